@@ -10,16 +10,18 @@ from tkinter import ttk, filedialog, messagebox
 import numpy as np
 import Emittance_scanner
 import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-import json
+matplotlib.use('Agg') #pyplot and the Tk backend are imported when the first plot is shown (faster start)
 import ctypes
+import threading
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 class EmittanceScanGUI:
-    def __init__(self, root):
+    def __init__(self, root, Motor_instance=None):
         """
         Initiates instances of the Emittance_scanner Motor and Variables Classes.
+        With Motor_instance = Emittance_daemon.Remote_Motor, the GUI is a client of the acquisition daemon: scans run as daemon jobs (see run_remote).
         Creates root, as well as all the frames and a few buttons. Calls the create_widgets method at the end.
         Additionally, a few variables are defined, like x/y_scans (Number of scans on x?y axis), running (Array that shows if a scan is currently happening and if so, on which axis) 
         and the variables_dict (A dictionary containing the variables from the Variables class as well as their names and labels)
@@ -32,10 +34,21 @@ class EmittanceScanGUI:
         self.root.title("Emittance Scan")
         #self.root.columnconfigure(0, weight=1)
         self.running = [False, None]
+        self.stop_event = threading.Event() #stops the local scan job before its next column (see stop_scan)
         self.x_scans = None
         self.y_scans = None
         self.Var = Emittance_scanner.Variables()
-        self.Mot = Emittance_scanner.Motor()
+        self.Mot = Emittance_scanner.Motor() if Motor_instance is None else Motor_instance
+        self.remote = getattr(self.Mot, "remote", False) #scans, auto gain, resume and queue run in the acquisition daemon
+        Emittance_scanner.Command_Metrics.select_role("gui") #commands of the main thread are status polling; scans run in threads (see run_local)
+        self.estimator = Emittance_scanner.Scan_Time_Estimator(self.Mot.planner) #predicted scan durations (latencies learned from past scans)
+        self.settle = Emittance_scanner.Settle_Model.load(Emittance_scanner.Settle_Model.setup_key("ANY", "DAC1", "AIN1"))
+        self.time_warning = 12*3600 #s, scan configurations that take longer ask for a confirmation
+        self.progress = None #latest progress event of the running scan (ETA)
+        Emittance_scanner.Read_and_Analyze.listeners.append(self.progress_event)
+        self.viewer = None #results viewer, created with the first plot (see create_viewer)
+        self.plot_cache = {} #data file: Future of its plot data (displayed scan and its neighbours)
+        self.plot_loader = ThreadPoolExecutor(max_workers=1) #prepares plot data in the background
         self.variables_dict = np.array([
             ["Extraction Voltage U [V]", "V_extr", self.Var.V_extr],
             ["Maximal x' [mrad]", "xp_max", self.Var.xp_max], 
@@ -104,6 +117,9 @@ class EmittanceScanGUI:
         
         load_data_btn = ttk.Button(self.frame9, text="Load Data", command = self.load_emittance)
         load_data_btn.grid(row=0, column = 0, sticky="en", padx=5, pady=5)
+        
+        resume_btn = ttk.Button(self.frame9, text="Resume Scan", command = self.resume_scan) #continues an interrupted scan from its journal file
+        resume_btn.grid(row=1, column = 0, sticky="en", padx=5, pady=5)
         # Initialize the GUI components
         self.create_widgets()
     
@@ -140,7 +156,7 @@ class EmittanceScanGUI:
         self.aecr = ttk.Button(self.frame2, state="normal", text="AECR", command = lambda: self.select_BeamLine(1)) #selects aecr as active beam_line, beam_line = 1
         self.aecr.grid(row=1, column=1)
         
-        emergency_stop = tk.Button(self.frame1, text="Kill All Motion", command = lambda: self.Mot.send_command("SET BIT8467 : SET BIT8499 : SET BIT8531 : SET BIT8563"), bg="red", fg="white") 
+        emergency_stop = tk.Button(self.frame1, text="Kill All Motion", command = self.kill_all_motion, bg="red", fg="white") 
         emergency_stop.grid(row=0, column=3, sticky="e") #emergency stop ends all movement and sets a kill all motion request, that won't allow further motion
         
         clear_kill_all = tk.Button(self.frame1, text="Clear Kill All Motion", command = lambda: self.Mot.send_command("CLR BIT8467 : CLR BIT8499 : CLR BIT8531 : CLR BIT8563"), bg="green", fg="white")
@@ -153,8 +169,10 @@ class EmittanceScanGUI:
         self.gain_dropdown = ttk.OptionMenu(self.frame7, self.gain_var, format(self.Mot.Voltagecurrentfactor, '.0e'), *[format(val, '.0e') for val in allowed_values], command=lambda value: self.set_gain_from_dropdown(value))
         self.gain_dropdown.grid(row=1, column=0, padx=5, pady=5)
         self.gain_dropdown.configure(style = "Custom.TMenubutton")
+        auto_gain_btn = ttk.Button(self.frame7, text="Auto Gain", command = self.auto_gain) #quick pre-scan that recommends the gain
+        auto_gain_btn.grid(row=1, column=1, padx=5, pady=5)
         
-        #front shield gain curently has no use. May be of use later on. 
+        #front shield current is measured with every sample (Read_and_Analyze.frontshield) and stored for drift normalization
         front_shield_gain_label = ttk.Label(self.frame7, text = "Front Shield Gain [V/A]", font=('Helvetica', 9))
         front_shield_gain_label.grid(row=2, column=0, padx=5, pady=5)
         allowed_values = [1e3, 1e4, 1e5, 1e6, 1e7,1e8, 1e9, 1e10, 1e11]
@@ -172,6 +190,7 @@ class EmittanceScanGUI:
         tk.Label(self.frame5, text="Gamma: None", font=("Helvetica", 10), bg="lightgrey").grid(row=2, column=2, sticky="e")
         
         self.create_LEDs()      
+        self.create_diagnostics()
         self.create_axis_status()       
         self.create_run_buttons()
         self.create_center_retract_buttons()
@@ -186,9 +205,10 @@ class EmittanceScanGUI:
 
         """
         if self.running[0]:
-            self.Mot.send_command("SET BIT8467 : SET BIT8499 : SET BIT8531 : SET BIT8563")
+            self.kill_all_motion()
             self.Mot.send_command("CLR BIT8467 : CLR BIT8499 : CLR BIT8531 : CLR BIT8563")
-            self.Mot.move_out(self.running[1])
+            if self.Mot.beam_line is not None: #both axes at the same time
+                self.Mot.move_out_multiple([[0,2][self.Mot.beam_line], [1,3][self.Mot.beam_line]])
         self.Var = Emittance_scanner.Variables()
         self.Mot.beam_line = None
         self.x_scans = None
@@ -239,17 +259,19 @@ class EmittanceScanGUI:
     def update_scale(self, i):
         """
         This updates the scales, canvases and positions every 42ms ~ 24fps for a smooth motion.
+        The position is predicted from the running move (Motor.predicted_position), the controller is only asked about once
+        per second while the axis moves and not at all while it is idle.
         """
-        if self.Mot.beam_line != None: #No need to update if no beam line has been selected
+        if self.Mot.beam_line != None and self.connected(): #No need to update if no beam line has been selected
             axis = i + 2*self.Mot.beam_line
-            self.scale_positions[i] = self.Mot.send_command(f"?P(12288 + {axis}*256")/self.Mot.factor #asking the controller for the current position and converting to mm
+            self.scale_positions[i], moving = self.Mot.predicted_position(axis) #mm
             self.scales[i].set(self.scale_positions[i])
             if self.Mot.centered[i+2*self.Mot.beam_line]:
                 min_position = -40
                 max_position = 160
                 self.scales[i].config(from_= min_position, to = max_position)
                 self.draw_ticks(self.tick_canvases[i], self.scales[i], 20)
-            if self.running[0] and self.running[1]%2 == i:     
+            if self.running[0] and self.running[1] is not None and self.running[1]%2 == i: #running[1] is None while the scan queue runs     
                 max_position = [self.Var.x_max, self.Var.y_max][i]
                 min_position = [self.Var.x_min, self.Var.y_min][i]
                 self.scales[i].config(from_= min_position, to = max_position)
@@ -270,6 +292,43 @@ class EmittanceScanGUI:
         except ValueError:
             pass 
     
+    def auto_gain(self):
+        """
+        Runs a quick pre-scan on the x-axis of the selected beam line (Read_and_Analyze.auto_gain) and shows the recommended gain.
+        The gain has to be set on the Keithley 428 by hand; after confirming, it is used for the next scans.
+        """
+        if self.Mot.beam_line == None or self.running[0]:
+            return
+        axis = [0,2][self.Mot.beam_line]
+        try:
+            RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
+        except TypeError: #variables not defined yet
+            messagebox.showinfo("Auto Gain", "Define the variables first.")
+            return
+        if self.remote:
+            self.run_remote("auto_gain", self.show_gain_recommendation, variables=vars(self.Var), axis=axis)
+            return
+        def job():
+            self.Mot.centering(axis)
+            try:
+                return RnA.auto_gain(axis)
+            finally:
+                self.Mot.move_out(axis)
+        self.run_local(job, self.show_gain_recommendation, axis)
+
+    def show_gain_recommendation(self, result):
+        """
+        Shows the result of the auto gain pre-scan (Read_and_Analyze.recommend_gain) and uses the gain after confirmation.
+        """
+        gain = format(result["gain"], '.0e')
+        text = (f"Peak current: {result['peak_current']:.3e} A, noise: {result['noise_current']:.3e} A (S/N {result['signal_to_noise']:.0f})\n"
+                f"Recommended gain: {gain} V/A (peak {result['peak_voltage']:.2f} V)\n")
+        if result["saturated"]:
+            text += "The pre-scan was saturated, repeat it with the recommended gain.\n"
+        if messagebox.askyesno("Auto Gain", text + "\nSet the Keithley 428 to this gain and press Yes to use it."):
+            self.gain_var.set(gain)
+            self.set_gain_from_dropdown(gain)
+
     def load_emittance(self):
         """
         Opens an emittance scan data file and displays the results, i.e. the plot and the twiss parameters.
@@ -287,21 +346,61 @@ class EmittanceScanGUI:
                 print(f"Error opening file: {e}")
                 continue
         
+    def resume_scan(self):
+        """
+        Opens the journal of an interrupted scan, measures the missing columns, displays the result and retracts the axis.
+
+        """
+        file_path = filedialog.askopenfilename(filetypes=[("Scan Journal", "*.journal")])
+        if not file_path:
+            return
+        header, columns = Emittance_scanner.Read_and_Analyze.read_journal(file_path)
+        axis = header["axis"]
+        if self.remote:
+            self.run_remote("resume", lambda filename: self.display_results(axis=None, filepath=filename), journal=os.path.abspath(file_path))
+            return
+        def job():
+            try:
+                return Emittance_scanner.Read_and_Analyze.resume(file_path, self.Mot, self.stop_event)[1]
+            finally:
+                self.Mot.move_out(axis)
+        self.run_local(job, lambda filename: self.display_results(axis=None, filepath=filename), axis)
+        
     def end_program(self): #stops all motion and moves all scanners out
         """
-        Stops all motion, moves out the axes and ends the program.
+        Stops all motion, moves out the axes and ends the program. Without a connection (offline), the GUI just closes.
 
         """
-        self.Mot.send_command("SET BIT8467 : SET BIT8499 : SET BIT8531 : SET BIT8563")
-        self.Mot.send_command("CLR BIT8467 : CLR BIT8499 : CLR BIT8531 : CLR BIT8563")
-        if self.Mot.beam_line != None:
-            self.Mot.move_out([0,2][self.Mot.beam_line])
-            self.Mot.move_out([1,3][self.Mot.beam_line])
-        else:
-            for i in range(4):
-                self.Mot.move_out(i)
+        if self.connected():
+            self.kill_all_motion()
+            self.Mot.send_command("CLR BIT8467 : CLR BIT8499 : CLR BIT8531 : CLR BIT8563")
+            if self.Mot.beam_line != None:
+                self.Mot.move_out_multiple([[0,2][self.Mot.beam_line], [1,3][self.Mot.beam_line]])
+            else:
+                self.Mot.move_out_multiple([0, 1, 2, 3])
         self.root.destroy()
         
+    def kill_all_motion(self):
+        """
+        Stops all motion and sets the kill all motion request of every axis, so nothing moves until it is cleared.
+        A running scan job is stopped first (see stop_scan), otherwise it would continue with the next column.
+
+        """
+        if self.running[0] or self.remote: #the daemon may run a job that was started by another client
+            self.stop_scan()
+        self.Mot.send_command("SET BIT8467 : SET BIT8499 : SET BIT8531 : SET BIT8563")
+
+    def stop_scan(self):
+        """
+        Stops the running scan job before its next column; the measured columns stay in the journal (see Resume Scan).
+        With the acquisition daemon, the daemon's running job is aborted.
+
+        """
+        if self.remote:
+            self.Mot.abort_job()
+        else:
+            self.stop_event.set()
+
     def create_retraction_status(self): #status lights to show if x and y are retracted or not
         """
         Status 'LEDs' that indicate wether an axis is cleared, i.e. at out Limit (green) or not (grey)
@@ -323,17 +422,18 @@ class EmittanceScanGUI:
         Updates retraction status 'LEDs' every second
 
         """
-        if self.Mot.beam_line != None:
+        if self.Mot.beam_line != None and self.connected():
             axes= np.array([[0,1], [2,3]])
-            for i in axes[self.Mot.beam_line]:
+            for n, i in enumerate(axes[self.Mot.beam_line]):
                 retracted = self.Mot.send_command(f"?BIT(16129 + {i}*32)")  #negative EOT Limit current status (0=not encountered, -1 = encountered)
                 if retracted:
                     color = "green3" #axis retracted
                 else:
                     color = "grey"
+                self.retraction_canvas.itemconfig(self.retraction[n], fill=color)
         else:
-            color = "grey"
-        self.retraction_canvas.itemconfig(self.retraction[i], fill=color)
+            for signal in self.retraction:
+                self.retraction_canvas.itemconfig(signal, fill="grey")
         self.root.after(1000, self.update_retraction_status)
         
     def create_center_retract_buttons(self):
@@ -347,7 +447,7 @@ class EmittanceScanGUI:
         self.center_y_btn = ttk.Button(self.frame6, text="Center Y-Axis", state = "disabled", command = lambda: self.Mot.centering([1,3][self.Mot.beam_line]))
         self.center_y_btn.grid(row=0, column=1, padx=5, pady=5)
         
-        self.retract_both_btn = ttk.Button(self.frame6, text="Retract Both Axes", state = "normal", command = lambda: (self.Mot.move_out([0,2][self.Mot.beam_line]), self.Mot.move_out([1,3][self.Mot.beam_line])))
+        self.retract_both_btn = ttk.Button(self.frame6, text="Retract Both Axes", state = "normal", command = lambda: self.Mot.move_out_multiple([[0,2][self.Mot.beam_line], [1,3][self.Mot.beam_line]]))
         self.retract_both_btn.grid(row=1, column=1, columnspan=2, padx=5, pady=5)
         
         self.update_center_retract_buttons()
@@ -357,7 +457,7 @@ class EmittanceScanGUI:
         Updates centering and retraction buttons, i.e. disables them if no beam line is selected.
 
         """
-        if self.Mot.beam_line != None:
+        if self.Mot.beam_line != None and self.connected():
             #x = [0,2][self.Mot.beam_line]
             #x_clear = self.Mot.axis_clear(x) #boolean
             #x_state = ["disabled", "normal"][int(x_clear)] #don"t have to check if the axis is clear becasue this is done in the centering method anyways
@@ -385,6 +485,26 @@ class EmittanceScanGUI:
         self.run_y_btn = ttk.Button(self.frame4, state="disabled", text="Run Y Scans", command = lambda  : self.run_scan([1,3][self.Mot.beam_line]))
         self.run_y_btn.grid(row=1, column=2,columnspan=2, padx=5, pady=5)
         
+        #scan jobs can also be queued and run unattended one after the other (the queue is kept in a file and survives a restart)
+        self.queue = Emittance_scanner.Scan_Queue()
+        self.queue_x_btn = ttk.Button(self.frame4, state="disabled", text="Queue X Scans", command = lambda : self.enqueue_scan([0,2][self.Mot.beam_line]))
+        self.queue_x_btn.grid(row=2, column=0,columnspan=2, padx=5, pady=5)
+        
+        self.queue_y_btn = ttk.Button(self.frame4, state="disabled", text="Queue Y Scans", command = lambda : self.enqueue_scan([1,3][self.Mot.beam_line]))
+        self.queue_y_btn.grid(row=2, column=2,columnspan=2, padx=5, pady=5)
+        
+        self.run_queue_btn = ttk.Button(self.frame4, state="disabled", text="Run Queue", command = self.run_queue)
+        self.run_queue_btn.grid(row=3, column=0,columnspan=2, padx=5, pady=5)
+        
+        self.queue_label = ttk.Label(self.frame4, text = "Queued Jobs: 0", font=("Helvetica", 10))
+        self.queue_label.grid(row=3, column=2, columnspan=2, padx=5, pady=5)
+        
+        self.time_label = ttk.Label(self.frame4, text = "Estimated Time: -", font=("Helvetica", 10)) #estimate before the scan, ETA during the scan
+        self.time_label.grid(row=4, column=0, columnspan=4, padx=5, pady=5)
+        
+        self.stop_btn = ttk.Button(self.frame4, state="disabled", text="Stop Scan", command = self.stop_scan) #stops the running scan (or daemon job) before the next column
+        self.stop_btn.grid(row=5, column=0, columnspan=4, padx=5, pady=5)
+        
         self.update_run_buttons()
         
     def update_run_buttons(self):
@@ -392,7 +512,7 @@ class EmittanceScanGUI:
         Updates run buttons depending if the beam line has been selected and variables are not None.
 
         """
-        if self.Mot.beam_line != None and all(val is not None for val in [self.Var.Q, self.Var.M, self.Var.V_extr]):
+        if self.Mot.beam_line != None and self.connected() and all(val is not None for val in [self.Var.Q, self.Var.M, self.Var.V_extr]):
             FC_state = ["disabled", "normal"][int(self.Mot.check_FC())]
             if self.x_scans != None:
                 if all(val is not None for val in [self.Var.x_max, self.Var.x_min, self.Var.xp_max, self.Var.x_step, self.Var.xp_step]):
@@ -416,90 +536,288 @@ class EmittanceScanGUI:
         if self.running[0]:
             self.run_x_btn.config(state="disabled")
             self.run_y_btn.config(state="disabled")
+        self.queue_x_btn.config(state = str(self.run_x_btn.cget("state"))) #a scan can be queued whenever it could be run
+        self.queue_y_btn.config(state = str(self.run_y_btn.cget("state")))
+        pending = self.queue.pending()
+        self.queue_label.config(text = f"Queued Jobs: {pending}")
+        self.time_label.config(text = self.time_text())
+        self.run_queue_btn.config(state = ["disabled", "normal"][int(pending > 0 and not self.running[0])])
+        self.stop_btn.config(state = ["disabled", "normal"][int(self.running[0])])
         self.root.after(1000, self.update_run_buttons)
     
+    def estimate_scan_time(self, axis):
+        """
+        Returns
+        -------
+        float or None
+            predicted duration [s] of the configured scans on axis, None if the variables are not complete
+        """
+        try:
+            scans = int([self.x_scans, self.y_scans][axis%2])
+            return self.estimator.estimate(self.Var, axis, scans, settle=self.settle)
+        except (TypeError, ValueError, ZeroDivisionError): #variables or number of scans not set yet
+            return None
+
+    @staticmethod
+    def format_duration(t):
+        return f"{t/3600:.1f} h" if t >= 3600 else f"{t/60:.0f} min"
+
+    def time_text(self):
+        """
+        Text of the time label: ETA of the running scan, otherwise the estimated duration of the configured X and Y scans.
+        """
+        if self.running[0] and self.progress is not None:
+            event = self.progress
+            return f"Column {event['column']+1}/{event['columns']}, ETA: {self.format_duration(event['ETA'])}"
+        estimates = [self.estimate_scan_time(axis) for axis in (0, 1)]
+        if all(t is None for t in estimates):
+            return "Estimated Time: -"
+        return "Estimated Time: " + ", ".join(f"{name} {self.format_duration(t)}" for name, t in zip(["X", "Y"], estimates) if t is not None)
+
+    def progress_event(self, event):
+        """Read_and_Analyze listener (called from the scan thread), keeps the latest event for the time label."""
+        self.progress = event
+
+    def check_scan_time(self):
+        """
+        Warns if the configured scans take longer than self.time_warning.
+        """
+        for axis, name in [(0, "X"), (1, "Y")]:
+            t = self.estimate_scan_time(axis)
+            if t is not None and t > self.time_warning and t != getattr(self, f"warned_{name}", None): #warn once per configuration
+                setattr(self, f"warned_{name}", t)
+                messagebox.showwarning("Long Scan", f"The {name} scans will take about {self.format_duration(t)} "
+                                       f"(more than {self.format_duration(self.time_warning)}). Consider larger step sizes, smaller ranges or fewer scans.")
+
+    def enqueue_scan(self, axis):
+        """
+        Adds the scans on the selected axis, with the current variables, number of scans and gain, to the scan queue.
+        """
+        try: 
+            scans = int([self.x_scans, self.y_scans][axis%2])
+        except:
+            return None
+        self.queue.enqueue(self.Var, axis, scans, self.Mot.Voltagecurrentfactor)
+        
+    def run_queue(self):
+        """
+        Runs all queued scan jobs in a separate thread (see run_local), so the window stays responsive during an unattended
+        (e.g. overnight) run. Jobs that failed are reported in a message box at the end.
+        """
+        jobs = [job["id"] for job in self.queue.load() if job["status"] == "pending"]
+        if self.remote: #the daemon reads the same queue file
+            self.run_remote("queue", lambda result: self.report_queue(jobs), file_name=os.path.abspath(self.queue.file_name))
+            return
+        self.run_local(lambda: self.queue.run(self.Mot, stop_event=self.stop_event), lambda result: self.report_queue(jobs)) #Stop Scan ends the run after the current job
+
+    def report_queue(self, jobs):
+        """
+        Shows the errors of the jobs (ids) that failed in the last queue run.
+        """
+        failed = [job for job in self.queue.load() if job["id"] in jobs and job["status"] == "failed"]
+        if failed:
+            messagebox.showerror("Queue", "\n".join(f"Job {job['id']} ({job['beam_line']}, axis {job['axis']}): {job['error']}" for job in failed))
+    
     def run_scan(self, axis):
         """
         Centers Axis, initiates a Read_and_Analyze object, and starts a number of scans (given by the user) on the selected axis.
-        It then calls the display_results method and retracts the axis.
+        It then retracts the axis and calls the display_results method. The scans run in a thread (see run_local).
         """
-        self.Mot.centering(axis)
-        self.running = [True, axis]
-        RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
         try: 
             scans = int([self.x_scans, self.y_scans][axis%2])
         except:
             return None
-        self.scan_results = []
-        for i in range(scans):
-            I, filename = RnA.get_current(axis)
-            E_rms, alpha, beta, gamma = RnA.emittance(axis, I)
-            #RnA.phase_space_plot(filename, E_rms, alpha, beta)
-            self.scan_results.append((filename, E_rms, alpha, beta, gamma))
-        self.current_scan = 0
-        self.display_results(axis)
-        self.Mot.move_out(axis)
-        self.running = [False, None]
+        def done(results):
+            self.scan_results = [tuple(result) for result in results]
+            self.current_scan = 0
+            self.display_results(axis)
+        if self.remote:
+            self.run_remote("scans", done, variables=vars(self.Var), axis=axis, scans=scans)
+            return
+        RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
+        RnA.stop_event = self.stop_event
+        def job():
+            self.Mot.centering(axis)
+            results = []
+            try: #a SaturationError stops this and the next scans, there is no use in finishing them
+                for i in range(scans):
+                    I, filename = RnA.get_current(axis)
+                    E_rms, alpha, beta, gamma = RnA.emittance(axis, I)
+                    #RnA.phase_space_plot(filename, E_rms, alpha, beta)
+                    results.append((filename, E_rms, alpha, beta, gamma))
+                if scans > 1: #combined result of the repeated scans is shown as the last page
+                    stats = Emittance_scanner.Scan_Statistics.from_files([result[0] for result in results])
+                    intervals = stats.bootstrap()
+                    filename = stats.write_and_save_file(intervals)
+                    results.append((filename, *[intervals[name][0] for name in ["E_rms", "alpha", "beta", "gamma"]]))
+            finally:
+                self.Mot.move_out(axis)
+            return results
+        self.run_local(job, done, axis)
+
+    def run_local(self, job, done, axis=None):
+        """
+        Runs job() (centering, scans, retraction) in a thread and checks it every 0.2 s, so the window and its status
+        pollers stay responsive during the scan (local counterpart of run_remote). The job's commands count as scan commands
+        in the controller link metrics. done(result) is called in the main thread; errors are shown in a message box.
+        """
+        self.stop_event.clear()
+        self.running = [True, axis]
+        self.progress = None
+        outcome = {}
+        def run():
+            Emittance_scanner.Command_Metrics.select_role("scan")
+            try:
+                outcome["result"] = job()
+            except Exception as e:
+                outcome["error"] = e
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        def poll():
+            if thread.is_alive():
+                self.root.after(200, poll)
+                return
+            self.running = [False, None]
+            self.estimator.load() #timing learned by the scan (see Scan_Time_Estimator.learn)
+            if "error" in outcome:
+                messagebox.showerror("Scan stopped", str(outcome["error"]))
+            else:
+                done(outcome["result"])
+        poll()
         
+    def run_remote(self, kind, done, **params):
+        """
+        Starts a job in the acquisition daemon (Emittance_daemon.Scan_Daemon.run_job) and polls its status every 0.5 s,
+        so the window stays responsive. done(result) is called when the job has finished; errors are shown in a message box.
+        """
+        try:
+            job_id = self.Mot.start_job(kind, **params)
+        except Exception as e:
+            messagebox.showerror("Acquisition Daemon", str(e))
+            return
+        self.running = [True, params.get("axis")]
+        self.progress = None
+        def poll():
+            status = self.Mot.job_status(job_id)
+            self.progress = status["progress"] #ETA for the time label
+            if status["state"] == "running":
+                self.root.after(500, poll)
+                return
+            self.running = [False, None]
+            self.estimator.load() #timing learned by the daemon's scan
+            if status["state"] == "done":
+                done(status["result"])
+            else:
+                messagebox.showerror("Scan stopped", status["error"]["message"])
+        poll()
+
     def display_results(self, axis=None, filepath=None):
         """
         Display Results from Current Scan or display results from a given data file.
         Every scan is displayed by a plot and through next and previous buttons, the user can witch to plots from other scans.
+        The figure, canvas and toolbar are created once (create_viewer); paging only replaces the image data, the ellipse and the labels.
+        The plot data of the neighbouring scans is prepared in the background (prefetch_results), so paging does not wait for the files.
         """
         if filepath: #load an existing file to see the plot and data
             filename = filepath
-            data = []
-            with open(filename) as f:
-                for i, line in enumerate(f):
-                    if i%2 == 1:
-                        try:
-                            data.append(json.loads(line))
-                        except:
-                            data.append(line.strip())
-            dic = data[0]
+            data = Emittance_scanner.read_data_file(filename)
+            dic = data["variables"]
             for row, (var_label, var_name, var_value) in enumerate(self.variables_dict):
                 setattr(self.Var, var_name, dic[var_label])
-            axis = data[2]
-            beam_line= data[1]
-            RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
-            beam_line = np.where(np.array(["VENUS", "AECR"])==beam_line)[0].item()
-            axis = np.where(np.array(["X", "Y", "X", "Y"])==axis)[0][beam_line].item()
-            E_rms, alpha, beta, gamma = float(data[7]), float(data[8]), float(data[9]), float(data[10])
+            beam_line = np.where(np.array(["VENUS", "AECR"])==data["beam_line"])[0].item()
+            axis = np.where(np.array(["X", "Y", "X", "Y"])==data["axis"])[0][beam_line].item()
+            E_rms, alpha, beta, gamma = data["E_rms"], data["alpha"], data["beta"], data["gamma"]
         else:
             if not hasattr(self, 'scan_results') or not self.scan_results:
                 return
             filename, E_rms, alpha, beta, gamma = self.scan_results[self.current_scan]
-            RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
-            
-        self.canvas.delete("all")
+        self.viewer_axis = axis
+        if self.viewer is None:
+            self.create_viewer()
+        plot = self.plot_data(filename).result()
         
-        for widget in self.frame5.winfo_children():
+        self.plot_image.set_data(plot["I"])
+        self.plot_image.set_extent(plot["extent"])
+        self.plot_image.set_clim(plot["I"].min(), plot["I"].max())
+        self.plot_ellipse.set_data(*plot["ellipse"])
+        self.plot_ellipse.set_label("$\\epsilon_{rms}$ = "+f"{round(plot['E_rms'],4)} [mm mrad]")
+        self.plot_ax.set_xlim(plot["extent"][:2])
+        self.plot_ax.set_ylim(plot["extent"][2:])
+        self.plot_ax.set_xlabel(f"Position {plot['axis']} [mm]")
+        self.plot_ax.set_ylabel(f"Momentum {plot['axis']}' [mrad]")
+        self.plot_ax.set_title(f"{plot['beam_line']} {plot['axis']}-Axis Emittance Scan")
+        self.plot_toolbar.update() #zoom/pan history of the previous scan does not apply
+        self.plot_canvas.draw_idle()
+        img_filename = filename.strip("txt") + "jpeg" #same picture phase_space_plot saves
+        if not os.path.exists(img_filename):
+            self.plot_figure.savefig(img_filename)
+        
+        self.epsilon_label.config(text=f"Epsilon: {E_rms*4*1e6:.4f} [mm mrad]")
+        self.alpha_label.config(text=f"Alpha: {alpha:.4f}")
+        self.beta_label.config(text=f"Beta: {beta:.4f} [mm/mrad]")
+        self.gamma_label.config(text=f"Gamma: {gamma:.4f} [mrad/mm]")
+        self.prefetch_results()
+
+    def create_viewer(self):
+        """
+        Creates the persistent figure (a matplotlib Figure, not a pyplot figure, so nothing is kept in the pyplot registry),
+        canvas, toolbar, labels and Previous/Next buttons of the results viewer.
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
+        for widget in self.frame5.winfo_children(): #placeholder canvas and labels
             widget.destroy()
-                
         self.canvas = tk.Canvas(self.frame5)
         self.canvas.grid(row=0, column=0, columnspan=5)
-
-        fig, ax = plt.subplots(figsize=(4.2,3.6), dpi=100)
-        #RnA = Emittance_scanner.Read_and_Analyze(self.Var, self.Mot)
-        RnA.phase_space_plot(filename)
-        
-        fig.tight_layout
+        self.plot_figure = Figure(figsize=(4.2,3.6), dpi=100)
+        self.plot_ax = self.plot_figure.add_subplot()
+        self.plot_image = self.plot_ax.imshow(np.zeros((2, 2)), cmap="inferno", origin="lower", aspect="auto")
+        self.plot_ellipse, = self.plot_ax.plot([], [], 'r--')
+        self.plot_figure.colorbar(self.plot_image, ax=self.plot_ax, label = "Current [nA]")
+        self.plot_figure.tight_layout()
             
-        plot_canvas = FigureCanvasTkAgg(fig, self.canvas)
-        plot_canvas.draw()
-        plot_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        
-        toolbar = NavigationToolbar2Tk(plot_canvas, self.canvas) #a toolbar that allows the user to zoom in on the plot and move around
-        toolbar.update()
-        plot_canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
-        
-        tk.Label(self.frame5, text=f"Epsilon: {E_rms*4*1e6:.4f} [mm mrad]", font=("Helvetica", 11), bg="lightgrey").grid(row=1, column=0)
-        tk.Label(self.frame5, text=f"Alpha: {alpha:.4f}", font=("Helvetica", 11), bg="lightgrey").grid(row=1, column=1, sticky="e")
-        tk.Label(self.frame5, text=f"Beta: {beta:.4f} [mm/mrad]", font=("Helvetica", 11), bg="lightgrey").grid(row=2, column=0)
-        tk.Label(self.frame5, text=f"Gamma: {gamma:.4f} [mrad/mm]", font=("Helvetica", 11), bg="lightgrey").grid(row=2, column=1, sticky="e")
+        self.plot_canvas = FigureCanvasTkAgg(self.plot_figure, self.canvas)
+        self.plot_toolbar = NavigationToolbar2Tk(self.plot_canvas, self.canvas) #a toolbar that allows the user to zoom in on the plot and move around
+        self.plot_toolbar.update()
+        self.plot_canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        
+        self.epsilon_label = tk.Label(self.frame5, font=("Helvetica", 11), bg="lightgrey")
+        self.epsilon_label.grid(row=1, column=0)
+        self.alpha_label = tk.Label(self.frame5, font=("Helvetica", 11), bg="lightgrey")
+        self.alpha_label.grid(row=1, column=1, sticky="e")
+        self.beta_label = tk.Label(self.frame5, font=("Helvetica", 11), bg="lightgrey")
+        self.beta_label.grid(row=2, column=0)
+        self.gamma_label = tk.Label(self.frame5, font=("Helvetica", 11), bg="lightgrey")
+        self.gamma_label.grid(row=2, column=1, sticky="e")
             
-        ttk.Button(self.frame5, text="Previous", command = lambda: self.previous_scan(axis)).grid(row=2, column=0, sticky="w")
-        ttk.Button(self.frame5, text="Next", command = lambda: self.next_scan(axis)).grid(row=2, column=3, sticky="e")
+        ttk.Button(self.frame5, text="Previous", command = lambda: self.previous_scan(self.viewer_axis)).grid(row=2, column=0, sticky="w")
+        ttk.Button(self.frame5, text="Next", command = lambda: self.next_scan(self.viewer_axis)).grid(row=2, column=3, sticky="e")
+        self.viewer = True
+
+    def plot_data(self, filename):
+        """
+        Returns
+        -------
+        concurrent.futures.Future
+            of Emittance_scanner.phase_space_data(filename), computed in the viewer's background thread
+        """
+        if filename not in self.plot_cache:
+            self.plot_cache[filename] = self.plot_loader.submit(Emittance_scanner.phase_space_data, filename)
+        return self.plot_cache[filename]
+
+    def prefetch_results(self):
+        """
+        Starts preparing the scans next to the displayed one and drops all others from the cache, so the memory does not grow with paging.
+        """
+        keep = set()
+        if getattr(self, 'scan_results', None):
+            for i in range(self.current_scan - 1, self.current_scan + 2):
+                if 0 <= i < len(self.scan_results):
+                    keep.add(self.scan_results[i][0])
+                    self.plot_data(self.scan_results[i][0])
+        for filename in list(self.plot_cache):
+            if filename not in keep:
+                del self.plot_cache[filename]
             
     def previous_scan(self, axis):
         """Navigate to previous Scan."""
@@ -530,7 +848,7 @@ class EmittanceScanGUI:
         """
         Updates Axis status labels every second, by calling the Motor.is_clear method. 
         """
-        if self.Mot.beam_line != None:
+        if self.Mot.beam_line != None and self.connected():
             x = [0,2][self.Mot.beam_line]
             y = [1,3][self.Mot.beam_line]
             if self.Mot.axis_clear(x) and self.Mot.check_FC():
@@ -542,7 +860,7 @@ class EmittanceScanGUI:
             else:
                 self.y_status_label.config(text="Y Axis: obstructed", foreground="red", font=("Helvetica", 10))
         else:
-            self.x_status_label.config(text = "Y Axis: checking...", font=("helvetica", 10), foregroun="black")
+            self.x_status_label.config(text = "X Axis: checking...", font=("helvetica", 10), foreground="black")
             self.y_status_label.config(text = "Y Axis: checking...", font=("helvetica", 10), foreground="black")
         self.root.after(1000, self.update_axis_status)
         
@@ -570,8 +888,10 @@ class EmittanceScanGUI:
     
     def update_LEDs(self):
         for i in range(4):
+            if not self.connected(): #offline: the LEDs stay grey
+                break
             drive_status = self.Mot.send_command(f"?BIT(8465 + {i}*32)")
-            fault_status = self.Motor.send_command(f"?BIT(8477 + {i}*32)")
+            fault_status = self.Mot.send_command(f"?BIT(8477 + {i}*32)")
             if bool(drive_status)and not bool(fault_status):
                 color = "green3" #Drive on, no fault
             elif bool(fault_status):
@@ -583,12 +903,50 @@ class EmittanceScanGUI:
         self.root.after(1000, self.update_LEDs)
     
         
+    def create_diagnostics(self):
+        """
+        Controller link statistics of the last minute (see Emittance_scanner.Command_Metrics): command rate (all and GUI polling),
+        latency, time the GUI and the scan waited for the link, link utilization, parse failures and timeouts.
+        The text turns red if the controller responds slowly or the scan waits for the link.
+        """
+        self.slow_latency = 0.2 #s, p95 latency above this counts as slow controller
+        self.slow_wait = 0.1 #s, p95 wait of the scan above this counts as starved by GUI polling
+        diagnostics_title = ttk.Label(self.frame3, text="Controller Link", font=("Helvetica", 10, "bold"))
+        diagnostics_title.grid(row=2, column=0, padx=5, pady=(5, 0))
+        self.diagnostics_label = tk.Label(self.frame3, text="", font=("Helvetica", 9), justify="left", anchor="w")
+        self.diagnostics_label.grid(row=3, column=0, sticky="w", padx=5, pady=(0, 5))
+        self.update_diagnostics()
+
+    def update_diagnostics(self):
+        summary = self.Mot.metrics.summary()
+        ms = lambda t: "-" if t is None else f"{t*1e3:.0f} ms"
+        text = (f"Commands: {summary['rate']:.1f}/s (GUI {summary['rate_gui']:.1f}/s), busy {summary['utilization']*100:.0f} %\n"
+                f"Latency: {ms(summary['latency_p50'])} (p95 {ms(summary['latency_p95'])})\n"
+                f"Wait p95: GUI {ms(summary['wait_p95_gui'])}, scan {ms(summary['wait_p95_scan'])}\n"
+                f"Parse failures: {summary['parse_failures']}, Timeouts: {summary['timeouts']}, Errors: {summary['errors']}")
+        slow = (summary["latency_p95"] or 0) > self.slow_latency or (summary["wait_p95_scan"] or 0) > self.slow_wait
+        self.diagnostics_label.config(text=text, fg="red" if slow else "black")
+        self.root.after(1000, self.update_diagnostics)
+    
+    def connected(self):
+        """
+        True if the controller link is open (the daemon always has it open). The status pollers only query the controller
+        when it is, so the GUI can be opened without the controller to look at data files; selecting a beam line connects.
+        """
+        return self.remote or self.Mot.tn is not None
+
     def select_BeamLine(self, beam_line): #Buttons set beam_line either to 0 (Venus) or 1 (AECR)
         """
         Sets the Motor objects beam line variable to 0 if Button "Venus" was pressed and 1 if "AECR" was pressed.
         At the same time, both buttons are disabled after selecting a beam line.
+        Opens the connection to the controller; if it can not be opened, no beam line is selected.
         """
-        
+        try:
+            if not self.remote:
+                self.Mot.test_connection()
+        except (TimeoutError, OSError) as e:
+            messagebox.showerror("Controller", f"Cannot connect to the controller: {e}")
+            return
         self.Mot.beam_line = beam_line
         
         if self.Var.x_min != None:
@@ -631,6 +989,7 @@ class EmittanceScanGUI:
             value = int(value)
             setattr(self, var_name, value)
             entry.config(bg="lightgreen")
+            self.check_scan_time()
         except ValueError:
             entry.config(bg="red")
     
@@ -754,6 +1113,7 @@ class EmittanceScanGUI:
                 entry.insert(0, value)
             except ValueError:
                 entry.config(bg="red")
+        self.check_scan_time()
     
     def show_variables(self):#opens another window with all the variables 
         """
@@ -799,6 +1159,20 @@ class EmittanceScanGUI:
 
 
 if __name__ == "__main__":
+    if "--monitor" in sys.argv: #optional web page with the scan progress: --monitor [host:port], default localhost:8050
+        import Emittance_monitor
+        address = sys.argv[sys.argv.index("--monitor")+1:][:1]
+        host, port = (address[0].split(":") + ["8050"])[:2] if address else ("127.0.0.1", "8050")
+        Emittance_monitor.Monitor_Server(host, int(port)).start()
+    Motor_instance = None
+    if "--daemon" in sys.argv: #client of the acquisition daemon (python Emittance_daemon.py): --daemon [host:port], default localhost:8051
+        import Emittance_daemon
+        address = [arg for arg in sys.argv[sys.argv.index("--daemon")+1:][:1] if not arg.startswith("--")]
+        host, port = (address[0].split(":") + ["8051"])[:2] if address else ("127.0.0.1", "8051")
+        Motor_instance = Emittance_daemon.Remote_Motor(host, int(port))
     root = tk.Tk()
-    app = EmittanceScanGUI(root)
+    app = EmittanceScanGUI(root, Motor_instance)
+    if "--metrics" in sys.argv and not app.remote: #controller link metrics in the Prometheus text format: --metrics [file], rewritten every 15 s (with --daemon, start the daemon with --metrics)
+        file_name = (sys.argv[sys.argv.index("--metrics")+1:] + ["Emittance_Scanner_Metrics.prom"])[0]
+        app.Mot.metrics.start_export("Emittance_Scanner_Metrics.prom" if file_name.startswith("--") else file_name)
     root.mainloop()
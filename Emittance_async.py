@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio interface for the motor controller and the LabJack acquisition.
+
+The coroutines wrap the existing Motor and Read_and_Analyze objects, so settings, homing state, motion planning and
+scan journals are shared with the synchronous code. They run the same steps as the synchronous methods (see
+Motor.run_steps), only the link and the waiting are asynchronous: waiting (controller responses, moves, plate voltage
+settling, sample spacing) is done with await asyncio.sleep instead of time.sleep, so several axes, a status stream and
+e.g. a GUI or web front end can run in one event loop without threads.
+
+Usage:
+    import asyncio
+    import Emittance_scanner, Emittance_async
+    Mot = Emittance_async.Async_Motor(Emittance_scanner.Motor())
+    RnA = Emittance_async.Async_DAQ(Emittance_scanner.Variables(), Mot)
+    I, file_name = asyncio.run(RnA.get_current(0))
+
+Cancelling a task that moves an axis (e.g. task.cancel()) stops the move like a KeyboardInterrupt in Motor.move_to.
+The LabJack library calls are blocking, so they run in a thread (the samples of one plate voltage per call, see
+Read_and_Analyze.read_samples) and the loop stays free while a column is acquired.
+"""
+import asyncio
+import time
+import weakref
+import numpy as np
+import Emittance_scanner
+
+
+link_locks = weakref.WeakKeyDictionary() #Motor: {event loop: asyncio.Lock}, shared by all Async_Motor of a Motor
+
+
+class Async_Motor:
+    def __init__(self, Motor_instance):
+        """
+        asyncio wrapper of a connected Motor. Uses the same telnet link, program prompts (Motor.select_program works per task)
+        and state file, so it can be used alongside the synchronous Motor, also from other threads.
+
+        Parameters
+        ----------
+        Motor_instance : Motor
+
+        Returns
+        -------
+        None.
+
+        """
+        self.Mot = Motor_instance
+        self.delay = Motor_instance.response_delay #same response delay as Motor.exchange
+
+    @property
+    def lock(self):
+        """
+        asyncio.Lock of the link in the running loop, shared by all Async_Motor of the Motor: one command line at a time.
+        The threading lock of the Motor is re-entrant, so it does not keep two tasks of the same loop apart.
+        """
+        locks = link_locks.setdefault(self.Mot, weakref.WeakKeyDictionary())
+        return locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+
+    def __getattr__(self, name): #settings, centered, unit, targets, ... of the wrapped Motor
+        return getattr(self.Mot, name)
+
+    async def send_command(self, command, Print=False):
+        """
+        Sends command to ACR74C Controller without blocking the event loop.
+
+        Parameters
+        ----------
+        command : str
+            command to be sent to controller
+        Print : Bool, Optional
+            If True, the entire response of the controller is printed. The default is False.
+
+        Returns
+        -------
+        output : float
+            Returns controller response if it is a float, i.e. position, in motion bit, etc.
+            Returns None otherwise
+
+        """
+        response = await self.exchange(command, command)
+        if Print:
+            print(f"Full Response:\n{response}")
+        return self.Mot.parse_response(response)
+
+    async def send_batch(self, commands, Print=False):
+        """
+        Sends several commands as one colon-joined command line (one round trip), see Motor.send_batch.
+
+        Returns
+        -------
+        outputs : list
+            one entry per command: the response of queries as float, None otherwise
+        """
+        response = await self.exchange(commands[0], " : ".join(commands))
+        if Print:
+            print(f"Full Response:\n{response}")
+        return self.Mot.parse_batch(commands, response)
+
+    async def exchange(self, first, line):
+        """
+        Writes a command line (after the prompt switch, see Motor.program_commands) and returns the raw response.
+
+        Parameters
+        ----------
+        first : str
+            first command of the line
+        line : str
+            command line
+
+        Returns
+        -------
+        response : str
+
+        """
+        if not self.Mot.tn:
+            await asyncio.to_thread(self.Mot.connect)
+        requested = time.perf_counter()
+        async with self.lock:
+            while not self.Mot.lock.acquire(blocking=False): #link is used by a thread
+                await asyncio.sleep(0.005)
+            acquired = time.perf_counter()
+            try:
+                for command in self.Mot.program_commands(first) + [line]:
+                    self.Mot.tn.write(command.encode('ascii') + b'\r')
+                    await asyncio.sleep(self.delay)
+                    response = self.Mot.tn.read_very_eager().decode('ascii').strip()
+            except Exception:
+                self.Mot.metrics.record_error(line)
+                raise
+            finally:
+                self.Mot.lock.release()
+        self.Mot.metrics.record(line, acquired - requested, time.perf_counter() - acquired, response)
+        return response
+
+    async def wait_idle(self, axis, interval=0.0):
+        """
+        Waits until the master of axis is not in motion anymore.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        interval : float, optional
+            additional time between two polls [s]. The default is 0.0, i.e. one poll per response delay.
+
+        Returns
+        -------
+        None.
+
+        """
+        while await self.send_command(f"?BIT({self.Mot.in_motion_bit(axis)})"):
+            await asyncio.sleep(interval)
+
+    async def run_steps(self, steps):
+        """
+        Runs steps (see Motor.run_steps) in the event loop: command lines are sent with send_batch, waiting is awaited and
+        blocking calls run in a thread. If the task is cancelled, a KeyboardInterrupt is raised inside the steps, so a move
+        stops its axis as in the synchronous code, and the cancellation is passed on once the steps are done.
+
+        Parameters
+        ----------
+        steps : generator
+
+        Returns
+        -------
+        return value of steps
+
+        """
+        result, error, cancelled = None, None, None
+        while True:
+            try:
+                request = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                if cancelled is not None:
+                    raise cancelled
+                return done.value
+            except KeyboardInterrupt:
+                if cancelled is not None:
+                    raise cancelled from None
+                raise
+            result, error = None, None
+            try:
+                result = await self.execute_step(request)
+            except asyncio.CancelledError as e:
+                cancelled, error = e, KeyboardInterrupt()
+            except BaseException as e: #raised inside the steps
+                error = e
+
+    async def execute_step(self, request):
+        """
+        Executes one request of a steps generator, see Motor.run_steps.
+        """
+        kind, *args = request
+        if kind == "batch":
+            return await self.send_batch(args[0])
+        if kind == "wait_idle":
+            await asyncio.sleep(0.8*args[1]) #no polling while the move surely runs
+            await self.wait_idle(args[0])
+        elif kind == "sleep":
+            await asyncio.sleep(args[0])
+        elif kind == "wait":
+            if args[0]:
+                await asyncio.wait([asyncio.wrap_future(future) for future in args[0]])
+        elif kind == "call":
+            return await asyncio.to_thread(*args)
+        else:
+            raise ValueError(f"Unknown step {kind!r}")
+
+    async def axis_clear(self, axis):
+        """
+        Returns
+        -------
+        bool
+            True if the other axis of the beam line is at its positive EOT limit (see Motor.axis_clear)
+        """
+        return await self.run_steps(self.Mot.axis_clear_steps(axis))
+
+    async def check_FC(self):
+        """
+        Returns
+        -------
+        bool
+            True if the Faraday Cup is out (see Motor.check_FC)
+        """
+        return self.Mot.check_FC()
+
+    async def current_position(self, axis):
+        """
+        Returns
+        -------
+        float
+            position of axis [mm]. The position read at the end of the last move if it is known, otherwise read from the controller.
+        """
+        return await self.run_steps(self.Mot.current_position_steps(axis))
+
+    async def stop(self, axis):
+        """Kills the moves of axis and turns off its drive."""
+        await self.run_steps(self.Mot.stop_steps(axis))
+
+    async def move_to(self, position, axis):
+        """
+        Same as Motor.move_to: clears the axis, checks the Faraday Cup, moves and turns the drive off.
+        ----------
+        position : float
+            position in mm
+        axis : Int
+            in [0,1,2,3] (Venus x, Venus y, Aecr x, Aecr y)
+        -------
+        None.
+        """
+        await self.run_steps(self.Mot.move_to_steps(position, axis))
+        if self.Mot.centered[axis]:
+            await asyncio.to_thread(self.Mot.save_state, axis)
+
+    async def relative_move(self, position, axis):
+        """
+        Same as Motor.relative_move.
+        ----------
+        position : float
+            distance in mm
+        axis : int
+            in [0,1,2,3]
+        -------
+        None.
+        """
+        await self.run_steps(self.Mot.relative_move_steps(position, axis))
+
+    async def move_out(self, axis):
+        """Moving axis to positive EOT Limit."""
+        await self.run_steps(self.Mot.move_out_steps(axis))
+
+    async def status_stream(self, axes=(0,1,2,3), interval=0.5):
+        """
+        Asynchronous generator of the axis status, e.g.
+            async for status in Mot.status_stream((0,1)):
+                print(status)
+
+        Parameters
+        ----------
+        axes : tuple, optional
+            axes to report. The default is (0,1,2,3).
+        interval : float, optional
+            time between two reports [s]. The default is 0.5.
+
+        Yields
+        ------
+        status : dict
+            {axis: {"position": mm, "in_motion": bool, "drive": bool}}
+
+        """
+        while True:
+            status = {}
+            for axis in axes:
+                in_motion, drive = await self.send_batch([f"?BIT({self.Mot.in_motion_bit(axis)})", f"?BIT(8465 + {axis}*32)"])
+                status[axis] = {"position": await self.current_position(axis), "in_motion": bool(in_motion), "drive": bool(drive)}
+            yield status
+            await asyncio.sleep(interval)
+
+
+class Async_DAQ(Emittance_scanner.Read_and_Analyze):
+    def __init__(self, Variables_instance, Async_Motor_instance):
+        """
+        Read_and_Analyze with a coroutine scan. Journal, data file and progress events are the same as for the
+        synchronous scan, so a scan started here can be continued with Read_and_Analyze.resume and vice versa.
+
+        Parameters
+        ----------
+        Variables_instance : Variables
+        Async_Motor_instance : Async_Motor
+
+        Returns
+        -------
+        None.
+
+        """
+        super().__init__(Variables_instance, Async_Motor_instance.Mot)
+        self.Async_Mot = Async_Motor_instance
+
+    async def measure_columns(self, axis, journal_name):
+        """
+        Coroutine version of Read_and_Analyze.measure_columns (same steps). The post-processing of a column runs in a thread
+        while the axis moves to the next column.
+        """
+        await self.Async_Mot.run_steps(self.measure_columns_steps(axis, journal_name))
+
+    async def acquire_column(self, handle, V, settle, rows=None, samples=None, position=0.0, raw=None, output="DAC1"):
+        """
+        Measures one column at the current position (same steps as the synchronous scan, see Read_and_Analyze.acquire_column_steps):
+        steps through the plate voltages V[rows] and averages the current at each voltage. The first voltage is expected to be
+        set already (before the move). The scan cup and, if self.frontshield is set, the front shield are read.
+
+        Parameters
+        ----------
+        handle : int
+            LabJack handle
+        V : numpy.ndarray
+            plate voltages (LabJack output before the +3.188V offset)
+        settle : Settle_Model
+        rows : numpy.ndarray, optional
+            indices of the voltages to measure. The default is None (all).
+        samples : int, optional
+            samples per voltage. The default is None (self.samples).
+        position : float, optional
+            position of the column [mm], for the saturation error. The default is 0.0.
+        raw : numpy.ndarray, optional
+            (voltages, samples) array that is filled with the single samples as current [A]. The default is None.
+        output : str, optional
+            DAC of the plate voltage. The default is "DAC1".
+
+        Raises
+        ------
+        SaturationError
+            see Read_and_Analyze.check_saturation
+
+        Returns
+        -------
+        I_ : numpy.ndarray
+            averaged currents of the column
+        F_ : numpy.ndarray or None
+            averaged front shield currents of the column
+
+        """
+        ljm = self.ljm or Emittance_scanner.load_ljm()
+        rows = np.arange(len(V)) if rows is None else rows
+        channels = ["AIN0"] + ([self.frontshield] if self.frontshield else [])
+        return await self.Async_Mot.run_steps(self.acquire_column_steps(ljm, handle, V, rows, settle, samples or self.samples, channels,
+                                                                        self.frontshield_gain, position, raw, output))
+
+    async def get_current(self, axis):
+        """
+        Coroutine version of Read_and_Analyze.get_current.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+
+        Returns
+        -------
+        I : numpy.ndarray
+            current matrix
+        file_name : str
+            data file of the scan
+
+        """
+        journal_name = self.start_journal(axis)
+        await self.measure_columns(axis, journal_name)
+        return self.assemble(journal_name)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the ACR74C controller, to test the motion code and the controller scan program without hardware.
+
+    M = Emittance_scanner.Motor()
+    M.telnet = Emittance_controller.Controller_Stand_In #or functools.partial(Controller_Stand_In, speed=10)
+    M.response_delay = 0.001
+
+The stand-in answers the commands Motor sends (bits, positions, moves, drives, P variables, program prompts) the way the
+controller does: the command line is echoed, query results follow on their own lines and the prompt ends the response.
+Axes move with the velocity of the motion profile between their limit switches. Programs entered with PROGRAM ... ENDP
+run in a thread of their own after RUN, so the handshake of the scan program (Motor.scan_program) can be tested against
+a DAQ that sets the acknowledge flag.
+"""
+import random
+import re
+import threading
+import time
+
+
+class Controller_Stand_In:
+    def __init__(self, host="127.0.0.1", port=5002, timeout=None, speed=1.0, limit=32.0, factor=19685, masters=(0, 0, 0, 0), switch_noise=0.0):
+        """
+        Telnet-like object (write, read_very_eager, close) that emulates the controller. Can be used as Motor.telnet.
+
+        Parameters
+        ----------
+        host, port, timeout :
+            as for telnetlib.Telnet, only kept for Motor.fingerprint
+        speed : float, optional
+            time scale of moves and dwells, e.g. 10 runs them 10 times faster. The default is 1.0.
+        limit : float, optional
+            distance of the limit switches from the middle of the axis [mm]. The default is 32.0.
+        factor : int, optional
+            encoder steps/mm. The default is 19685.
+        masters : tuple, optional
+            master of every axis (see Motor.masters). The default is (0, 0, 0, 0).
+        switch_noise : float, optional
+            standard deviation of the position a limit switch trips at [mm]. The default is 0.0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.limit = limit
+        self.factor = factor
+        self.masters = masters
+        self.axis_names = ["X", "Y", "Z", "A"]
+        self.lock = threading.RLock()
+        self.output = ""
+        self.prog = 0 #prompt, None for SYS
+        self.bits = set() #set user and control flags
+        self.variables = {} #P variables
+        self.physical = [limit, limit, limit, limit] #position between the limit switches [mm], starts retracted
+        self.origin = [0.0, 0.0, 0.0, 0.0] #physical position of 0 (see RES)
+        self.drive = [False, False, False, False]
+        self.moves = [None, None, None, None] #running move of every axis
+        self.velocity = 15.0 #mm/s
+        self.stop_deceleration = 100.0 #mm/s^2 (STP), a move that hits a limit switch overtravels by v^2/(2 STP)
+        self.switch_noise = switch_noise
+        self.programs = {} #prog: program lines
+        self.entering = None #program lines while PROGRAM ... ENDP is entered
+        self.halts = {} #prog: threading.Event of the running program
+
+    def write(self, data):
+        line = data.decode('ascii').strip()
+        with self.lock:
+            answers = []
+            if self.entering is not None:
+                if line.upper() == "ENDP":
+                    self.programs[self.prog] = self.entering
+                    self.entering = None
+                else:
+                    self.entering.append(line)
+            else:
+                for statement in line.split(":"):
+                    answer = self.execute(statement.strip())
+                    if answer is not None:
+                        answers.append(answer)
+            prompt = "SYS>" if self.prog is None else f"P{self.prog:02d}>"
+            self.output += line + "\r\n" + "".join(answer + "\r\n" for answer in answers) + prompt
+
+    def read_very_eager(self):
+        with self.lock:
+            output, self.output = self.output, ""
+        return output.encode('ascii')
+
+    def close(self):
+        for halt in list(self.halts.values()):
+            halt.set()
+
+    def position(self, axis):
+        """Physical position of axis [mm]."""
+        self.update()
+        return self.physical[axis]
+
+    def update(self):
+        """
+        Advances the running moves to now. Moves end at their target, or at a limit switch; a limit switch stops all moves
+        of the master (the controller kills the coordinated move).
+        """
+        now = time.monotonic()
+        for master in set(self.masters):
+            axes = [axis for axis in range(4) if self.masters[axis] == master and self.moves[axis] is not None]
+            hits = [t for t in (self.limit_time(axis) for axis in axes) if t is not None and t <= now]
+            end = min(hits) if hits else now
+            for axis in axes:
+                move = self.moves[axis]
+                fraction = 1.0 if move["duration"] == 0 else min(1.0, (end - move["time"])/move["duration"])
+                self.physical[axis] = move["start"] + (move["end"] - move["start"])*fraction
+                hit = self.limit_time(axis)
+                if hit is not None and hit <= end: #stops behind the switch
+                    velocity = abs(move["end"] - move["start"])/max(move["duration"], 1e-12)/self.speed #real velocity, without the time scale
+                    switch = self.limit + move["switch"] + velocity**2/(2*self.stop_deceleration)
+                    self.physical[axis] = switch if move["end"] > 0 else -switch
+                if hits or fraction >= 1.0:
+                    self.moves[axis] = None
+
+    def limit_time(self, axis):
+        """Time the running move of axis reaches a limit switch, None if it ends before."""
+        move = self.moves[axis]
+        for limit in (self.limit + move["switch"], -self.limit - move["switch"]):
+            if (move["end"] - limit)*(limit/abs(limit)) > 0: #target beyond the limit switch
+                return move["time"] + move["duration"]*(limit - move["start"])/(move["end"] - move["start"])
+        return None
+
+    def bit(self, n):
+        for axis in range(4):
+            if n == 16128 + axis*32: #positive EOT limit
+                return self.position(axis) >= self.limit
+            if n == 16129 + axis*32: #negative EOT limit
+                return self.position(axis) <= -self.limit
+            if n == 8465 + axis*32: #drive enabled
+                return self.drive[axis]
+        for master in set(self.masters):
+            if n == 516 + 32*master: #in motion
+                return any(self.moving(axis) for axis in range(4) if self.masters[axis] == master)
+        return n in self.bits
+
+    def moving(self, axis):
+        self.update()
+        return self.moves[axis] is not None
+
+    def variable(self, n):
+        n = int(n)
+        if n >= 12288 and (n - 12288)%256 == 0 and (n - 12288)//256 < 4: #actual position [steps]
+            axis = (n - 12288)//256
+            return round((self.position(axis) - self.origin[axis])*self.factor)
+        return self.variables.get(n, 0.0)
+
+    def evaluate(self, expression, local=None):
+        """Value of an expression with numbers, LV and P variables, arithmetic and comparisons."""
+        expression = re.sub(r"LV(\d+)", lambda m: repr((local or {}).get(int(m.group(1)), 0.0)), expression)
+        while re.search(r"P\s*\(", expression):
+            expression = re.sub(r"P\s*\(([^()]*)\)", lambda m: repr(self.variable(self.evaluate(m.group(1)))), expression)
+        expression = re.sub(r"P(\d+)", lambda m: repr(self.variable(int(m.group(1)))), expression)
+        if not re.fullmatch(r"[\d\s.eE+\-*/()<>=!]*", expression):
+            raise ValueError(f"Cannot evaluate {expression}")
+        return eval(expression, {"__builtins__": {}}, {})
+
+    @staticmethod
+    def format(value):
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def move(self, targets):
+        """
+        Starts a coordinated move: all axes start and end together, the vector velocity is the VEL of the profile.
+
+        Parameters
+        ----------
+        targets : dict
+            axis: (target [mm], relative)
+        """
+        self.update()
+        axes = [axis for axis in targets if self.drive[axis] and 8467 + axis*32 not in self.bits] #not with the drive off or a kill all moves request
+        ends = {axis: (self.physical[axis] if targets[axis][1] else self.origin[axis]) + targets[axis][0] for axis in axes}
+        length = sum((ends[axis] - self.physical[axis])**2 for axis in axes)**0.5
+        now = time.monotonic()
+        for axis in axes:
+            self.moves[axis] = {"start": self.physical[axis], "end": ends[axis], "time": now, "duration": length/(self.velocity*self.speed),
+                                "switch": random.gauss(0.0, self.switch_noise) if self.switch_noise else 0.0} #trip point of the limit switch
+
+    def execute(self, statement, local=None):
+        """
+        Executes one command of a command line or program. Returns the answer of queries, None otherwise.
+        """
+        upper = statement.upper()
+        if not statement or upper.startswith("DIM"):
+            return None
+        m = re.fullmatch(r"\?\s*BIT\s*(.+)", statement, re.I)
+        if m:
+            return "1" if self.bit(int(self.evaluate(m.group(1), local))) else "0"
+        m = re.fullmatch(r"\?\s*P\s*(.+)", statement, re.I)
+        if m:
+            return self.format(self.variable(self.evaluate(m.group(1), local)))
+        m = re.fullmatch(r"(SET|CLR)\s+(?:BIT\s*)?(.+)", statement, re.I)
+        if m:
+            n = int(self.evaluate(m.group(2), local))
+            if m.group(1).upper() == "SET":
+                self.bits.add(n)
+                if n in [8467 + axis*32 for axis in range(4)]: #kill all moves request stops the axis where it is
+                    self.update()
+                    self.moves[(n - 8467)//32] = None
+            else:
+                self.bits.discard(n)
+            return None
+        m = re.fullmatch(r"P\s*(\(.+\)|\d+)\s*=\s*(.+)", statement, re.I)
+        if m:
+            self.variables[int(self.evaluate(m.group(1), local))] = self.evaluate(m.group(2), local)
+            return None
+        m = re.fullmatch(r"LV(\d+)\s*=\s*(.+)", statement, re.I)
+        if m:
+            local[int(m.group(1))] = self.evaluate(m.group(2), local)
+            return None
+        m = re.fullmatch(r"DRIVE\s+(ON|OFF)\s+(.+)", statement, re.I)
+        if m:
+            for name in m.group(2).split():
+                self.drive[self.axis_names.index(name.upper())] = m.group(1).upper() == "ON"
+            return None
+        if upper.startswith("ACC") or upper.startswith("VEL"):
+            m = re.search(r"VEL\s+([\d.eE+\-]+)", statement, re.I)
+            if m:
+                self.velocity = float(m.group(1))
+            m = re.search(r"STP\s+([\d.eE+\-]+)", statement, re.I)
+            if m:
+                self.stop_deceleration = float(m.group(1))
+            return None
+        m = re.fullmatch(r"RES\s+AXIS(\d)", statement, re.I)
+        if m:
+            axis = int(m.group(1))
+            self.origin[axis] = self.position(axis)
+            return None
+        m = re.fullmatch(r"PROG(\d+)", statement, re.I)
+        if m:
+            self.prog = int(m.group(1))
+            return None
+        if upper == "SYS":
+            self.prog = None
+        elif upper == "VER":
+            return "ACR74C stand-in"
+        elif upper == "NEW":
+            self.programs.pop(self.prog, None)
+        elif upper == "PROGRAM":
+            self.entering = []
+        elif upper == "RUN":
+            self.run(self.prog)
+        elif upper == "HALT":
+            if self.prog in self.halts:
+                self.halts[self.prog].set()
+        else:
+            axis_move = r"([XYZA])\s*(/?)\s*(\((?:[^()]|\([^()]*\))*\)|[\d.eE+\-]+)" #move, e.g. X10, X/10, X(P(101 + LV0)) or X200 Y200
+            if re.fullmatch(rf"(?:{axis_move}\s*)+", statement, re.I):
+                self.move({self.axis_names.index(name.upper()): (self.evaluate(target, local), bool(relative))
+                           for name, relative, target in re.findall(axis_move, statement, re.I)})
+        return None
+
+    def run(self, prog):
+        if prog in self.halts:
+            return
+        halt = threading.Event()
+        self.halts[prog] = halt
+        threading.Thread(target=self.run_program, args=(prog, halt), daemon=True).start()
+
+    def run_program(self, prog, halt):
+        """
+        Runs the lines of a program until its end or HALT: statements as on the prompt, plus labels (_NAME), GOTO NAME,
+        IF (condition) ... ENDIF, INH [-]bit (waits until the bit is set, or cleared with -) and DWL seconds.
+        """
+        lines = [line.strip() for line in self.programs.get(prog, [])]
+        labels = {line[1:].upper(): i for i, line in enumerate(lines) if line.startswith("_")}
+        local = {}
+        i = 0
+        try:
+            while i < len(lines) and not halt.is_set():
+                line = lines[i]
+                upper = line.upper()
+                i += 1
+                if line.startswith("_") or upper == "ENDIF":
+                    continue
+                if upper.startswith("GOTO"):
+                    i = labels[line.split()[1].upper()]
+                    continue
+                m = re.fullmatch(r"IF\s*\((.+)\)", line, re.I)
+                if m:
+                    with self.lock:
+                        condition = self.evaluate(m.group(1), local)
+                    depth = 0
+                    while not condition and i < len(lines): #skip to the matching ENDIF
+                        if re.match(r"IF\b", lines[i], re.I):
+                            depth += 1
+                        elif lines[i].upper() == "ENDIF":
+                            if depth == 0:
+                                break
+                            depth -= 1
+                        i += 1
+                    continue
+                m = re.fullmatch(r"INH\s+(-?)(\d+)", line, re.I)
+                if m:
+                    state = not m.group(1)
+                    while not halt.is_set():
+                        with self.lock:
+                            if self.bit(int(m.group(2))) == state:
+                                break
+                        time.sleep(0.001)
+                    continue
+                m = re.fullmatch(r"DWL\s+(.+)", line, re.I)
+                if m:
+                    halt.wait(float(m.group(1))/self.speed)
+                    continue
+                with self.lock:
+                    self.execute(line, local)
+        finally:
+            with self.lock:
+                self.halts.pop(prog, None)
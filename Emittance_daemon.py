@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition daemon: the controller link, the LabJack and the scan loop run in a process of their own, so plotting and
+GUI load cannot delay the hardware I/O.
+
+    python Emittance_daemon.py [--port 8051] [--live emittance_scanner_live] [--monitor host:port] [--metrics file]
+
+Clients talk to the daemon over a local TCP socket with one json object per line:
+    request     {"id": 1, "method": "call", "name": "move_to", "args": [10.0, 0]}
+    response    {"id": 1, "result": ...} or {"id": 1, "error": {"type": "FatalError", "message": "..."}}
+Methods:
+    call        Motor method (MOTOR_METHODS)
+    get / set   Motor attribute (MOTOR_ATTRIBUTES)
+    start       starts a job in the daemon: "scans", "auto_gain", "resume" or "queue" (see Scan_Daemon.run_job), returns its id
+    status      state, result and progress of a job
+    abort       stops the running job before its next column (the journal is kept, the scan can be resumed) or the queue after its current job
+    metrics     Motor.metrics.summary() of the controller link
+Remote_Motor is a client with the methods and attributes of Motor, e.g. for the GUI (Emittance_GUI_NEW.py --daemon).
+
+The live data of the running scan (progress, position and momentum arrays, partial current matrix) is published in a
+shared memory block. Any number of clients can map it (Live_View) and read the current matrix as a numpy array without
+copying; a sequence number (odd while the daemon writes) tells readers whether their view is consistent.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory
+import Emittance_scanner
+
+MOTOR_METHODS = {"send_command", "send_batch", "move_to", "relative_move", "move_out", "move_multiple", "move_out_multiple", "centering", "check_FC", "axis_clear",
+                 "current_position", "predicted_position", "stop", "in_motion_bit", "save_state", "check_unit"}
+MOTOR_ATTRIBUTES = {"beam_line", "centered", "Voltagecurrentfactor", "frontshield_gain", "mid_point_offsets", "targets",
+                    "factor", "unit", "masters", "motion_profile", "axis_names"}
+ERRORS = {"FatalError": Emittance_scanner.FatalError, "SaturationError": Emittance_scanner.SaturationError,
+          "TimeoutError": TimeoutError, "ValueError": ValueError, "KeyError": KeyError}
+
+
+class Remote_Error(Exception): #error in the daemon without a local equivalent (see ERRORS)
+    pass
+
+
+def to_json(value):
+    """json.dumps default for numpy values."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not json serializable")
+
+
+class Live_Buffer:
+    HEADER = struct.Struct("<Qiiiiiidddd") #seq, axis, column, columns, rows, cols, pad, ETA, E_rms, position, time
+
+    def __init__(self, name="emittance_scanner_live", max_rows=512, max_cols=512, create=True):
+        """
+        Shared memory block with the live data of the running scan:
+            header      sequence number, axis, column, columns, rows and columns of the matrix, ETA [s], running E_rms [m rad], position [mm], time
+            current     partial current matrix [A] (rows x cols of max_rows x max_cols used)
+            position    position array [mm] (cols used)
+            momentum    momentum array [mrad] (rows used)
+        The daemon creates it (create=True), clients attach to it by name (see Live_View).
+
+        Parameters
+        ----------
+        name : str, optional
+            The default is "emittance_scanner_live".
+        max_rows, max_cols : int, optional
+            largest momentum and position arrays. The default is 512.
+        create : bool, optional
+            The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.name = name
+        if create:
+            size = self.HEADER.size + 8*(max_rows*max_cols + max_rows + max_cols + 2)
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError: #left over from a daemon that was killed (the daemon only creates the block once it has bound its port)
+                old = shared_memory.SharedMemory(name)
+                old.close()
+                old.unlink()
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            struct.pack_into("<ii", self.shm.buf, self.HEADER.size, max_rows, max_cols)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name, track=False) #Python >= 3.13; the block belongs to the daemon
+            except TypeError:
+                self.shm = shared_memory.SharedMemory(name)
+                try: #older versions would remove the block when the client exits
+                    from multiprocessing import resource_tracker
+                    resource_tracker.unregister(self.shm._name, "shared_memory")
+                except Exception:
+                    pass
+        self.max_rows, self.max_cols = struct.unpack_from("<ii", self.shm.buf, self.HEADER.size)
+        offset = self.HEADER.size + 8
+        self.data = np.ndarray(self.max_rows*self.max_cols + self.max_rows + self.max_cols, dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)
+
+    def update(self, event, position=None, momentum=None):
+        """
+        Writes a progress event (see Read_and_Analyze.publish) and the scan grid. Readers see an odd sequence number while it is written.
+        """
+        I = np.asarray(event["current"], dtype=float)
+        rows, cols = I.shape
+        if rows > self.max_rows or cols > self.max_cols:
+            return #scan grid larger than the buffer, only the status is available (Scan_Daemon.status)
+        E_rms = event.get("E_rms")
+        with self.lock:
+            seq = self.header()[0]
+            struct.pack_into("<Q", self.shm.buf, 0, seq + 1)
+            self.data[:rows*cols] = I.ravel()
+            if position is not None:
+                self.data[self.max_rows*self.max_cols:self.max_rows*self.max_cols + cols] = position
+            if momentum is not None:
+                self.data[self.max_rows*self.max_cols + self.max_cols:self.max_rows*self.max_cols + self.max_cols + rows] = momentum
+            self.HEADER.pack_into(self.shm.buf, 0, seq + 2, event["axis"], event["column"], event["columns"], rows, cols, 0,
+                                  event.get("ETA") or 0.0, np.nan if E_rms is None else E_rms, event.get("position", np.nan), event.get("time", time.time()))
+
+    def close(self, unlink=False):
+        self.data = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class Live_View(Live_Buffer):
+    def __init__(self, name="emittance_scanner_live"):
+        """
+        Client side of the live buffer. current(), position() and momentum() are views into the shared memory (no copy);
+        snapshot() returns a consistent copy.
+        """
+        super().__init__(name, create=False)
+
+    def seq(self):
+        return self.header()[0]
+
+    def current(self):
+        seq, axis, column, columns, rows, cols = self.header()[:6]
+        return self.data[:rows*cols].reshape(rows, cols)
+
+    def position(self):
+        cols = self.header()[5]
+        return self.data[self.max_rows*self.max_cols:self.max_rows*self.max_cols + cols]
+
+    def momentum(self):
+        rows = self.header()[4]
+        start = self.max_rows*self.max_cols + self.max_cols
+        return self.data[start:start + rows]
+
+    def snapshot(self, timeout=1.0):
+        """
+        Returns
+        -------
+        snapshot : dict
+            seq, axis, column, columns, ETA, E_rms, position (of the axis), time, current, position_array, momentum_array (copies)
+        """
+        end = time.time() + timeout
+        while True:
+            seq, axis, column, columns, rows, cols, pad, ETA, E_rms, position, t = self.header()
+            snapshot = {"seq": seq, "axis": axis, "column": column, "columns": columns, "ETA": ETA, "E_rms": E_rms,
+                        "position": position, "time": t, "current": self.current().copy(),
+                        "position_array": self.position().copy(), "momentum_array": self.momentum().copy()}
+            if seq%2 == 0 and self.seq() == seq or time.time() > end:
+                return snapshot
+            time.sleep(0.001)
+
+
+class Scan_Daemon:
+    def __init__(self, host="127.0.0.1", port=8051, live="emittance_scanner_live", Motor_instance=None):
+        """
+        Owns the Motor (and through the jobs the LabJack) and serves the socket interface described in the module docstring.
+
+        Parameters
+        ----------
+        host : str, optional
+            The default is "127.0.0.1" (local clients only).
+        port : int, optional
+            The default is 8051.
+        live : str, optional
+            name of the live buffer, None for none. The default is "emittance_scanner_live".
+        Motor_instance : Emittance_scanner.Motor, optional
+            The default is a new Motor.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.server = socketserver.ThreadingTCPServer((host, port), self.handler(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True #restart right after a crash
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError: #e.g. another daemon is running, its live buffer must not be touched
+            self.server.server_close()
+            raise
+        self.Mot = Emittance_scanner.Motor() if Motor_instance is None else Motor_instance
+        self.live = None if live is None else Live_Buffer(live) #after the bind: a block that still exists is left over from a killed daemon
+        self.jobs = {} #id: job
+        self.job = None #running job
+        self.lock = threading.Lock()
+        self.grid = (None, None) #position and momentum arrays of the running scan, for the live buffer
+        Emittance_scanner.Read_and_Analyze.listeners.append(self.progress_event)
+
+    def handler(self):
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                Emittance_scanner.Command_Metrics.select_role("gui") #client requests are status polls and manual moves
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        continue
+                    response = {"id": request.get("id")}
+                    try:
+                        response["result"] = daemon.dispatch(request)
+                    except Exception as e:
+                        response["error"] = {"type": type(e).__name__, "message": str(e)}
+                    self.wfile.write(json.dumps(response, default=to_json).encode('utf-8') + b"\n")
+                    self.wfile.flush()
+        return Handler
+
+    def dispatch(self, request):
+        method = request.get("method")
+        name = request.get("name")
+        if method == "call":
+            if name not in MOTOR_METHODS:
+                raise ValueError(f"Motor.{name} cannot be called remotely")
+            return getattr(self.Mot, name)(*request.get("args", []), **request.get("kwargs", {}))
+        if method == "get":
+            if name not in MOTOR_ATTRIBUTES:
+                raise ValueError(f"Motor.{name} cannot be read remotely")
+            return getattr(self.Mot, name)
+        if method == "set":
+            if name not in MOTOR_ATTRIBUTES:
+                raise ValueError(f"Motor.{name} cannot be set remotely")
+            setattr(self.Mot, name, request["value"])
+            return None
+        if method == "start":
+            return self.start(request["kind"], request.get("params", {}))
+        if method == "status":
+            return self.status(request.get("job"))
+        if method == "abort":
+            if self.job is not None:
+                self.job["stop"].set()
+            return None
+        if method == "metrics":
+            return self.Mot.metrics.summary()
+        if method == "ping":
+            return "pong"
+        raise ValueError(f"Unknown method {method}")
+
+    def start(self, kind, params):
+        """
+        Starts a job in a thread of its own. Only one job runs at a time.
+
+        Returns
+        -------
+        job_id : int
+        """
+        with self.lock:
+            if self.job is not None:
+                raise Emittance_scanner.FatalError(f"Job {self.job['id']} ({self.job['kind']}) is still running")
+            job = {"id": len(self.jobs) + 1, "kind": kind, "params": params, "state": "running", "result": None, "error": None,
+                   "progress": None, "stop": threading.Event(), "start": time.time()}
+            self.jobs[job["id"]] = job
+            self.job = job
+        threading.Thread(target=self.run_job, args=(job,), daemon=True).start()
+        return job["id"]
+
+    def status(self, job_id=None):
+        """
+        Returns
+        -------
+        status : dict
+            of job_id (default: the running or last job): id, kind, state ("running", "done", "failed", "aborted"), result, error, progress;
+            plus the name of the live buffer. Empty if there was no job.
+        """
+        job = self.jobs.get(job_id) if job_id is not None else (self.job or (self.jobs[len(self.jobs)] if self.jobs else None))
+        status = {} if job is None else {key: job[key] for key in ("id", "kind", "state", "result", "error", "progress")}
+        status["live"] = None if self.live is None else self.live.name
+        return status
+
+    def variables(self, params):
+        V = Emittance_scanner.Variables()
+        for name, value in params.get("variables", {}).items():
+            setattr(V, name, value)
+        return V
+
+    def analyzer(self, params):
+        RnA = Emittance_scanner.Read_and_Analyze(self.variables(params), self.Mot)
+        RnA.stop_event = self.job["stop"]
+        for name in ("device", "Voltagecurrentfactor", "frontshield_gain", "samples", "sampling", "waveform", "controller_program"):
+            if name in params:
+                setattr(RnA, name, params[name])
+        return RnA
+
+    def run_job(self, job):
+        """
+        Runs a job:
+            scans       params: variables (Variables attributes), axis, scans, and Read_and_Analyze settings (device, Voltagecurrentfactor,
+                        frontshield_gain, samples, sampling, waveform, controller_program). Centers the axis, runs the scans (plus the combined result of
+                        repeated scans) and retracts the axis. Result: [[file, E_rms, alpha, beta, gamma], ...] as in the GUI.
+                        Files are returned with their absolute path, the daemon may run in another directory than the client.
+            auto_gain   params: variables, axis. Result: see Read_and_Analyze.recommend_gain
+            resume      params: journal. Result: data file
+            queue       params: file_name (default: the queue file of the working directory). Runs the scan queue.
+        """
+        params = job["params"]
+        axis = params.get("axis")
+        Emittance_scanner.Command_Metrics.select_role("scan")
+        try:
+            if job["kind"] == "scans":
+                RnA = self.analyzer(params)
+                self.grid = ([RnA.x, RnA.y][axis%2], [RnA.x_prime, RnA.y_prime][axis%2])
+                self.Mot.centering(axis)
+                results = []
+                try:
+                    for i in range(int(params.get("scans", 1))):
+                        I, filename = RnA.get_current(axis)
+                        results.append([os.path.abspath(filename), *RnA.emittance(axis, I)])
+                    if len(results) > 1:
+                        stats = Emittance_scanner.Scan_Statistics.from_files([result[0] for result in results])
+                        intervals = stats.bootstrap()
+                        results.append([os.path.abspath(stats.write_and_save_file(intervals)), *[intervals[name][0] for name in ["E_rms", "alpha", "beta", "gamma"]]])
+                finally:
+                    self.Mot.move_out(axis)
+                job["result"] = results
+            elif job["kind"] == "auto_gain":
+                RnA = self.analyzer(params)
+                self.Mot.centering(axis)
+                try:
+                    job["result"] = RnA.auto_gain(axis)
+                finally:
+                    self.Mot.move_out(axis)
+            elif job["kind"] == "resume":
+                header, columns = Emittance_scanner.Read_and_Analyze.read_journal(params["journal"])
+                axis = header["axis"]
+                self.grid = (np.array(header["position"]), np.array(header["momentum"]))
+                try:
+                    I, filename = Emittance_scanner.Read_and_Analyze.resume(params["journal"], self.Mot, job["stop"])
+                finally:
+                    self.Mot.move_out(axis)
+                job["result"] = os.path.abspath(filename)
+            elif job["kind"] == "queue":
+                Emittance_scanner.Scan_Queue(**({"file_name": params["file_name"]} if "file_name" in params else {})).run(self.Mot, stop_event=job["stop"])
+            else:
+                raise ValueError(f"Unknown job {job['kind']}")
+            job["state"] = "done"
+        except Exception as e:
+            job["state"] = "aborted" if job["stop"].is_set() else "failed"
+            job["error"] = {"type": type(e).__name__, "message": str(e)}
+        finally:
+            self.grid = (None, None)
+            with self.lock:
+                self.job = None
+
+    def progress_event(self, event):
+        """
+        Read_and_Analyze listener: keeps the progress of the running job and writes the live buffer.
+        """
+        job = self.job
+        if job is not None:
+            job["progress"] = {key: value for key, value in event.items() if key != "current"}
+        if self.live is not None:
+            self.live.update(event, *self.grid)
+
+    def serve_forever(self):
+        host, port = self.server.server_address[:2]
+        print(f"Emittance scanner daemon listening on {host}:{port}" + ("" if self.live is None else f", live data in shared memory '{self.live.name}'"))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.live is not None:
+                self.live.close(unlink=True)
+
+
+class Remote_Metrics:
+    def __init__(self, client):
+        self.client = client
+
+    def summary(self):
+        return self.client.request("metrics")
+
+
+class Remote_Motor:
+    remote = True #the GUI runs scans as daemon jobs
+
+    def __init__(self, host="127.0.0.1", port=8051, timeout=None):
+        """
+        Client of a Scan_Daemon with the interface of Motor: the methods in MOTOR_METHODS are called in the daemon,
+        the attributes in MOTOR_ATTRIBUTES are read and set in the daemon. Thread safe (one request at a time).
+
+        Parameters
+        ----------
+        host : str, optional
+            The default is "127.0.0.1".
+        port : int, optional
+            The default is 8051.
+        timeout : float, optional
+            socket timeout [s]. The default is None (moves and centering can take minutes).
+
+        Returns
+        -------
+        None.
+
+        """
+        local = self.__dict__
+        local["address"] = (host, port)
+        local["sock"] = socket.create_connection((host, port), timeout=timeout)
+        local["reader"] = self.sock.makefile('rb')
+        local["lock"] = threading.Lock()
+        local["next_id"] = 0
+        local["planner"] = Emittance_scanner.Motion_Planner() #same defaults as the daemon's planner, for time estimates
+        local["metrics"] = Remote_Metrics(self)
+
+    def request(self, method, **params):
+        """
+        Sends one request and waits for its response.
+
+        Raises
+        ------
+        FatalError, SaturationError, TimeoutError, ValueError, KeyError
+            errors of the daemon with a local equivalent
+        Remote_Error
+            all other errors of the daemon
+
+        """
+        with self.lock:
+            self.__dict__["next_id"] += 1
+            request = dict(params, id=self.next_id, method=method)
+            self.sock.sendall(json.dumps(request, default=to_json).encode('utf-8') + b"\n")
+            line = self.reader.readline()
+        if not line:
+            raise ConnectionError("The daemon closed the connection")
+        response = json.loads(line)
+        if response.get("error"):
+            error = response["error"]
+            raise ERRORS.get(error["type"], Remote_Error)(error["message"])
+        return response.get("result")
+
+    def __getattr__(self, name):
+        if name in MOTOR_ATTRIBUTES:
+            return self.request("get", name=name)
+        if name in MOTOR_METHODS:
+            return lambda *args, **kwargs: self.request("call", name=name, args=list(args), kwargs=kwargs)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in MOTOR_ATTRIBUTES:
+            self.request("set", name=name, value=value)
+        else:
+            self.__dict__[name] = value
+
+    def start_job(self, kind, **params):
+        """Starts a daemon job (see Scan_Daemon.run_job) and returns its id."""
+        return self.request("start", kind=kind, params=params)
+
+    def job_status(self, job_id=None):
+        return self.request("status", job=job_id)
+
+    def abort_job(self):
+        self.request("abort")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emittance scanner acquisition daemon")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8051)
+    parser.add_argument("--live", default="emittance_scanner_live", help="name of the shared memory block with the live scan data")
+    parser.add_argument("--monitor", help="host:port of the scan progress web page (Emittance_monitor)")
+    parser.add_argument("--metrics", help="file for the controller link metrics in the Prometheus text format")
+    args = parser.parse_args()
+    if args.monitor:
+        import Emittance_monitor
+        host, port = (args.monitor.split(":") + ["8050"])[:2]
+        Emittance_monitor.Monitor_Server(host, int(port)).start()
+    daemon = Scan_Daemon(args.host, args.port, args.live)
+    if args.metrics:
+        daemon.Mot.metrics.start_export(args.metrics)
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Optional monitoring server for running emittance scans.
+
+Serves the progress of the scans of the current process over HTTP:
+    /           minimal page that renders the progress
+    /snapshot   latest state as json
+    /events     server-sent events, one json message per update
+
+All clients read the same in-memory snapshot, which is only updated by the scan itself (Read_and_Analyze.publish),
+so the number of viewers has no effect on the controller or the LabJack.
+
+Usage:
+    import Emittance_monitor
+    server = Emittance_monitor.Monitor_Server(host="0.0.0.0", port=8050) #"127.0.0.1" for localhost only
+    server.start()
+"""
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import Emittance_scanner
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Emittance Scan Monitor</title>
+<style>body{font-family:Helvetica,sans-serif;margin:20px} .scan{display:inline-block;margin:10px;vertical-align:top} canvas{border:1px solid black;image-rendering:pixelated;width:420px;height:360px}</style>
+</head><body>
+<h2>Emittance Scan Monitor</h2>
+<div id="scans">Waiting for scan data...</div>
+<script>
+const names = ["X - VENUS", "Y - VENUS", "X - AECR", "Y - AECR"];
+function draw(canvas, I) {
+    const m = I.length, n = I[0].length;
+    canvas.width = n; canvas.height = m;
+    const ctx = canvas.getContext("2d"), img = ctx.createImageData(n, m);
+    const max = Math.max(...I.flat()) || 1;
+    for (let r = 0; r < m; r++) for (let c = 0; c < n; c++) {
+        const v = I[r][c]/max, k = 4*((m-1-r)*n + c); //origin lower
+        img.data[k] = 255*Math.min(1, 2*v); img.data[k+1] = 255*Math.max(0, 2*v-1); img.data[k+2] = 80*(1-v); img.data[k+3] = 255;
+    }
+    ctx.putImageData(img, 0, 0);
+}
+function render(snapshot) {
+    const div = document.getElementById("scans");
+    div.innerHTML = "";
+    for (const [axis, s] of Object.entries(snapshot.scans)) {
+        const box = document.createElement("div"); box.className = "scan";
+        const eta = s.ETA == null ? "-" : (s.ETA/60).toFixed(1) + " min";
+        const eps = s.E_rms == null ? "-" : (4*s.E_rms*1e6).toFixed(4) + " mm mrad";
+        box.innerHTML = "<h3>" + names[axis] + "</h3>" +
+            "Column: " + (s.column+1) + " / " + s.columns + "<br>Position: " + s.position.toFixed(3) + " mm<br>ETA: " + eta +
+            "<br>Epsilon (running): " + eps + "<br>Drive: " + (s.drive ? "on" : "off") + ", Fault: " + (s.fault ? "YES" : "no") + "<br>";
+        const canvas = document.createElement("canvas"); box.appendChild(canvas); div.appendChild(box);
+        draw(canvas, s.current);
+    }
+}
+fetch("snapshot").then(r => r.json()).then(render);
+new EventSource("events").onmessage = e => render(JSON.parse(e.data));
+</script></body></html>"""
+
+
+class Scan_Snapshot:
+    def __init__(self):
+        """
+        Latest progress of every scan, by axis. update() is registered as a Read_and_Analyze listener,
+        the server threads wait on self.condition for new versions.
+        """
+        self.condition = threading.Condition()
+        self.version = 0
+        self.scans = {} #axis: latest event
+        self.message = json.dumps({"version": 0, "scans": {}})
+
+    def update(self, event):
+        """
+        Stores a progress event and wakes up all waiting clients. The json message is built once per update, not per client.
+        """
+        with self.condition:
+            self.scans[event["axis"]] = event
+            self.version += 1
+            self.message = json.dumps({"version": self.version, "scans": self.scans})
+            self.condition.notify_all()
+
+    def wait(self, version, timeout=15):
+        """
+        Waits until there is a version newer than the given one (or until timeout).
+
+        Returns
+        -------
+        version : int
+        message : str
+            json of the snapshot
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version, self.message
+
+
+class Monitor_Server:
+    def __init__(self, host="127.0.0.1", port=8050, snapshot=None):
+        """
+        HTTP server for the scan progress. Runs in a daemon thread inside the scan process.
+
+        Parameters
+        ----------
+        host : str, optional
+            "127.0.0.1" (localhost only) or "0.0.0.0" (LAN). The default is "127.0.0.1".
+        port : int, optional
+            The default is 8050.
+        snapshot : Scan_Snapshot, optional
+            If None, a new snapshot is created and registered as listener of all Read_and_Analyze scans.
+
+        Returns
+        -------
+        None.
+
+        """
+        if snapshot is None:
+            snapshot = Scan_Snapshot()
+            Emittance_scanner.Read_and_Analyze.status_listeners.append(snapshot.update) #the page shows the drive and fault bits
+        self.snapshot = snapshot
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def handler(self):
+        snapshot = self.snapshot
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args): #no log line per request
+                pass
+
+            def send(self, body, content_type):
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/":
+                    self.send(PAGE, "text/html; charset=utf-8")
+                elif self.path == "/snapshot":
+                    self.send(snapshot.message, "application/json")
+                elif self.path == "/events":
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    version = snapshot.version
+                    try:
+                        while True:
+                            new_version, message = snapshot.wait(version)
+                            if new_version == version: #keep the connection alive
+                                self.wfile.write(b": keep-alive\n\n")
+                            else:
+                                self.wfile.write(b"data: " + message.encode('utf-8') + b"\n\n")
+                                version = new_version
+                            self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError): #client closed the page
+                        return
+                else:
+                    self.send_error(404)
+        return Handler
+
+    def start(self):
+        """Starts serving in a daemon thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        print(f"Scan monitor running on http://{host}:{port}/")
+
+    def stop(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Recording and replay of the hardware I/O of a session: every exchange with the ACR74C controller (telnet writes and reads)
+and every LabJack (LJM) call, with timestamps and results.
+
+Recording (on the lab computer):
+    import Emittance_replay
+    trace = Emittance_replay.record("scan.trace.gz", Motor_instance, RnA) #before the first command, RnA optional
+    RnA.get_current(0)
+    trace.close()
+
+Replay (anywhere, no hardware or libraries needed):
+    session = Emittance_replay.Replay_Session("scan.trace.gz", speed=None) #None: as fast as possible, 1.0: recorded speed
+    M = session.motor()
+    RnA = session.analyzer(Variables_instance, M) #same Variables and settings (device, gain, samples, ...) as the recorded scan
+    I, file_name = RnA.get_current(0)
+
+Trace file: 8 bytes magic, then one record per event: kind (uint8), time since the start of the recording (float64, s),
+payload length (uint32) and payload. Telnet payloads are the raw bytes, LJM payloads are [function, arguments, result]
+in a small tagged binary encoding (numbers as float64/int64, strings interned in a string table). Files ending with
+".gz" are gzip compressed (the samples of a scan compress well).
+
+The replay matches every write and LJM call to the recorded event with the same command/arguments that is closest after
+the last match (within a few events, so that threads that were interleaved differently, e.g. progress queries of the worker
+thread, still find their responses). A call that is not in the trace raises ReplayError.
+"""
+import gzip
+import struct
+import threading
+import time
+import Emittance_scanner
+
+MAGIC = b"ECRTRC01"
+HEADER = struct.Struct("<BdI") #kind, time [s], payload length
+OPEN, WRITE, READ, CALL, ERROR, STRING = 1, 2, 3, 4, 5, 6 #record kinds
+
+
+class ReplayError(Exception): #the replayed code does something that is not in the trace
+    pass
+
+
+class Trace_Writer:
+    def __init__(self, file_name):
+        """
+        Appends records to a new trace file. Thread safe.
+
+        Parameters
+        ----------
+        file_name : str
+            ".gz" for a compressed trace
+
+        Returns
+        -------
+        None.
+
+        """
+        self.file_name = file_name
+        self.f = gzip.open(file_name, 'wb', compresslevel=1) if file_name.endswith(".gz") else open(file_name, 'wb')
+        self.f.write(MAGIC)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.strings = {} #string: index in the string table
+
+    def write(self, kind, payload):
+        with self.lock:
+            self.f.write(HEADER.pack(kind, time.perf_counter() - self.start, len(payload)) + payload)
+
+    def call(self, kind, value):
+        """Writes an LJM record, value is encoded with encode (new strings are written to the string table first)."""
+        with self.lock:
+            payload = encode(value, self)
+            self.f.write(HEADER.pack(kind, time.perf_counter() - self.start, len(payload)) + payload)
+
+    def intern(self, string):
+        """Index of string in the string table. Has to be called while holding self.lock."""
+        if string not in self.strings:
+            self.strings[string] = len(self.strings)
+            data = string.encode('utf-8')
+            self.f.write(HEADER.pack(STRING, time.perf_counter() - self.start, len(data)) + data)
+        return self.strings[string]
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def encode(value, writer):
+    """
+    Tagged binary encoding of None, bool, int, float, str (string table of writer), bytes and lists/tuples of them.
+    """
+    if value is None:
+        return b"n"
+    if isinstance(value, bool):
+        return b"t" if value else b"f"
+    if isinstance(value, int):
+        return b"i" + struct.pack("<q", value)
+    if isinstance(value, float):
+        return b"d" + struct.pack("<d", value)
+    if isinstance(value, str):
+        return b"s" + struct.pack("<I", writer.intern(value))
+    if isinstance(value, bytes):
+        return b"b" + struct.pack("<I", len(value)) + value
+    if isinstance(value, (list, tuple)):
+        return b"l" + struct.pack("<I", len(value)) + b"".join(encode(v, writer) for v in value)
+    try: #numpy scalars
+        return encode(value.item(), writer)
+    except AttributeError:
+        return encode(repr(value), writer)
+
+
+def decode(data, strings, offset=0):
+    """
+    Inverse of encode.
+
+    Returns
+    -------
+    value
+    offset : int
+        position after the value
+    """
+    tag = data[offset:offset+1]
+    offset += 1
+    if tag == b"n":
+        return None, offset
+    if tag in (b"t", b"f"):
+        return tag == b"t", offset
+    if tag == b"i":
+        return struct.unpack_from("<q", data, offset)[0], offset + 8
+    if tag == b"d":
+        return struct.unpack_from("<d", data, offset)[0], offset + 8
+    if tag == b"s":
+        return strings[struct.unpack_from("<I", data, offset)[0]], offset + 4
+    if tag == b"b":
+        n = struct.unpack_from("<I", data, offset)[0]
+        return data[offset+4:offset+4+n], offset + 4 + n
+    if tag == b"l":
+        n = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        values = []
+        for i in range(n):
+            value, offset = decode(data, strings, offset)
+            values.append(value)
+        return values, offset
+    raise ValueError(f"Unknown tag {tag!r} in trace")
+
+
+def read_trace(file_name):
+    """
+    Reads a trace file.
+
+    Returns
+    -------
+    exchanges : list
+        (time of the write, command, time of the response, response) of every telnet write, in order
+    calls : list
+        (time, function, arguments, result, error) of every LJM call, in order. error is None or the message of the exception
+    address : tuple
+        (host, port) of the recorded controller connection, ("", "") if the trace has none
+    """
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(file_name, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{file_name} is not a trace file")
+    offset = len(MAGIC)
+    strings = []
+    exchanges = []
+    calls = []
+    address = None
+    while offset + HEADER.size <= len(data):
+        kind, t, n = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        payload = data[offset:offset+n]
+        offset += n
+        if kind == STRING:
+            strings.append(payload.decode('utf-8'))
+        elif kind == OPEN:
+            if address is None: #first connection of the session
+                host, _, port = payload.decode('ascii').rpartition(":")
+                address = (host, int(port) if port.isdigit() else port)
+        elif kind == WRITE:
+            exchanges.append([t, payload, t, b""])
+        elif kind == READ:
+            if exchanges:
+                exchanges[-1][2:] = [t, exchanges[-1][3] + payload] #responses are read right after their write (under Motor.lock)
+        elif kind in (CALL, ERROR):
+            function, args, result = decode(payload, strings)[0]
+            calls.append((t, function, args, None if kind == ERROR else result, result if kind == ERROR else None))
+    return [tuple(e) for e in exchanges], calls, address or ("", "")
+
+
+class Recording_Telnet:
+    def __init__(self, tn, writer):
+        """
+        Telnet connection that writes every write and read to the trace.
+
+        Parameters
+        ----------
+        tn : telnetlib.Telnet
+            open connection
+        writer : Trace_Writer
+        """
+        self.tn = tn
+        self.writer = writer
+        self.writer.write(OPEN, f"{getattr(tn, 'host', '')}:{getattr(tn, 'port', '')}".encode('ascii'))
+
+    def write(self, buffer):
+        self.writer.write(WRITE, buffer)
+        self.tn.write(buffer)
+
+    def read_very_eager(self):
+        response = self.tn.read_very_eager()
+        self.writer.write(READ, response)
+        return response
+
+    def close(self):
+        self.tn.close()
+
+    def __getattr__(self, name):
+        return getattr(self.tn, name)
+
+
+class Recording_LJM:
+    def __init__(self, ljm, writer):
+        """
+        LJM library that writes every function call (arguments and result or exception) to the trace.
+
+        Parameters
+        ----------
+        ljm : module
+            labjack.ljm (or an object with the same functions)
+        writer : Trace_Writer
+        """
+        self.ljm = ljm
+        self.writer = writer
+
+    def __getattr__(self, name):
+        function = getattr(self.ljm, name)
+        if not callable(function):
+            return function
+        def call(*args):
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.writer.call(ERROR, [name, list(args), f"{type(e).__name__}: {e}"])
+                raise
+            self.writer.call(CALL, [name, list(args), result])
+            return result
+        return call
+
+
+def record(file_name, Motor_instance, Read_and_Analyze_instance=None):
+    """
+    Starts recording the controller link of Motor_instance and the LabJack calls of Read_and_Analyze_instance.
+    If the Motor is already connected, the recording starts with its next command.
+
+    Parameters
+    ----------
+    file_name : str
+        trace file, ".gz" for a compressed trace
+    Motor_instance : Emittance_scanner.Motor
+    Read_and_Analyze_instance : Emittance_scanner.Read_and_Analyze, optional
+        The default is None (controller only).
+
+    Returns
+    -------
+    writer : Trace_Writer
+        close it at the end of the recording
+
+    """
+    writer = Trace_Writer(file_name)
+    M = Motor_instance
+    with M.lock:
+        if M.tn:
+            M.tn = Recording_Telnet(M.tn, writer)
+        else:
+            if M.telnet is None:
+                import telnetlib
+                M.telnet = telnetlib.Telnet
+            telnet = M.telnet
+            M.telnet = lambda *args, **kwargs: Recording_Telnet(telnet(*args, **kwargs), writer)
+    if Read_and_Analyze_instance is not None:
+        RnA = Read_and_Analyze_instance
+        RnA.ljm = Recording_LJM(RnA.ljm or Emittance_scanner.load_ljm(), writer)
+    return writer
+
+
+class Replay_Clock:
+    def __init__(self, speed=None):
+        """
+        Paces the replay: with speed, an event is not returned before its recorded time (divided by speed) since the
+        start of the replay; with None, everything is returned right away.
+        """
+        self.speed = speed
+        self.start = time.perf_counter()
+
+    def wait(self, t):
+        if self.speed:
+            delay = t/self.speed - (time.perf_counter() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class Replay_Events:
+    def __init__(self, events, key, lookahead=50):
+        """
+        Recorded events that are consumed in order. take(match) returns the unconsumed event closest after the last
+        consumed one (within lookahead events before or after it) for which key(event) == match. Events that are never
+        asked for (e.g. a query the recorded session made and the replayed one does not) are skipped.
+        """
+        self.events = events
+        self.key = key
+        self.lookahead = lookahead
+        self.used = [False]*len(events)
+        self.cursor = 0 #after the last consumed event
+        self.lock = threading.Lock()
+
+    def take(self, match, what):
+        with self.lock:
+            after = range(self.cursor, min(len(self.events), self.cursor + self.lookahead))
+            before = range(self.cursor - 1, max(-1, self.cursor - 1 - self.lookahead), -1)
+            for i in list(after) + list(before):
+                if not self.used[i] and self.key(self.events[i]) == match:
+                    self.used[i] = True
+                    self.cursor = max(self.cursor, i + 1)
+                    return self.events[i]
+            expected = self.key(self.events[self.cursor]) if self.cursor < len(self.events) else "end of the trace"
+            raise ReplayError(f"{what} {match!r} is not in the trace (next recorded: {expected!r})")
+
+    def remaining(self):
+        return self.used.count(False)
+
+
+class Replay_Telnet:
+    def __init__(self, exchanges, clock, host="", port=""):
+        """
+        Telnet connection that answers every write with the recorded response of the same command. host and port are
+        those of the recorded connection (Motor.fingerprint).
+        """
+        self.exchanges = exchanges
+        self.clock = clock
+        self.host = host
+        self.port = port
+        self.pending = threading.local() #response of the last write of the calling thread
+
+    def write(self, buffer):
+        self.pending.exchange = self.exchanges.take(buffer, "Command")
+
+    def read_very_eager(self):
+        exchange = getattr(self.pending, "exchange", None)
+        if exchange is None:
+            return b""
+        self.pending.exchange = None
+        self.clock.wait(exchange[2])
+        return exchange[3]
+
+    def close(self):
+        pass
+
+
+class Replay_LJM:
+    def __init__(self, calls, clock):
+        """
+        LJM library that returns the recorded results (or raises the recorded errors as ReplayError) of the same calls.
+        """
+        self.calls = calls
+        self.clock = clock
+
+    def __getattr__(self, name):
+        def call(*args):
+            t, function, recorded_args, result, error = self.calls.take((name, encode_args(args)), "LJM call")
+            self.clock.wait(t)
+            if error is not None:
+                raise ReplayError(f"Recorded error of {name}: {error}")
+            return result
+        return call
+
+
+def encode_args(args):
+    """Arguments as they compare with the decoded recorded arguments (lists, Python numbers)."""
+    return repr([a.item() if hasattr(a, "item") else list(a) if isinstance(a, tuple) else a for a in args])
+
+
+class Replay_Session:
+    def __init__(self, file_name, speed=None, lookahead=50):
+        """
+        Replays a trace. Motors and analyzers created by the session share the recorded events.
+
+        Parameters
+        ----------
+        file_name : str
+            trace file
+        speed : float, optional
+            1.0 for the recorded speed, 2.0 for twice as fast, ... None replays as fast as possible: the response delay,
+            sample delay and settling delays of the created instances are set to 0. The default is None.
+        lookahead : int, optional
+            number of events a call may be ahead of the oldest unused event. The default is 50.
+
+        Returns
+        -------
+        None.
+
+        """
+        exchanges, calls, self.address = read_trace(file_name)
+        self.speed = speed
+        self.clock = Replay_Clock(speed)
+        self.exchanges = Replay_Events(exchanges, key=lambda e: e[1], lookahead=lookahead)
+        self.calls = Replay_Events(calls, key=lambda c: (c[1], repr(c[2])), lookahead=lookahead)
+        self.ljm = Replay_LJM(self.calls, self.clock)
+
+    def motor(self, beam_line=None):
+        """
+        Returns
+        -------
+        Emittance_scanner.Motor
+            connected to the recorded controller
+        """
+        M = Emittance_scanner.Motor(beam_line)
+        M.telnet = lambda *args, **kwargs: Replay_Telnet(self.exchanges, self.clock, *self.address)
+        M.state_file = M.state_file[:-5] + "_Replay.json" #the homing state of the lab computer is not touched
+        M.homing_log = M.homing_log[:-5] + "_Replay.json"
+        if self.speed is None:
+            M.response_delay = 0
+        return M
+
+    def analyzer(self, Variables_instance, Motor_instance):
+        """
+        Returns
+        -------
+        Emittance_scanner.Read_and_Analyze
+            with the recorded LabJack
+        """
+        RnA = Emittance_scanner.Read_and_Analyze(Variables_instance, Motor_instance)
+        RnA.ljm = self.ljm
+        RnA.estimator = Emittance_scanner.Scan_Time_Estimator(Motor_instance.planner, RnA.estimator.file_name[:-5] + "_Replay.json") #replayed timing is not learned
+        if self.speed is None:
+            RnA.sample_delay = 0
+            RnA.settle = Emittance_scanner.Settle_Model(dead_time=0)
+        return RnA
+
+    def remaining(self):
+        """
+        Returns
+        -------
+        exchanges, calls : int
+            recorded events that were not replayed
+        """
+        return self.exchanges.remaining(), self.calls.remaining()
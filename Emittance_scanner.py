@@ -3,18 +3,68 @@
 author: SBModre
 """
 import numpy as np
-import scipy.constants
 import time
-from labjack import ljm 
-import matplotlib.pyplot as plt
 from datetime import datetime
 import json
 import re
-import telnetlib
+import threading
+import contextvars
+import copy
+import os
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+def load_ljm():
+    """
+    Imports the LabJack library. Hardware libraries are only imported when they are used, so that data files can be
+    analysed on computers without them (and the program starts faster).
+
+    Returns
+    -------
+    module
+        labjack.ljm
+    """
+    from labjack import ljm
+    return ljm
+
+def create_file(prefix, suffix, extension, related=()):
+    """
+    Creates an empty file named prefix + date and time + suffix + extension. If the name is taken (e.g. two scans of
+    the same axis started within the same second), a counter is added to the time ("... 12h30m05s-2 ..."). The file is
+    created exclusively, so two threads never get the same name.
+
+    Parameters
+    ----------
+    prefix, suffix, extension : str
+        e.g. "Emittance_Scanner_Data_", " Venus_x_", ".journal"
+    related : tuple of str, optional
+        extensions of other files of the same name that must not exist either (e.g. the data file of a journal). The default is ().
+
+    Returns
+    -------
+    base : str
+        file name without extension
+    """
+    Date_Time = datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss")
+    n = 1
+    while True:
+        base = prefix + Date_Time + (f"-{n}" if n > 1 else "") + suffix
+        if not any(os.path.exists(base + other) for other in related):
+            try:
+                open(base + extension, 'x').close()
+                return base
+            except FileExistsError:
+                pass
+        n += 1
+
 
 class FatalError(Exception): #just to later raise a custom Error
     pass
 
+class SaturationError(FatalError): #scan cup signal at the end of the input range, the scan is stopped (gain too high)
+    pass
+
 class Variables:
     def __init__(self):
         """
@@ -122,25 +172,356 @@ class Variables:
         except KeyError: #KeyError would only be raised if somehow a file got the correct filename pattern and format but variables are missing
             print('Wrong Key')
         
+class Motion_Planner:
+    def __init__(self):
+        """
+        Chooses acceleration, deceleration and velocity for every move from the move length and the axis' mechanical limits,
+        so that the time until the axis has settled at the target is minimal.
+        Short moves (e.g. the steps between scan columns) never reach the velocity, their duration is set by the ramps;
+        long moves (centering, retraction) mostly run at the velocity limit.
+        The settling time after a move is modelled as proportional to the deceleration (harder stops ring longer).
+        """
+        self.max_velocity = [15, 15, 15, 15] #mm/s per axis
+        self.max_acceleration = [20, 20, 20, 20] #mm/s^2 per axis (ACC and DEC)
+        self.min_acceleration = [5, 5, 5, 5] #mm/s^2 per axis; the old fixed profile used ACC 5 DEC 5
+        self.settle_per_deceleration = [0.005, 0.005, 0.005, 0.005] #s per mm/s^2 of deceleration
+        self.candidates = 50 #number of accelerations tried between min and max
+
+    def move_time(self, distance, acceleration, velocity):
+        """
+        Duration of a move with symmetric ramps (trapezoidal profile, triangular if the velocity is not reached).
+
+        Parameters
+        ----------
+        distance : float
+            move length [mm]
+        acceleration : float or numpy.ndarray
+            ACC = DEC [mm/s^2]
+        velocity : float or numpy.ndarray
+            VEL [mm/s]
+
+        Returns
+        -------
+        t : float or numpy.ndarray
+            [s]
+
+        """
+        velocity = np.minimum(velocity, np.sqrt(acceleration*distance)) #peak velocity of a triangular profile
+        return np.where(velocity > 0, distance/np.maximum(velocity, 1e-12) + velocity/acceleration, 0)
+
+    def distance_at(self, distance, acceleration, velocity, t):
+        """
+        Distance covered t seconds after the start of a move with symmetric ramps (see move_time).
+
+        Parameters
+        ----------
+        distance : float
+            move length [mm]
+        acceleration : float
+            ACC = DEC [mm/s^2]
+        velocity : float
+            VEL [mm/s]
+        t : float
+            time since the start of the move [s]
+
+        Returns
+        -------
+        float
+            [mm], between 0 and distance
+
+        """
+        distance = abs(distance)
+        velocity = min(velocity, float(np.sqrt(acceleration*distance))) #peak velocity
+        if velocity <= 0 or t <= 0:
+            return 0.0
+        ramp = velocity/acceleration
+        duration = distance/velocity + ramp
+        if t < ramp:
+            return 0.5*acceleration*t**2
+        if t < duration - ramp:
+            return 0.5*acceleration*ramp**2 + velocity*(t - ramp)
+        if t < duration:
+            return distance - 0.5*acceleration*(duration - t)**2
+        return distance
+
+    def plan(self, distance, axis):
+        """
+        Parameters
+        ----------
+        distance : float
+            move length [mm]
+        axis : int
+            in [0,1,2,3]
+
+        Returns
+        -------
+        acc, dec, vel : float
+            ramps [mm/s^2] and velocity [mm/s] for the move
+        t : float
+            expected time until the axis has settled [s]
+
+        """
+        distance = abs(distance)
+        acceleration = np.linspace(self.min_acceleration[axis], self.max_acceleration[axis], self.candidates)
+        velocity = np.minimum(self.max_velocity[axis], np.sqrt(acceleration*distance))
+        velocity = np.maximum(velocity, 0.01) #the controller does not accept VEL 0
+        t = self.move_time(distance, acceleration, velocity) + self.settle_per_deceleration[axis]*acceleration
+        best = int(np.argmin(t))
+        return round(float(acceleration[best]), 3), round(float(acceleration[best]), 3), round(float(velocity[best]), 3), float(t[best])
+
+
+class Command_Metrics:
+    buckets = [0.075, 0.08, 0.09, 0.1, 0.125, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0] #s, histogram bucket bounds (the response delay alone is 0.07s)
+    roles = ("gui", "scan", "other")
+    role = contextvars.ContextVar("link_role", default="other") #caller role of the current thread or asyncio task (see select_role)
+
+    def __init__(self, window=60.0):
+        """
+        Round trip statistics of the controller link, recorded by Motor.send_command/send_batch (and Async_Motor):
+            latency         time a command line holds the link (prompt switch, command, response delay), by command type
+            wait            time a caller waited for the link (held by another thread), by caller role: "gui" (status polling),
+                            "scan" (scan loop, centering and retraction of scan jobs) or "other"
+            parse failures  queries ("?...") whose response could not be read as a number
+            timeouts        responses that did not end with the controller prompt (incomplete within the response delay)
+            errors          exceptions on the link (e.g. lost connection)
+        Lifetime counters are exported in the Prometheus text format (write_prometheus), the last window seconds
+        are summarized for the GUI (summary).
+
+        Parameters
+        ----------
+        window : float, optional
+            [s] of recent commands kept for summary. The default is 60.0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.lock = threading.Lock()
+        self.window = window
+        self.start = time.time()
+        self.latency = {} #command type: bucket counts + [sum, count]
+        self.wait = {} #caller: bucket counts + [sum, count]
+        self.commands = {} #(command type, caller): count
+        self.parse_failures = {} #command type: count
+        self.timeouts = {} #command type: count
+        self.errors = {} #command type: count
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.recent = deque() #(time, command type, caller, wait, latency) of the last window seconds
+        self.thread = None
+
+    @staticmethod
+    def command_type(command):
+        """
+        Label of a command line: the command word without arguments (e.g. "?P", "?BIT", "DRIVE", "PROG"), "MOVE" for axis moves
+        and "BATCH" for colon-joined lines.
+        """
+        if " : " in command:
+            return "BATCH"
+        word = re.match(r"\??[A-Za-z]*", command.strip()).group().upper()
+        return "MOVE" if word in ("X", "Y", "Z", "A") else (word or "OTHER")
+
+    @classmethod
+    def caller(cls):
+        return cls.role.get()
+
+    @classmethod
+    def select_role(cls, role):
+        """
+        Sets the caller role of the commands of the current thread or asyncio task (like Motor.select_program).
+        Scan loops set it for their duration with Command_Metrics.role.set/reset.
+
+        Parameters
+        ----------
+        role : str
+            "gui", "scan" or "other"
+
+        Returns
+        -------
+        None.
+
+        """
+        cls.role.set(role)
+
+    def observe(self, histograms, label, value):
+        histogram = histograms.setdefault(label, [0]*(len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record(self, command, wait, latency, response):
+        """
+        Records one command line.
+
+        Parameters
+        ----------
+        command : str
+            command line as sent (commands joined by " : " for batches)
+        wait : float
+            time waiting for the link [s]
+        latency : float
+            time holding the link [s]
+        response : str
+            raw response
+
+        Returns
+        -------
+        None.
+
+        """
+        kind = self.command_type(command)
+        caller = self.caller()
+        commands = command.split(" : ")
+        if len(commands) == 1:
+            outputs = [Motor.parse_response(response)]
+        else:
+            outputs = Motor.parse_batch(commands, response)
+        failed = sum(c.strip().startswith("?") and output is None for c, output in zip(commands, outputs))
+        now = time.time()
+        with self.lock:
+            self.observe(self.latency, kind, latency)
+            self.observe(self.wait, caller, wait)
+            self.commands[(kind, caller)] = self.commands.get((kind, caller), 0) + 1
+            if failed:
+                self.parse_failures[kind] = self.parse_failures.get(kind, 0) + failed
+            if not response.endswith(">"): #the prompt is the last thing the controller sends
+                self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+            self.bytes_sent += len(command) + 1
+            self.bytes_received += len(response)
+            self.recent.append((now, kind, caller, wait, latency))
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+
+    def record_error(self, command):
+        with self.lock:
+            kind = self.command_type(command)
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : dict
+            of the last window seconds: rate [1/s] (all, GUI polling), latency p50/p95 [s], wait p95 per caller role [s],
+            utilization (fraction of the time the link was busy); lifetime: parse_failures, timeouts, errors
+
+        """
+        with self.lock:
+            recent = list(self.recent)
+            totals = {name: sum(getattr(self, name).values()) for name in ("parse_failures", "timeouts", "errors")}
+        span = min(self.window, max(1e-9, time.time() - self.start))
+        latency = np.array([r[4] for r in recent])
+        summary = {"rate": len(recent)/span, "rate_gui": sum(r[2] == "gui" for r in recent)/span,
+                   "latency_p50": float(np.percentile(latency, 50)) if len(latency) else None,
+                   "latency_p95": float(np.percentile(latency, 95)) if len(latency) else None,
+                   "utilization": float(latency.sum())/span}
+        for caller in self.roles:
+            wait = [r[3] for r in recent if r[2] == caller]
+            summary[f"wait_p95_{caller}"] = float(np.percentile(wait, 95)) if wait else None
+        summary.update(totals)
+        return summary
+
+    def prometheus(self):
+        """
+        Returns
+        -------
+        str
+            all lifetime counters and histograms in the Prometheus text format
+        """
+        prefix = "emittance_scanner_controller"
+        lines = []
+        def histogram(name, description, label, histograms):
+            lines.extend([f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} histogram"])
+            for value, counts in sorted(histograms.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{prefix}_{name}_bucket{{{label}="{value}",le="{bound}"}} {count}')
+                lines.append(f'{prefix}_{name}_bucket{{{label}="{value}",le="+Inf"}} {counts[-1]}')
+                lines.append(f'{prefix}_{name}_sum{{{label}="{value}"}} {counts[-2]}')
+                lines.append(f'{prefix}_{name}_count{{{label}="{value}"}} {counts[-1]}')
+        def counter(name, description, values):
+            lines.extend([f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} counter"])
+            for labels, value in sorted(values.items()):
+                lines.append(f"{prefix}_{name}{{{labels}}} {value}" if labels else f"{prefix}_{name} {value}")
+        with self.lock:
+            histogram("command_latency_seconds", "Time a command line holds the controller link.", "command", self.latency)
+            histogram("link_wait_seconds", "Time waiting for the controller link.", "caller", self.wait)
+            counter("commands_total", "Command lines sent.", {f'command="{k}",caller="{c}"': n for (k, c), n in self.commands.items()})
+            counter("parse_failures_total", "Query responses that are not a number.", {f'command="{k}"': n for k, n in self.parse_failures.items()})
+            counter("timeouts_total", "Responses without the controller prompt.", {f'command="{k}"': n for k, n in self.timeouts.items()})
+            counter("errors_total", "Exceptions on the controller link.", {f'command="{k}"': n for k, n in self.errors.items()})
+            counter("sent_bytes_total", "Bytes sent to the controller.", {"": self.bytes_sent})
+            counter("received_bytes_total", "Bytes received from the controller.", {"": self.bytes_received})
+        lines.append(f"# HELP {prefix}_start_time_seconds Start of the recording (unix time).")
+        lines.append(f"# TYPE {prefix}_start_time_seconds gauge")
+        lines.append(f"{prefix}_start_time_seconds {self.start}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_name="Emittance_Scanner_Metrics.prom"):
+        """
+        Writes the metrics to file_name (atomically, so a collector, e.g. the node_exporter textfile collector, never reads a partial file).
+        """
+        with open(file_name + ".tmp", 'w') as f:
+            f.write(self.prometheus())
+        os.replace(file_name + ".tmp", file_name)
+
+    def start_export(self, file_name="Emittance_Scanner_Metrics.prom", interval=15.0):
+        """
+        Rewrites file_name every interval seconds in a daemon thread.
+        """
+        def export():
+            while True:
+                try:
+                    self.write_prometheus(file_name)
+                except OSError as e:
+                    print(f"Metrics export failed: {e}")
+                time.sleep(interval)
+        self.thread = threading.Thread(target=export, daemon=True)
+        self.thread.start()
+
+
 class Motor:
     def __init__(self, beam_line=None):
         """
         This initiates the Motor Class. In this class all methods that control the motors behaviour can be found
         
-        After defining some variables, communication with the Drive Controller is opened
+        After defining some variables, communication with the Drive Controller is opened on first use (see connect),
+        so a Motor can be created without the controller, e.g. to look at old data.
         """
         self.factor = 19685 #steps/unit (by default = steps/mm) (after gearbox)     
         self.beam_line = beam_line #0 (VENUS) or 1 (AECR)
         self.centered = [False, False, False, False] #list to confirm if centering has been done (i.e. if 0 position has been redefined)
         self.mid_point_offsets = [30.18, 36.50, 31.75, 31.75] #Midpoint Offsets, i.e. the difference between the In/positive Limit and true 0 position [mm]
         #midpoint offsets for VENUS from LabView program
-        self.tn = telnetlib.Telnet("10.10.100.60", 5002, timeout=3) #opens connection to controller
-        self.send_command("PROG0") #opens Program0 prompt. Because Master = 0 all commands have to be sent in Prog0
-        self.send_command("ACC 5 DEC 5 VEL 15 STP 100") #sets Acceleration Ramp, Decceleration Ramp, Velocity and Stop Ramp
+        self.masters = [0, 0, 0, 0] #Master (and therefore Program) each axis is attached to. Beam lines can only move at the same time if they are attached to different masters, e.g. [0, 0, 1, 1]
+        self.lock = threading.RLock() #one command/response at a time on the shared link, e.g. when both beam lines are scanned at the same time
+        self.program = contextvars.ContextVar("program", default=0) #program prompt used by the current thread or asyncio task (see select_program)
+        self.motion_profile = "ACC 5 DEC 5 VEL 15 STP 100" #Acceleration Ramp, Decceleration Ramp, Velocity and Stop Ramp
+        self.address = ("10.10.100.60", 5002) #controller
+        self.tn = None #connection to controller, opened by connect
+        self.telnet = None #Telnet class (or factory with the same arguments) used by connect, None for telnetlib.Telnet. E.g. Emittance_replay recording or replay
+        self.response_delay = 0.07 #s, time the controller gets to answer a command line (see exchange)
+        self.programs_configured = set() #programs the motion profile has been sent to. The first command opens the Program0 prompt and sets the profile (see program_commands)
         self.Voltagecurrentfactor = 1e8 #V/A Scan cup - gain from Keithley 428
         self.axis_names = ["X", "Y", "Z", "A"]
         self.unit = None #while we cannot directly access information about the unit the controller is working in, it might be worth it to figure that out, and add the possibility for the user to change units
-        self.frontshield_gain = 1e8
+        self.frontshield_gain = 1e8 #V/A front shield current amplifier
+        self.planner = Motion_Planner() #chooses ACC/DEC/VEL for every move
+        self.targets = [None, None, None, None] #known position of each idle axis [mm] (read when its last move ended), None if unknown or moving
+        self.last_move = [None, None, None, None] #trajectory of the running move of each axis (see record_move), None while the axis is idle
+        self.state_file = "Emittance_Scanner_Motor_State.json" #homing state, unit factor and controller fingerprint of the last session
+        self.homed_bits = [128, 129, 130, 131] #user flags set after centering an axis. User flags are cleared when the controller is power cycled or reset, i.e. when the reference is lost
+        self.metrics = Command_Metrics() #latency, parse failures, timeouts and throughput of the controller link
+        self.scan_program_base = 100 #P variable with the number of points of the controller scan program, the positions follow (see upload_scan_program). P variables have to be dimensioned on the controller (SYS: DIM P(2048))
+        self.handshake_bits = [[132, 133], [134, 135]] #(point reached, acknowledge) user flags of the controller scan program, per master
+        self.point_settle = 0.05 #s the controller scan program waits at a point before it signals the DAQ
+        self.scan_programs = {} #master: program that was uploaded in this session, so it is only sent again if it changed
+        self.homing_fast = [25.0, 25.0, 25.0, 25.0] #mm/s first approach to the negative limit switch (see home)
+        self.homing_slow = [2.0, 2.0, 2.0, 2.0] #mm/s second approach; sets the precise switch edge, the overtravel grows with the square of the speed
+        self.homing_backoff = [4.0, 4.0, 4.0, 4.0] #mm moved off the switch between the approaches, has to be larger than the overtravel of the fast approach (VEL^2/(2 STP), 3 mm at 25 mm/s)
+        self.homing_log = "Emittance_Scanner_Homing.json" #switch edges of the last homings per axis (repeatability)
         #self.send_command('ATTACH SLAVE0 AXIS0 "X" : ATTACH SLAVE1 AXIS1 "Y" : ATTACH SLAVE2 AXIS2 "Z" : ATTACH SLAVE3 AXIS3 "A"', True)
     
 #axis goes from 0-3. 0,1 are venus horizontal, vertical and 2,3 aecr horizontal, vertical respectively
@@ -179,27 +560,31 @@ class Motor:
             Unit
 
         """
+        if self.unit is not None: #known from this or the last session (see load_state), no need to move
+            return self.unit
         if not self.axis_clear(axis):
             self.move_out([1,0,3,2][axis])
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit
+            while self.send_command(f"?BIT({self.in_motion_bit(axis)})"): #"In Motion"-Bit
                 continue
         position = self.send_command(f"?P(12288 + {axis} * 256)")
         self.relative_move(1, axis)
-        while self.send_command("?BIT(516)"): #"In Motion"-Bit
+        while self.send_command(f"?BIT({self.in_motion_bit(axis)})"): #"In Motion"-Bit
             continue
         new_position = self.send_command(f"?P(12288 + {axis} * 256)")
         distance = new_position-position
         if distance == 1:
             self.factor = 1
-            return "steps"
+            self.unit = "steps"
         elif distance == 19685:
             self.factor = 19685
-            return "mm"
+            self.unit = "mm"
         elif distance == 500000: 
             self.factor = 500000
-            return "inch"
+            self.unit = "inch"
         else:
             raise ValueError("Unknown Unit")
+        self.save_state()
+        return self.unit
             
     def test_connection(self):
         """
@@ -213,14 +598,34 @@ class Motor:
 
         """
         if not self.tn:
-            try:
-                self.tn = telnetlib.Telnet("10.10.100.60", 5002, timeout=3)
-            except:
-                raise TimeoutError("Cannot open Communication")
+            self.connect()
         else:
             pass
 
-    def move_to(self, position, axis): #positon in units (depends on what the acr is calibrated to); axis = 0,1,2,3
+    def connect(self):
+        """
+        Opens the connection to the controller and restores the state of the last session (see load_state).
+        Called by the first command, so creating a Motor does not need the controller.
+
+        Raises
+        ------
+        TimeoutError
+            If opening connection takes longer than 3 seconds
+
+        """
+        if self.telnet is None:
+            import telnetlib #only needed with the controller (and removed from recent Python versions)
+            self.telnet = telnetlib.Telnet
+        with self.lock:
+            if self.tn:
+                return
+            try:
+                self.tn = self.telnet(*self.address, timeout=3) #opens connection to controller
+            except OSError:
+                raise TimeoutError("Cannot open Communication")
+        self.load_state()
+
+    def move_to(self, position, axis, save=True): #positon in units (depends on what the acr is calibrated to); axis = 0,1,2,3
         """
         First checks if axis is clear to move, i.e. if other axis is at out limit. If not, other axis is moved to out Limit.
         Then sends command to Drive on axis
@@ -238,36 +643,27 @@ class Motor:
             position in mm
         axis : Int
             in [0,1,2,3] (Venus x, Venus y, Aecr x, Aecr y)
+        save : bool, optional
+            saves the position of a centered axis afterwards (see save_state), so the reference survives a crash.
+            Loops of moves (scans, auto gain) save once at their end instead. The default is True.
 
         Returns
         -------
         None.
 
         """
-        if not self.axis_clear(axis):
-            self.move_to(200, [1,0,3,2][axis])  #make big enough move, so that motor will travel to positive EOT limit switch
-            self.send_command(f"CLR BIT({8467 + axis * 32})") #clear kill all moves (hitting limit switch sets kill all moves request)
-            self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit for Master 0
-                continue
-            if not self.axis_clear(axis):
-                self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-                raise FatalError("Axis can not be cleared")
+        self.run_steps(self.move_to_steps(position, axis))
+        if save and self.centered[axis]:
+            self.save_state(axis)
+
+    def move_to_steps(self, position, axis):
+        """Steps of move_to (see run_steps)."""
+        yield from self.clear_steps(axis)
         if not self.check_FC():
             raise FatalError("Faraday Cup is not Out")
-        
-        self.send_command(f"DRIVE ON {self.axis_names[axis]}")
-        self.send_command(f'{self.axis_names[axis]}{position}')
-        try:
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit for Master 0
-                continue
-        except KeyboardInterrupt:
-            self.send_command(f"SET BIT({8467 + axis * 32})")
-            self.send_command(f"CLR BIT({8467 + axis * 32})")
-            self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-            raise KeyboardInterrupt()
-        self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-        
+        start = yield from self.current_position_steps(axis)
+        yield from self.move_steps(f"{self.axis_names[axis]}{position}", start, position - start, axis)
+
     def relative_move(self, position, axis):
         """
         Moves axis to position relative to current position. E.g. If current position is -10, relative_move(10, 3) moves axis 3 10mm in positive direction.
@@ -290,190 +686,1720 @@ class Motor:
         -------
         None.
         """
-        if not self.axis_clear(axis):
-            self.move_to(200, [0,1,3,2][axis])  #make big enough move, so that motor will travel to positive EOT limit switch
-            self.send_command(f"CLR BIT({8467 + axis * 32})") #clear kill all moves (hitting limit switch sets kill all moves request)
-            self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit for Master 0
-                continue
-            if not self.axis_clear(axis):
-                self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-                raise FatalError("Axis can not be cleared") 
-      
-        self.send_command(f"DRIVE ON {self.axis_names[axis]}")
-        self.send_command(f'{self.axis_names[axis]}/{position}')
-        try:
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit for Master 0
-                continue
-            self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-        except KeyboardInterrupt:
-            self.send_command(f"SET BIT({8467 + axis * 32})")
-            self.send_command(f"CLR BIT({8467 + axis * 32})")
-        self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
+        self.run_steps(self.relative_move_steps(position, axis))
 
+    def relative_move_steps(self, position, axis):
+        """Steps of relative_move (see run_steps)."""
+        yield from self.clear_steps(axis)
+        start = yield from self.current_position_steps(axis)
+        yield from self.move_steps(f"{self.axis_names[axis]}/{position}", start, position, axis)
 
-    def send_command(self, command, Print=False):
+    def clear_steps(self, axis):
         """
-        Sends command to ACR74C Controller
-
-        Parameters
-        ----------
-        command : str
-            command to be sent to controller
-        Print : Bool, Optional
-            If True, the entire response of the controller is printed. The default is False.
-
-        Returns
-        -------
-        output : float
-            Returns controller response if it is a float, i.e. position, in motion bit, etc.
-            Returns None otherwise
+        Steps (see run_steps) that move the other axis of the beam line to its positive EOT limit if axis is not clear.
 
+        Raises
+        ------
+        FatalError
+            custom error that is raised when seemingly other axis cannot be moved out.
         """
-        self.test_connection
-        self.tn.write(command.encode('ascii') + b'\r') #writes encoded command to socket
-        time.sleep(0.07) #need to await response from controller. If the delay here is too small we might not catch the enire response which will lead to errors in reading position or other relevant information
-        response = self.tn.read_very_eager().decode('ascii').strip()
-        if Print:
-            print(f"Full Response:\n{response}")
-        lines= response.splitlines()
-        if lines:
-            try:
-                output = float(lines[-2]) #if float output, it is always in last line of response. However read_very_eager also reads next prompt line as response, so output is on second to last line
-                return output
-            except:
-                return None
+        if not (yield from self.axis_clear_steps(axis)):
+            yield from self.move_to_steps(200, [1,0,3,2][axis])  #make big enough move, so that motor will travel to positive EOT limit switch
+            yield ("batch", [f"CLR BIT({8467 + axis * 32})", f"DRIVE OFF {self.axis_names[axis]}"]) #clear kill all moves (hitting limit switch sets kill all moves request)
+            yield ("wait_idle", axis, 0.0)
+            if not (yield from self.axis_clear_steps(axis)):
+                yield ("batch", [f"DRIVE OFF {self.axis_names[axis]}"])
+                raise FatalError("Axis can not be cleared")
 
-    def axis_clear(self, axis): 
+    def move_steps(self, move, start, distance, axis, profile=None, commands=()):
         """
-        Checks if the axis is clear, i.e. when input is axis 0, axis 1 should be in outside (clear) position and vice versa
-                                            same for axis 2 and 3
-        
+        Steps (see run_steps) of a single move: sends the move with its motion profile, waits until the master is idle and
+        ends the move (see end_move). A KeyboardInterrupt while the axis moves stops all motion of the axis before it is passed on.
+
         Parameters
         ----------
+        move : str
+            move command without profile, e.g. "X10" or "X/10"
+        start : float
+            position at the start of the move [mm]
+        distance : float
+            signed length of the move [mm]
         axis : int
             in [0,1,2,3]
-            
+        profile : tuple, optional
+            (acc, dec, vel) of the move. The default is None, i.e. the profile planned by self.planner.
+        commands : list of str, optional
+            sent when the move ends, see end_move. The default is ().
+
         Returns
         -------
-        Boolean: True = axis clear
-                 False = axis not clear          
+        None.
 
         """
-        if type(axis) is not int:
-            try:
-                axis = int(axis)
-            except:
-                raise TypeError("Axis has to be int or float!") #(0,1,2,3)
-        other_axis = [1,0,3,2][axis] #if axis = 0, then other axis = 1, if axis = 2, other axis = 3 and vice versa
-        bit = 16128 + other_axis * 32 #positive EOT Limit Current State
-        return bool(self.send_command(f"?BIT({bit})")) 
+        if profile is None:
+            acc, dec, vel, t = self.planner.plan(distance, axis)
+        else:
+            acc, dec, vel = profile
+        self.record_move(axis, start, distance, acc, vel)
+        if profile is not None:
+            t = self.last_move[axis]["duration"]
+        self.targets[axis] = None #read back when the move ends (see end_move)
+        try:
+            yield ("batch", [f"DRIVE ON {self.axis_names[axis]}", f"ACC {acc} DEC {dec} VEL {vel}", move]) #drive, profile and move in one line
+            yield ("wait_idle", axis, t)
+        except KeyboardInterrupt:
+            yield from self.stop_steps(axis)
+            raise
+        yield from self.end_move_steps(axis, commands)
 
-    
-    def move_out(self, axis):
+    def end_move(self, axis, commands=()):
         """
-        Moving axis to positive EOT Limit
+        Ends the move of an idle axis: sends commands, turns the drive off and reads the position in the same batch.
+        The read position becomes the known position of the axis (see current_position), so a move that was killed
+        or stopped by a limit switch is not reported at its target.
 
         Parameters
         ----------
         axis : int
             in [0,1,2,3]
+        commands : list of str, optional
+            sent before the drive is turned off, e.g. clearing the kill all moves request. The default is ().
 
         Returns
         -------
         None.
 
         """
-        self.move_to(200, axis)  #make big enough move, so that motor will travel to positive EOT limit switch
-        self.send_command(f"CLR BIT({8467 + axis * 32})") #clear kill all moves (hitting limit switch sets kill all moves request)
-        self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-     
-        
-    def centering(self, axis):
+        self.run_steps(self.end_move_steps(axis, commands))
+
+    def end_move_steps(self, axis, commands=()):
+        """Steps of end_move (see run_steps)."""
+        self.last_move[axis] = None
+        position = (yield ("batch", list(commands) + [f"DRIVE OFF {self.axis_names[axis]}", f"?P(12288 + {axis} * 256)"]))[-1]
+        self.targets[axis] = None if position is None else position/self.factor
+
+    def move_multiple(self, positions):
         """
-        If axis is clear moves to positive EOT Limit. From there, moves back to Midpointoffset. 
-        Resets Axis, so center position is 0.
-        sets self.centered to True for this axis
-        If this axis has been centered before, this moves the axis to 0
+        Moves several axes at the same time and waits until all of them are done.
+        The axes of one master are moved with one coordinated move (e.g. "X200 Y200") whose vector velocity is chosen so that
+        the longest move runs with its planned profile; axes on different masters move independently in their own programs.
+        A limit switch stops the whole coordinated move of its master, so axes that stopped short are moved again
+        (at most once per axis) until every axis is at its target or limit switch.
+        Axes that move in (target below 200) have to be clear: the other axis of their beam line is retracted first,
+        and both axes of a beam line cannot move in together.
 
         Parameters
         ----------
-        axis : int
-            in [0,1,2,3]
+        positions : dict
+            axis: position [mm]; +-200 moves to the limit switch (see move_out)
 
         Raises
         ------
+        ValueError
+            if both axes of a beam line are to move in
         FatalError
-            if perpendicular axis cannot be cleared.
+            if the Faraday Cup is not out or an axis does not reach its target
 
         Returns
         -------
         None.
 
         """
-        if not self.axis_clear(axis):
-            try:
-                self.move_out([1,0,3,2][axis])
-            except KeyboardInterrupt:
-                return
-            while self.send_command("?BIT(516)"): #"In Motion"-Bit for Master 0
-                continue
-            if not self.axis_clear(axis):
-                self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-                raise FatalError("Axis can not be cleared")
-        if self.centered[axis]: #If the axis has already been centered before just move to 0.
-            self.move_to(0, axis)
-            return
-    
-        self.move_to(-200, axis)
-        while self.send_command("?BIT(516)"): 
-            try:
-                continue
-            except KeyboardInterrupt:
-                return
-        self.relative_move(self.mid_point_offsets[axis], axis)
-        while self.send_command("?BIT(516)"): #"In Motion"-Bit
+        positions = {int(axis): float(position) for axis, position in positions.items()}
+        inward = [axis for axis, position in positions.items() if position < 200]
+        if any([1,0,3,2][axis] in inward for axis in inward):
+            raise ValueError("Both axes of a beam line cannot move in at the same time")
+        if inward:
+            if not self.check_FC():
+                raise FatalError("Faraday Cup is not Out")
+            blocking = [[1,0,3,2][axis] for axis in inward if [1,0,3,2][axis] not in positions and not self.axis_clear(axis)]
+            if blocking:
+                self.move_multiple({axis: 200 for axis in blocking})
+        remaining = dict(positions)
+        for attempt in range(len(positions) + 2):
+            remaining = {axis: position for axis, position in remaining.items() if not self.at_target(axis, position)} #commanding a move into an active limit switch would kill the other moves
+            if not remaining:
+                break
+            if attempt == len(positions) + 1:
+                raise FatalError(f"Axes {[self.axis_names[axis] for axis in remaining]} did not reach their targets")
+            masters = {}
+            for axis in remaining:
+                masters.setdefault(self.masters[axis], []).append(axis)
             try:
-                continue
+                for master, axes in masters.items():
+                    starts = {axis: self.current_position(axis) for axis in axes}
+                    distances = {axis: remaining[axis] - starts[axis] for axis in axes}
+                    longest = max(axes, key=lambda axis: abs(distances[axis]))
+                    acc, dec, vel, t = self.planner.plan(distances[longest], longest)
+                    scale = float(np.hypot.reduce([distances[axis] for axis in axes]))/max(abs(distances[longest]), 1e-9) #vector length/longest move
+                    for axis in axes:
+                        share = abs(distances[axis])/max(abs(distances[longest]), 1e-9)
+                        self.record_move(axis, starts[axis], distances[axis], acc*share, vel*share)
+                        self.targets[axis] = None #read by at_target after the move
+                    names = " ".join(self.axis_names[axis] for axis in axes)
+                    token = self.program.set(master) #moves are commanded in the program of the master
+                    try:
+                        self.send_batch([f"DRIVE ON {names}", f"ACC {round(acc*scale, 3)} DEC {round(dec*scale, 3)} VEL {round(vel*scale, 3)}",
+                                         " ".join(f"{self.axis_names[axis]}{remaining[axis]}" for axis in axes)])
+                    finally:
+                        self.program.reset(token)
+                bits = sorted({self.in_motion_bit(axis) for axis in remaining})
+                while any(self.send_batch([f"?BIT({bit})" for bit in bits])): #"In Motion"-Bits of all masters
+                    continue
             except KeyboardInterrupt:
-                return
-        self.send_command(f"RES AXIS{axis}")
-        self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
-        self.centered[axis] = True
-        
-        
-class Read_and_Analyze:
-    def __init__(self, Variables_instance, Motor_instance):
+                for axis in remaining:
+                    self.stop(axis)
+                raise
+            self.send_batch([f"CLR BIT({8467 + axis * 32})" for axis in remaining] + [f"DRIVE OFF {' '.join(self.axis_names[axis] for axis in remaining)}"]) #clear kill all moves (hitting limit switch sets kill all moves request)
+            for axis in remaining:
+                self.last_move[axis] = None
+        centered = [axis for axis in positions if self.centered[axis]]
+        if centered:
+            self.save_state(centered)
+
+    def at_target(self, axis, position):
         """
-        Initiates the analysing class. Initates a Variables and Motor instance.
-        creates arrays for the positions x and y and the momenta x' and y'
+        Returns
+        -------
+        bool
+            True if axis is at position (within 0.01 mm, read from the controller), or at the limit switch for +-200.
+            Updates the known position of the axis.
+        """
+        if abs(position) >= 200:
+            return bool(self.send_command(f"?BIT({16128 + axis * 32 + (position < 0)})")) #positive/negative EOT Limit Current State
+        self.targets[axis] = None #read the real position
+        reached = abs(self.current_position(axis) - position) <= 0.01
+        if reached:
+            self.targets[axis] = position
+        return reached
+
+    def move_out_multiple(self, axes):
+        """
+        Moves several axes to their positive EOT Limit at the same time (see move_multiple).
 
         Parameters
         ----------
-        Variables_instance : object
-            instance of Variables() class
-        Motor_instance : object
-            instance of Motor() class
+        axes : list of int
+            in [0,1,2,3]
 
         Returns
         -------
         None.
 
         """
-        self.Var = Variables_instance
-        self.Mot = Motor_instance
-        self.x = np.arange(self.Var.x_min, self.Var.x_max+self.Var.x_step, self.Var.x_step) #x-array
-        self.y = np.arange(self.Var.y_min, self.Var.y_step + self.Var.y_max, self.Var.y_step) #y-array
-        self.x_prime = np.arange(self.Var.xp_min,self.Var.xp_step + self.Var.xp_max, self.Var.xp_step) #x' array
-        self.y_prime = np.arange(self.Var.yp_min, self.Var.yp_step + self.Var.yp_max, self.Var.yp_step) # y' array
-        
-        
+        self.move_multiple({axis: 200 for axis in axes})
+
+    def record_move(self, axis, start, distance, acc, vel):
+        """
+        Stores the trajectory of a move that is about to be sent, so its position can be predicted without asking the controller
+        (see predicted_position). The move methods reset self.last_move[axis] to None when the axis is idle again.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        start : float
+            position at the start of the move [mm]
+        distance : float
+            signed move length [mm]
+        acc, vel : float
+            ramps [mm/s^2] and velocity [mm/s] sent with the move
+
+        Returns
+        -------
+        None.
+
+        """
+        now = time.monotonic()
+        self.last_move[axis] = {"start": start, "distance": distance, "acc": acc, "vel": vel, "time": now,
+                                "duration": float(self.planner.move_time(abs(distance), acc, vel)), "offset": 0.0, "synced": now}
+
+    def predicted_position(self, axis, resync=False, interval=1.0):
+        """
+        Position of axis for displays, without polling the controller: while a move runs, the position is interpolated
+        along the trapezoidal profile of the move (see record_move); an idle axis is at its last known position.
+        While moving, the prediction is corrected with a real position read every interval seconds (or when resync is True),
+        and if the model says the move should be over but the axis still moves.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        resync : bool, optional
+            read the real position now if the axis moves. The default is False.
+        interval : float, optional
+            time between two reads while moving [s]. The default is 1.0.
+
+        Returns
+        -------
+        position : float
+            [mm]
+        moving : bool
+
+        """
+        move = self.last_move[axis]
+        if move is None:
+            return self.current_position(axis), False
+        now = time.monotonic()
+        elapsed = now - move["time"]
+        if resync or now - move["synced"] > interval or (elapsed > move["duration"] and now - move["synced"] > 0.2):
+            in_motion, position = self.send_batch([f"?BIT({self.in_motion_bit(axis)})", f"?P(12288 + {axis} * 256)"])
+            move["synced"] = now
+            if position is not None:
+                position /= self.factor
+                move["offset"] = position - move["start"] - np.sign(move["distance"])*self.planner.distance_at(move["distance"], move["acc"], move["vel"], elapsed)
+                if not in_motion: #the move is over, e.g. it ended at a limit switch
+                    return position, False
+        return float(move["start"] + move["offset"] + np.sign(move["distance"])*self.planner.distance_at(move["distance"], move["acc"], move["vel"], elapsed)), True
+
+    def current_position(self, axis):
+        """
+        Returns
+        -------
+        float
+            position of axis [mm]. The position read at the end of the last move if it is known, otherwise read from the controller.
+        """
+        return self.run_steps(self.current_position_steps(axis))
+
+    def current_position_steps(self, axis):
+        """Steps of current_position (see run_steps)."""
+        if self.targets[axis] is None:
+            position, = yield ("batch", [f"?P(12288 + {axis} * 256)"])
+            if position is None:
+                return 0
+            self.targets[axis] = position/self.factor
+        return self.targets[axis]
+
+
+    def send_command(self, command, Print=False):
+        """
+        Sends command to ACR74C Controller
+
+        Parameters
+        ----------
+        command : str
+            command to be sent to controller
+        Print : Bool, Optional
+            If True, the entire response of the controller is printed. The default is False.
+
+        Returns
+        -------
+        output : float
+            Returns controller response if it is a float, i.e. position, in motion bit, etc.
+            Returns None otherwise
+
+        """
+        self.test_connection()
+        requested = time.perf_counter()
+        try:
+            with self.lock:
+                acquired = time.perf_counter()
+                for line in self.program_commands(command):
+                    self.exchange(line)
+                response = self.exchange(command)
+        except Exception:
+            self.metrics.record_error(command)
+            raise
+        self.metrics.record(command, acquired - requested, time.perf_counter() - acquired, response)
+        if Print:
+            print(f"Full Response:\n{response}")
+        return self.parse_response(response)
+
+    def send_batch(self, commands, Print=False):
+        """
+        Sends several commands as one colon-joined command line, so the whole sequence costs one round trip
+        (one response delay) instead of one per command.
+
+        Parameters
+        ----------
+        commands : list of str
+            commands to be sent to controller, executed in the given order
+        Print : Bool, Optional
+            If True, the entire response of the controller is printed. The default is False.
+
+        Returns
+        -------
+        outputs : list
+            one entry per command: the response of queries ("?...") as float, None for all other commands
+            (and for queries without float response)
+
+        """
+        self.test_connection()
+        line = " : ".join(commands)
+        requested = time.perf_counter()
+        try:
+            with self.lock:
+                acquired = time.perf_counter()
+                for prefix in self.program_commands(commands[0]):
+                    self.exchange(prefix)
+                response = self.exchange(line)
+        except Exception:
+            self.metrics.record_error(line)
+            raise
+        self.metrics.record(line, acquired - requested, time.perf_counter() - acquired, response)
+        if Print:
+            print(f"Full Response:\n{response}")
+        return self.parse_batch(commands, response)
+
+    @staticmethod
+    def parse_batch(commands, response):
+        """
+        Splits the response of a colon-joined command line. The controller echoes the line, answers every query on its own line
+        and ends with the next prompt, so the lines in between are the query responses in the order of the queries.
+
+        Returns
+        -------
+        outputs : list
+            one entry per command, see send_batch
+        """
+        answers = iter(response.splitlines()[1:-1])
+        outputs = []
+        for command in commands:
+            output = None
+            if command.strip().startswith("?"):
+                try:
+                    output = float(next(answers, ""))
+                except ValueError:
+                    pass
+            outputs.append(output)
+        return outputs
+
+    def stop(self, axis):
+        """
+        Kills all moves of axis, turns the drive off and clears the kill request again (one round trip).
+        The drive is turned off between setting and clearing the kill request, so the kill is active for a moment.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+
+        Returns
+        -------
+        None.
+
+        """
+        self.run_steps(self.stop_steps(axis))
+
+    def stop_steps(self, axis):
+        """Steps of stop (see run_steps)."""
+        yield ("batch", [f"SET BIT({8467 + axis * 32})", f"DRIVE OFF {self.axis_names[axis]}", f"CLR BIT({8467 + axis * 32})"])
+        self.targets[axis] = None #stopped somewhere on the way
+        self.last_move[axis] = None
+
+    def run_steps(self, steps):
+        """
+        Runs steps with blocking calls. Steps are generators (the *_steps methods of Motor and Read_and_Analyze) that contain
+        the logic of a move or a scan and yield whatever they have to wait for, so the same logic is run here and, with awaits,
+        by Emittance_async.Async_Motor.run_steps:
+            ("batch", commands)        the commands are sent as one command line (see send_batch), the outputs are sent back
+            ("wait_idle", axis, t)     waits until the master of axis is not in motion; t is the planned duration of the move [s]
+            ("sleep", seconds)
+            ("wait", futures)          waits until the concurrent.futures are done
+            ("call", function, *args)  blocking call (file I/O, methods that use the synchronous link), its result is sent back
+        An error while waiting (e.g. a KeyboardInterrupt) is raised inside the steps, so a move can stop its axis first.
+
+        Parameters
+        ----------
+        steps : generator
+
+        Returns
+        -------
+        return value of steps
+
+        """
+        result, error = None, None
+        while True:
+            try:
+                request = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            result, error = None, None
+            try:
+                result = self.execute_step(request)
+            except BaseException as e: #raised inside the steps
+                error = e
+
+    def execute_step(self, request):
+        """
+        Executes one request of a steps generator, see run_steps.
+        """
+        kind, *args = request
+        if kind == "batch":
+            return self.send_batch(args[0])
+        if kind == "wait_idle":
+            while self.send_command(f"?BIT({self.in_motion_bit(args[0])})"): #"In Motion"-Bit of the master
+                continue
+        elif kind == "sleep":
+            time.sleep(args[0])
+        elif kind == "wait":
+            futures.wait(args[0])
+        elif kind == "call":
+            return args[0](*args[1:])
+        else:
+            raise ValueError(f"Unknown step {kind!r}")
+
+    def program_commands(self, command):
+        """
+        Commands that have to be sent before command, so that it reaches the program prompt of the calling thread/task
+        (see select_program), i.e. the prompt switch and, the first time a program is used, the motion profile.
+        Has to be called while holding self.lock; the commands are assumed to be sent right away.
+
+        Parameters
+        ----------
+        command : str
+            command that is going to be sent
+
+        Returns
+        -------
+        commands : list of str
+
+        """
+        prog = self.program.get()
+        if command.startswith("PROG") and command[4:].isdigit(): #prompt switch (not PROGRAM)
+            self.prog = int(command[4:])
+            return []
+        if prog == getattr(self, "prog", None):
+            return []
+        commands = [f"PROG{prog}"] #switch to the prompt of the master this thread is driving
+        self.prog = prog
+        if prog not in self.programs_configured:
+            commands.append(self.motion_profile)
+            self.programs_configured.add(prog)
+        return commands
+
+    @staticmethod
+    def parse_response(response):
+        """
+        Returns
+        -------
+        output : float
+            the controller response if it is a float, i.e. position, in motion bit, etc.
+            None otherwise
+        """
+        lines= response.splitlines()
+        if lines:
+            try:
+                output = float(lines[-2]) #if float output, it is always in last line of response. However read_very_eager also reads next prompt line as response, so output is on second to last line
+                return output
+            except:
+                return None
+
+    def exchange(self, command):
+        """
+        Writes one command line to the controller and returns the raw response.
+        Callers sharing the link between threads have to hold self.lock (send_command does).
+
+        Parameters
+        ----------
+        command : str
+            command to be sent to controller
+
+        Returns
+        -------
+        response : str
+            everything the controller answered, including the next prompt
+
+        """
+        self.tn.write(command.encode('ascii') + b'\r') #writes encoded command to socket
+        time.sleep(self.response_delay) #need to await response from controller. If the delay here is too small we might not catch the enire response which will lead to errors in reading position or other relevant information
+        return self.tn.read_very_eager().decode('ascii').strip()
+
+    def select_program(self, prog):
+        """
+        Sets the program prompt that send_command uses for all commands sent from the calling thread (or asyncio task).
+        Motion commands have to be sent in the program of the master the axis is attached to (see self.masters).
+
+        Parameters
+        ----------
+        prog : int
+            program number
+
+        Returns
+        -------
+        None.
+
+        """
+        self.program.set(prog)
+
+    def in_motion_bit(self, axis):
+        """
+        Returns
+        -------
+        int
+            "In Motion"-Bit of the master that axis is attached to
+        """
+        return 516 + 32*self.masters[axis]
+
+    def axis_clear(self, axis): 
+        """
+        Checks if the axis is clear, i.e. when input is axis 0, axis 1 should be in outside (clear) position and vice versa
+                                            same for axis 2 and 3
+        
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+            
+        Returns
+        -------
+        Boolean: True = axis clear
+                 False = axis not clear          
+
+        """
+        if type(axis) is not int:
+            try:
+                axis = int(axis)
+            except:
+                raise TypeError("Axis has to be int or float!") #(0,1,2,3)
+        return self.run_steps(self.axis_clear_steps(axis))
+
+    def axis_clear_steps(self, axis):
+        """Steps of axis_clear (see run_steps)."""
+        other_axis = [1,0,3,2][int(axis)] #if axis = 0, then other axis = 1, if axis = 2, other axis = 3 and vice versa
+        bit = 16128 + other_axis * 32 #positive EOT Limit Current State
+        return bool((yield ("batch", [f"?BIT({bit})"]))[0])
+
+    
+    def move_out(self, axis):
+        """
+        Moving axis to positive EOT Limit
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+
+        Returns
+        -------
+        None.
+
+        """
+        self.run_steps(self.move_out_steps(axis))
+
+    def move_out_steps(self, axis):
+        """Steps of move_out (see run_steps)."""
+        yield from self.move_to_steps(200, axis)  #make big enough move, so that motor will travel to positive EOT limit switch
+        yield ("batch", [f"CLR BIT({8467 + axis * 32})", f"DRIVE OFF {self.axis_names[axis]}"]) #clear kill all moves (hitting limit switch sets kill all moves request)
+     
+        
+    def centering(self, axis, rehome=False):
+        """
+        If axis is clear moves to positive EOT Limit. From there, moves back to Midpointoffset. 
+        Resets Axis, so center position is 0.
+        sets self.centered to True for this axis
+        If this axis has been centered before, this moves the axis to 0
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        rehome : bool, optional
+            home the axis even if it is centered, e.g. to log the repeatability of the reference (see home). The default is False.
+
+        Raises
+        ------
+        FatalError
+            if perpendicular axis cannot be cleared.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not self.axis_clear(axis):
+            try:
+                self.move_out([1,0,3,2][axis])
+            except KeyboardInterrupt:
+                return
+            while self.send_command(f"?BIT({self.in_motion_bit(axis)})"): #"In Motion"-Bit of the master
+                continue
+            if not self.axis_clear(axis):
+                self.send_command(f"DRIVE OFF {self.axis_names[axis]}")
+                raise FatalError("Axis can not be cleared")
+        if self.centered[axis] and not rehome: #If the axis has already been centered before just move to 0.
+            self.move_to(0, axis)
+            return
+        self.home(axis)
+
+    def home(self, axis, repeats=1):
+        """
+        Two-speed homing: approaches the negative limit switch with homing_fast, backs off by homing_backoff and approaches
+        it again with homing_slow, so the switch edge does not depend on the overtravel of the fast stop. From the edge,
+        the axis moves mid_point_offsets[axis] to the center, which becomes 0 (RES).
+        The edges are logged in self.homing_log: their spread (with repeats > 1) and, if the encoder is still in the frame of
+        an earlier homing (its homed bit is set, i.e. the controller was not reset since), the deviation of the edge from
+        where that homing put it (repeatability between homings, e.g. with centering(axis, rehome=True)).
+        The other axis of the beam line has to be clear (see centering).
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        repeats : int, optional
+            number of slow approaches, e.g. 5 to measure the repeatability of the edge. The default is 1.
+
+        Raises
+        ------
+        FatalError
+            if the limit switch is not reached or not released by the backoff, or the position at the switch cannot be read
+
+        Returns
+        -------
+        entry : dict
+            log entry: time, axis, edges [mm], spread [mm], deviation [mm] (None without a valid reference)
+
+        """
+        if not self.check_FC():
+            raise FatalError("Faraday Cup is not Out")
+        reference = bool(self.send_command(f"?BIT{self.homed_bits[axis]}")) #the encoder frame is the one of the last homing, also in a new session
+        self.centered[axis] = False
+        self.homing_move(axis, -200, self.homing_fast[axis])
+        edges = []
+        for i in range(repeats):
+            self.homing_move(axis, self.homing_backoff[axis], self.homing_fast[axis], relative=True)
+            if self.send_command(f"?BIT({16129 + axis * 32})"): #negative EOT Limit Current State
+                raise FatalError(f"Axis {self.axis_names[axis]} did not leave the limit switch, increase homing_backoff")
+            self.homing_move(axis, -200, self.homing_slow[axis])
+            edge = self.targets[axis] #read when the move ended (see end_move), None if the response could not be parsed
+            for attempt in range(3):
+                if edge is not None:
+                    break
+                position = self.send_command(f"?P(12288 + {axis} * 256)")
+                edge = None if position is None else position/self.factor
+            if edge is None:
+                raise FatalError(f"Homing of axis {self.axis_names[axis]} failed: the position at the limit switch could not be read")
+            edges.append(edge)
+        self.relative_move(self.mid_point_offsets[axis], axis)
+        self.send_batch([f"RES AXIS{axis}", f"DRIVE OFF {self.axis_names[axis]}", f"SET BIT{self.homed_bits[axis]}"]) #homed bit marks the reference as valid until the controller is reset
+        self.targets[axis] = 0
+        self.centered[axis] = True
+        self.save_state()
+        return self.log_homing(axis, edges, reference)
+
+    def homing_move(self, axis, position, velocity, relative=False):
+        """
+        Move of the homing routine with its own velocity (not limited by the Motion_Planner) and the planner's maximum ramps.
+        Moves to -200 end at the negative limit switch, which has to be reached.
+        """
+        name = self.axis_names[axis]
+        acc = self.planner.max_acceleration[axis]
+        start = self.current_position(axis)
+        self.run_steps(self.move_steps(f"{name}{'/' if relative else ''}{position}", start, position if relative else position - start, axis,
+                                       (acc, acc, velocity), [f"CLR BIT({8467 + axis * 32})"])) #clear kill all moves (hitting limit switch sets kill all moves request)
+        if position <= -200 and not self.send_command(f"?BIT({16129 + axis * 32})"):
+            raise FatalError(f"Axis {self.axis_names[axis]} did not reach the limit switch")
+
+    def log_homing(self, axis, edges, reference):
+        """
+        Appends a homing to self.homing_log (the last 100 per axis are kept) and prints the repeatability.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        edges : list of float
+            positions of the switch edge [mm], in the encoder frame before the reset
+        reference : bool
+            True if the encoder frame was the one of the last homing (homed bit set), i.e. the edge should be at -mid_point_offsets[axis]
+
+        Returns
+        -------
+        entry : dict
+            see home
+        """
+        entry = {"time": datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss"), "axis": axis, "edges": edges,
+                 "spread": max(edges) - min(edges) if len(edges) > 1 else None,
+                 "deviation": edges[-1] + self.mid_point_offsets[axis] if reference and edges else None}
+        log = []
+        if os.path.exists(self.homing_log):
+            try:
+                with open(self.homing_log) as f:
+                    log = json.load(f)
+            except ValueError:
+                pass
+        log.append(entry)
+        log = [old for old in log if old["axis"] != axis] + [old for old in log if old["axis"] == axis][-100:]
+        with open(self.homing_log + ".tmp", 'w') as f:
+            json.dump(log, f)
+        os.replace(self.homing_log + ".tmp", self.homing_log)
+        deviations = [old["deviation"] for old in log if old["axis"] == axis and old["deviation"] is not None]
+        text = f"Homed {self.axis_names[axis]}: edge spread {entry['spread']*1e3:.1f} um" if entry["spread"] is not None else f"Homed {self.axis_names[axis]}"
+        if entry["deviation"] is not None:
+            text += f", deviation from the last reference {entry['deviation']*1e3:.1f} um (std of the last {len(deviations)}: {np.std(deviations)*1e3:.1f} um)"
+        print(text)
+        return entry
+
+    def scan_program(self, axis, step):
+        """
+        AcroBASIC program that walks the position list in P(scan_program_base + 1 ...) (count in P(scan_program_base)).
+        At every point it waits until the move is done and settled, sets the "point reached" flag and waits for the DAQ
+        to set the acknowledge flag, then clears both flags and moves on. The drive is turned off after the last point.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        step : float
+            typical distance between two points [mm], sets the motion profile (see Motion_Planner.plan)
+
+        Returns
+        -------
+        lines : list of str
+            program lines, from PROGRAM to ENDP
+        """
+        name = self.axis_names[axis]
+        ready, ack = self.handshake_bits[self.masters[axis]]
+        base = self.scan_program_base
+        acc, dec, vel, t = self.planner.plan(step, axis)
+        return ["PROGRAM",
+                "DIM LV(1)",
+                f"DRIVE ON {name}",
+                f"ACC {acc} DEC {dec} VEL {vel}",
+                "LV0 = 0",
+                "_NEXT",
+                f"{name}(P({base + 1} + LV0))",
+                f"INH -{self.in_motion_bit(axis)}", #move done
+                f"DWL {self.point_settle}",
+                f"SET BIT{ready}",
+                f"INH {ack}", #DAQ has measured the point
+                f"CLR BIT{ready}",
+                f"CLR BIT{ack}",
+                "LV0 = LV0 + 1",
+                f"IF (LV0 < P{base})",
+                "GOTO NEXT",
+                "ENDIF",
+                f"DRIVE OFF {name}",
+                "ENDP"]
+
+    def upload_scan_program(self, axis, positions):
+        """
+        Writes the position list to the controller's P variables and, if it is not there yet, the scan program (see scan_program)
+        to the program of the axis' master.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        positions : array-like
+            positions [mm] in the order they are measured
+
+        Returns
+        -------
+        None.
+
+        """
+        positions = [float(position) for position in positions]
+        base = self.scan_program_base
+        commands = [f"P{base} = {len(positions)}"] + [f"P{base + 1 + i} = {position}" for i, position in enumerate(positions)]
+        for i in range(0, len(commands), 10): #10 assignments per command line
+            self.send_batch(commands[i:i+10])
+        step = float(np.median(np.abs(np.diff(positions)))) if len(positions) > 1 else 1.0
+        program = self.scan_program(axis, step)
+        master = self.masters[axis]
+        if self.scan_programs.get(master) == program:
+            return
+        token = self.program.set(master) #programs are entered at their own prompt
+        try:
+            self.send_command("HALT")
+            self.send_command("NEW")
+            for line in program:
+                self.send_command(line)
+        finally:
+            self.program.reset(token)
+        self.scan_programs[master] = program
+
+    def start_scan_program(self, axis, positions):
+        """
+        Uploads and starts the controller scan program: the controller moves to every position by itself and waits at each point
+        for the DAQ (see wait_scan_point and acknowledge_scan_point), so a column costs one command instead of a move sequence.
+        As for move_to, the other axis of the beam line is moved out first and the Faraday Cup has to be out.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        positions : array-like
+            positions [mm] in the order they are measured
+
+        Raises
+        ------
+        FatalError
+            if the other axis cannot be cleared or the Faraday Cup is not out
+
+        Returns
+        -------
+        None.
+
+        """
+        if not self.axis_clear(axis):
+            self.move_out([1,0,3,2][axis])
+            if not self.axis_clear(axis):
+                raise FatalError("Axis can not be cleared")
+        if not self.check_FC():
+            raise FatalError("Faraday Cup is not Out")
+        ready, ack = self.handshake_bits[self.masters[axis]]
+        self.upload_scan_program(axis, positions)
+        self.send_batch([f"CLR BIT{ready}", f"CLR BIT{ack}"])
+        self.targets[axis] = None #moving on its own
+        self.last_move[axis] = None
+        token = self.program.set(self.masters[axis])
+        try:
+            self.send_command("RUN")
+        finally:
+            self.program.reset(token)
+
+    def wait_scan_point(self, axis, position, timeout=60.0):
+        """
+        Waits until the scan program has reached the next point (flag set and the previous acknowledge cleared).
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        position : float
+            position of the point [mm], becomes the axis' known position
+        timeout : float, optional
+            [s]. The default is 60.
+
+        Raises
+        ------
+        FatalError
+            if the point is not reached within timeout (e.g. the program was halted or hit a limit)
+
+        Returns
+        -------
+        None.
+
+        """
+        self.run_steps(self.wait_scan_point_steps(axis, position, timeout))
+
+    def wait_scan_point_steps(self, axis, position, timeout=60.0):
+        """Steps of wait_scan_point (see run_steps)."""
+        ready, ack = self.handshake_bits[self.masters[axis]]
+        end = time.time() + timeout
+        while True:
+            reached, acknowledged = yield ("batch", [f"?BIT{ready}", f"?BIT{ack}"])
+            if reached and not acknowledged:
+                break
+            if time.time() > end:
+                raise FatalError(f"Scan program did not reach {position} mm")
+        self.targets[axis] = float(position)
+
+    def acknowledge_scan_point(self, axis):
+        """
+        Tells the scan program that the point is measured, it moves on to the next one.
+        """
+        self.run_steps(self.acknowledge_scan_point_steps(axis))
+
+    def acknowledge_scan_point_steps(self, axis):
+        """Steps of acknowledge_scan_point (see run_steps)."""
+        yield ("batch", [f"SET BIT{self.handshake_bits[self.masters[axis]][1]}"])
+
+    def end_scan_program(self, axis):
+        """
+        Halts the scan program (if it still runs, e.g. after an error), turns the drive off and clears the handshake flags.
+        """
+        ready, ack = self.handshake_bits[self.masters[axis]]
+        token = self.program.set(self.masters[axis])
+        try:
+            self.end_move(axis, ["HALT", f"CLR BIT{ready}", f"CLR BIT{ack}"])
+        finally:
+            self.program.reset(token)
+        if self.centered[axis]:
+            self.save_state(axis)
+
+    def fingerprint(self):
+        """
+        Returns
+        -------
+        str
+            controller address and firmware version. Identifies the controller the saved state belongs to.
+        """
+        if getattr(self, "controller_fingerprint", None) is None: #only asked once per session
+            self.test_connection()
+            with self.lock:
+                lines = self.exchange("VER").splitlines()
+            self.controller_fingerprint = f"{self.tn.host}:{self.tn.port} " + " ".join(line.strip() for line in lines[1:-1]) #without echoed command and prompt
+        return self.controller_fingerprint
+
+    def save_state(self, axis=None):
+        """
+        Saves which axes are centered, their positions, the unit factor and the controller fingerprint in self.state_file,
+        so the next session does not have to center the axes again.
+
+        Parameters
+        ----------
+        axis : int or list of int, optional
+            Only the position of this axis (these axes) is updated, the others are unchanged. The default updates all axes.
+            The position of an idle axis is the one read when its last move ended (self.targets), so it costs no round trip;
+            it is only read from the controller if it is not known.
+
+        Returns
+        -------
+        None.
+
+        """
+        if getattr(self, "positions", None) is None:
+            self.positions = [None, None, None, None]
+        for i in (range(4) if axis is None else [axis] if np.isscalar(axis) else axis):
+            if self.targets[i] is None or self.last_move[i] is not None: #unknown or moving
+                self.positions[i] = self.send_command(f"?P(12288 + {i} * 256)")
+            else:
+                self.positions[i] = self.targets[i]*self.factor #encoder counts
+        state = {"fingerprint": self.fingerprint(), "centered": self.centered, "positions": self.positions, "factor": self.factor, "unit": self.unit,
+                 "time": datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss")}
+        with open(self.state_file + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def load_state(self):
+        """
+        Restores the state of the last session if it is still valid. An axis counts as centered if
+        - the controller has the same fingerprint,
+        - the axis' homed bit is still set (i.e. the controller was not reset or power cycled),
+        - the encoder position is still the saved one (within 0.01 mm), i.e. the axis was not moved by anything else.
+        Otherwise the axis has to be centered again.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except ValueError:
+            return
+        if state.get("fingerprint") != self.fingerprint():
+            print("Different controller than in the last session. Axes have to be centered.")
+            return
+        self.factor = state["factor"]
+        self.unit = state["unit"]
+        self.positions = state["positions"]
+        for axis in range(4):
+            if not state["centered"][axis] or not self.send_command(f"?BIT{self.homed_bits[axis]}"):
+                continue
+            position = self.send_command(f"?P(12288 + {axis} * 256)")
+            if position is not None and state["positions"][axis] is not None and abs(position - state["positions"][axis]) <= 0.01*self.factor:
+                self.centered[axis] = True
+
+
+def read_data_file(filename):
+    """
+    Reads an Emittance_Scanner_Data file (as written by Read_and_Analyze.get_current) into a dictionary.
+    Every second line of the file holds a value, the lines in between are the section titles.
+
+    Parameters
+    ----------
+    filename : str
+        Data file to be read
+
+    Returns
+    -------
+    data : dict
+        keys: variables, beam_line, axis, position [mm], momentum [mrad], voltage [V], current [A], E_rms [m rad], alpha, beta, gamma
+        Sections that follow Gamma (e.g. in files written by Scan_Statistics) are stored in data["extra"] by their title.
+
+    """
+    titles = []
+    values = []
+    with open(filename) as f:
+        for i, line in enumerate(f):
+            if i%2 == 0:
+                titles.append(line.strip().rstrip(':').strip())
+                continue
+            try:
+                values.append(json.loads(line))
+            except:
+                values.append(line.strip())
+    data = {"variables": values[0], "beam_line": values[1], "axis": values[2],
+            "position": np.array(values[3], dtype=float), "momentum": np.array(values[4], dtype=float),
+            "voltage": np.array(values[5], dtype=float), "current": np.array(values[6], dtype=float),
+            "E_rms": float(values[7]), "alpha": float(values[8]), "beta": float(values[9]), "gamma": float(values[10])}
+    data["extra"] = dict(zip(titles[11:], values[11:]))
+    return data
+
+
+def beam_moments(position, momentum, I):
+    """
+    Raw moments of the current distribution. Moments are linear in I, so the moments of an averaged current matrix
+    are the average of the moments of the single matrices. That is what makes the bootstrap in Scan_Statistics cheap.
+
+    Parameters
+    ----------
+    position : numpy.ndarray
+        position array [m] (length n)
+    momentum : numpy.ndarray
+        momentum array [rad] (length m)
+    I : numpy.ndarray
+        current matrix of shape (m, n) or a stack of matrices of shape (..., m, n)
+
+    Returns
+    -------
+    S : numpy.ndarray
+        shape (..., 6): sum(I), sum(x*I), sum(x'*I), sum(x^2*I), sum(x'^2*I), sum(x*x'*I)
+
+    """
+    I = np.asarray(I, dtype=float)
+    I_x = I.sum(axis=-2) #summed over momentum, (..., n)
+    I_p = I.sum(axis=-1) #summed over position, (..., m)
+    return np.stack([I_x.sum(axis=-1),
+                     I_x@position,
+                     I_p@momentum,
+                     I_x@position**2,
+                     I_p@momentum**2,
+                     np.einsum('...ij,i,j->...', I, momentum, position)], axis=-1)
+
+
+def twiss_from_moments(S):
+    """
+    Calculates RMS emittance and Twiss parameters from the raw moments returned by beam_moments.
+    Works on single moment vectors as well as on stacks of them.
+
+    Parameters
+    ----------
+    S : numpy.ndarray
+        shape (..., 6)
+
+    Returns
+    -------
+    E_rms, alpha, beta, gamma : float or numpy.ndarray
+        same definitions as in Read_and_Analyze.emittance
+
+    """
+    S = np.asarray(S, dtype=float)
+    total = S[..., 0]
+    position_mean = S[..., 1]/total
+    momentum_mean = S[..., 2]/total
+    sigma_position_squared = S[..., 3]/total - position_mean**2
+    sigma_momentum_squared = S[..., 4]/total - momentum_mean**2
+    sigma_position_sigma_momentum = S[..., 5]/total - position_mean*momentum_mean
+    E_rms = np.sqrt(sigma_position_squared*sigma_momentum_squared-(sigma_position_sigma_momentum)**2)
+    alpha = -sigma_position_sigma_momentum/E_rms
+    beta = sigma_position_squared/E_rms
+    gamma = sigma_momentum_squared/E_rms
+    return E_rms, alpha, beta, gamma
+
+
+def time_resolved_emittance(filename, window=1, chunk=100, sample_time=0.02):
+    """
+    RMS emittance and Twiss parameters as a function of the time within the sampling window of each point, from a scan
+    that was measured with Read_and_Analyze.waveform = True. Sample k of every point is taken k*sample_time after the
+    plate voltage was set, so the current matrix of sample k shows the beam at that time (e.g. afterglow of a pulsed beam).
+    The waveform file is memory-mapped and processed in chunks of samples, so the memory use does not depend on its size.
+    In sparse scans, the unmeasured cells of every time bin are reconstructed from the sampling mask like the averaged
+    current matrix (see reconstruct_current); a larger window means fewer bins to reconstruct.
+
+    Parameters
+    ----------
+    filename : str
+        data file of the scan
+    window : int, optional
+        number of consecutive samples averaged into one time bin. The default is 1.
+    chunk : int, optional
+        time bins per chunk. The default is 100.
+    sample_time : float, optional
+        time between two samples [s]. The default is 0.02.
+
+    Returns
+    -------
+    t : numpy.ndarray
+        center time of every bin [s]
+    E_rms, alpha, beta, gamma : numpy.ndarray
+        per time bin, same definitions as in Read_and_Analyze.emittance
+
+    """
+    data = read_data_file(filename)
+    if "Waveform File" not in data["extra"]:
+        raise ValueError(f"{filename} was measured without waveform")
+    wave = np.load(data["extra"]["Waveform File"], mmap_mode='r') #(position, voltage, sample)
+    mask = data["extra"].get("Sampling Mask") #(voltage, position), sparse scans only
+    position = data["position"]*1e-3 #m
+    momentum = data["momentum"]*1e-3 #rad
+    bins = wave.shape[2]//window
+    S = np.zeros((bins, 6))
+    for start in range(0, bins, chunk):
+        stop = min(bins, start + chunk)
+        block = np.asarray(wave[:, :, start*window:stop*window], dtype=float)
+        block = block.reshape(block.shape[0], block.shape[1], stop-start, window).mean(axis=-1)
+        I = block.transpose(2, 1, 0) #(time, momentum, position)
+        if mask is not None: #unmeasured cells are 0 in the waveform file
+            I = np.array([reconstruct_current(I_t, np.array(mask, dtype=bool)) for I_t in I])
+        S[start:stop] = beam_moments(position, momentum, (abs(I) + I)/2) #negative currents to 0, as for the averaged matrix
+    t = (np.arange(bins) + 0.5)*window*sample_time
+    return (t,) + twiss_from_moments(S)
+
+
+def gaussian_beam(position, momentum, E_rms, alpha, beta, center=(0.0, 0.0), current=1e-6):
+    """
+    Current matrix of a beam with a Gaussian phase space distribution, e.g. the predicted beam of a scan
+    (from the Twiss parameters of a previous scan) or a simulated scan.
+
+    Parameters
+    ----------
+    position : numpy.ndarray
+        position array [m] (length n)
+    momentum : numpy.ndarray
+        momentum array [rad] (length m)
+    E_rms, alpha, beta : float
+        rms emittance [m rad] and Twiss parameters
+    center : tuple of float, optional
+        (position [m], momentum [rad]) of the beam center. The default is (0.0, 0.0).
+    current : float, optional
+        peak current [A]. The default is 1e-6.
+
+    Returns
+    -------
+    I : numpy.ndarray
+        shape (m, n)
+
+    """
+    gamma = (1 + alpha**2)/beta
+    x = position[np.newaxis, :] - center[0]
+    xp = momentum[:, np.newaxis] - center[1]
+    return current*np.exp(-(gamma*x**2 + 2*alpha*x*xp + beta*xp**2)/(2*E_rms))
+
+
+def sampling_mask(shape, fraction, mode="stratified", prior=None, seed=None):
+    """
+    Cells (voltage, position) of a sparse scan.
+        random      fraction of all cells, drawn uniformly
+        stratified  a third of the points on a jittered grid (one random cell per block, so no region is left out),
+                    the rest drawn with probability proportional to prior (predicted beam). Without prior, all points are on the jittered grid.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (voltages, positions)
+    fraction : float
+        fraction of the cells that are measured, in (0, 1]
+    mode : str, optional
+        "random" or "stratified". The default is "stratified".
+    prior : numpy.ndarray, optional
+        predicted current matrix of the scan, e.g. gaussian_beam with the Twiss parameters of a previous scan. The default is None.
+    seed : int, optional
+        The default is None.
+
+    Raises
+    ------
+    ValueError
+        unknown mode
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        bool, True for the cells that are measured
+
+    """
+    rng = np.random.default_rng(seed)
+    size = shape[0]*shape[1]
+    points = min(size, max(1, int(round(fraction*size))))
+    mask = np.zeros(size, dtype=bool)
+    if mode == "random":
+        mask[rng.choice(size, points, replace=False)] = True
+        return mask.reshape(shape)
+    if mode != "stratified":
+        raise ValueError(f"Unknown sampling mode {mode}")
+    grid = points if prior is None else max(1, points//3)
+    block = max(1.0, np.sqrt(size/grid)) #block edge [cells], one point per block
+    rows = np.unique(np.append(np.floor(np.arange(0, shape[0], block)).astype(int), shape[0])) #block edges
+    cols = np.unique(np.append(np.floor(np.arange(0, shape[1], block)).astype(int), shape[1]))
+    blocks = [(r, c) for r in range(len(rows)-1) for c in range(len(cols)-1)]
+    for b in rng.permutation(len(blocks))[:grid]:
+        r, c = blocks[b]
+        r = rng.integers(rows[r], rows[r+1])
+        c = rng.integers(cols[c], cols[c+1])
+        mask[r*shape[1] + c] = True
+    free = np.flatnonzero(~mask)
+    if prior is None:
+        weights = np.ones(len(free))
+    else:
+        weights = np.clip(np.asarray(prior, dtype=float).ravel()[free], 0, None)
+        weights += 0.01*weights.max() + 1e-300 #some points outside of the predicted beam, in case the beam moved
+    missing = points - mask.sum()
+    if missing > 0:
+        mask[rng.choice(free, missing, replace=False, p=weights/weights.sum())] = True
+    return mask.reshape(shape)
+
+
+def reconstruct_current(I, mask, smoothing=0.1, iterations=2000, tolerance=1e-8):
+    """
+    Full current matrix from the measured cells of a sparse scan. Solves
+        min |mask*(X - I)|^2 + smoothing*|L X|^2
+    with L the discrete Laplacian (zero slope at the edges) by conjugate gradients. The penalty on the curvature
+    fills the cells in between the measured ones smoothly, the measured cells are kept close to their values.
+
+    Parameters
+    ----------
+    I : numpy.ndarray
+        current matrix, only the cells in mask are used
+    mask : numpy.ndarray
+        bool, measured cells (see sampling_mask)
+    smoothing : float, optional
+        weight of the curvature penalty. Larger values smooth out noise, smaller values keep sharp edges. The default is 0.1.
+    iterations : int, optional
+        maximal number of iterations. The default is 2000.
+    tolerance : float, optional
+        relative residual at which the iteration stops. The default is 1e-8.
+
+    Returns
+    -------
+    X : numpy.ndarray
+        reconstructed current matrix, negative currents are set to 0 (as for measured columns)
+
+    """
+    mask = np.asarray(mask, dtype=bool)
+    scale = np.abs(I[mask]).max() if mask.any() else 0
+    if scale == 0:
+        return np.zeros(mask.shape)
+    b = np.where(mask, I, 0.0)/scale
+
+    def laplacian(X):
+        P = np.pad(X, 1, mode='edge')
+        return P[:-2, 1:-1] + P[2:, 1:-1] + P[1:-1, :-2] + P[1:-1, 2:] - 4*X
+
+    def A(X): #symmetric positive definite as long as one cell is measured
+        return mask*X + smoothing*laplacian(laplacian(X))
+
+    X = b.copy()
+    r = b - A(X)
+    p = r.copy()
+    rr = np.sum(r*r)
+    limit = tolerance**2*np.sum(b*b)
+    for k in range(iterations):
+        if rr <= limit:
+            break
+        Ap = A(p)
+        step = rr/np.sum(p*Ap)
+        X += step*p
+        r -= step*Ap
+        rr, rr_old = np.sum(r*r), rr
+        p = r + rr/rr_old*p
+    X = X*scale
+    return (abs(X) + X)/2
+
+
+def simulate_sparse_scan(position, momentum, E_rms, alpha, beta, fraction=0.25, mode="stratified", noise=0.01, prior_error=0.2,
+                         repeats=10, smoothing=0.1, seed=None):
+    """
+    Simulated sparse scans of a Gaussian beam: every repeat simulates a full scan (beam plus noise), measures only the cells of
+    a sampling mask, reconstructs the matrix and compares it with the full scan.
+
+    Parameters
+    ----------
+    position : numpy.ndarray
+        position array [mm]
+    momentum : numpy.ndarray
+        momentum array [mrad]
+    E_rms, alpha, beta : float
+        rms emittance [m rad] and Twiss parameters of the simulated beam
+    fraction : float, optional
+        fraction of measured cells. The default is 0.25.
+    mode : str, optional
+        sampling mode, see sampling_mask. The default is "stratified".
+    noise : float, optional
+        rms noise of a cell relative to the peak current. The default is 0.01.
+    prior_error : float, optional
+        relative error of the emittance and beta of the predicted beam that the stratified mask is built from. The default is 0.2.
+    repeats : int, optional
+        The default is 10.
+    smoothing : float, optional
+        see reconstruct_current. The default is 0.1.
+    seed : int, optional
+        The default is None.
+
+    Returns
+    -------
+    errors : dict
+        mean over the repeats of the reconstruction error against the full scan:
+        current (rms error relative to the peak current), E_rms, beta, gamma (relative errors) and alpha (absolute error)
+
+    """
+    rng = np.random.default_rng(seed)
+    position = np.asarray(position, dtype=float)*1e-3 #m
+    momentum = np.asarray(momentum, dtype=float)*1e-3 #rad
+    beam = gaussian_beam(position, momentum, E_rms, alpha, beta)
+    prior = gaussian_beam(position, momentum, E_rms*(1 + prior_error), alpha, beta*(1 - prior_error))
+    errors = {"current": [], "E_rms": [], "alpha": [], "beta": [], "gamma": []}
+    for r in range(repeats):
+        I = beam + noise*beam.max()*rng.standard_normal(beam.shape)
+        I = (abs(I) + I)/2 #as in finish_column
+        mask = sampling_mask(I.shape, fraction, mode, prior, seed=rng.integers(2**32))
+        X = reconstruct_current(I, mask, smoothing)
+        full = twiss_from_moments(beam_moments(position, momentum, I))
+        sparse = twiss_from_moments(beam_moments(position, momentum, X))
+        errors["current"].append(np.sqrt(np.mean((X - I)**2))/beam.max())
+        for name, f, s in zip(["E_rms", "alpha", "beta", "gamma"], full, sparse):
+            errors[name].append(abs(s - f) if name == "alpha" else abs(s/f - 1))
+    return {name: float(np.mean(values)) for name, values in errors.items()}
+
+
+def phase_space_data(filename, normalize=False):
+    """
+    Everything phase_space_plot draws, computed from a data file (no plotting, so it can run in a background thread).
+
+    Parameters
+    ----------
+    filename : str
+        data file
+    normalize : bool, optional
+        drift normalized current matrix and emittance (see Read_and_Analyze.normalize_drift), if the file has a
+        front shield current matrix. The default is False.
+
+    Returns
+    -------
+    plot : dict
+        beam_line, axis, I (current matrix [nA]), extent (image extent [mm, mrad]), E_rms [mm mrad], alpha, beta, gamma,
+        ellipse (x [mm] and x' [mrad] of the ellipse with area 4*E_rms)
+
+    """
+    data = read_data_file(filename)
+    position = data["position"] #mm
+    momentum = data["momentum"] #mrad
+    I = data["current"]*1e9 # unit nA
+    E_rms, A, B, G = data["E_rms"]*1e6, data["alpha"], data["beta"], data["gamma"] #convert to mm mrad
+    frontshield = data["extra"].get("Front Shield Current Matrix") if normalize else None
+    if frontshield is not None:
+        I = Read_and_Analyze.normalize_drift(I, frontshield)
+        E_rms, A, B, G = twiss_from_moments(beam_moments(position*1e-3, momentum*1e-3, I))
+        E_rms *= 1e6
+    theta = np.linspace(0, 2*np.pi, 100)
+    x_e = np.sqrt(4*E_rms*B)*np.cos(theta)
+    x_prime_e = -np.sqrt(4*E_rms/B)*(A*np.cos(theta)+np.sin(theta)) #parametrisizing the ellipse (Epsilon = 4*Epsilon_rms)  
+    m,n = I.shape
+    binlength_position = (max(position)-min(position))/n
+    binlength_momentum = (max(momentum)-min(momentum))/m
+    extent = (min(position)-binlength_position/2, max(position)+binlength_position/2, min(momentum)-binlength_momentum/2, max(momentum)+binlength_momentum/2)
+    return {"beam_line": data["beam_line"], "axis": data["axis"], "I": I, "extent": extent,
+            "E_rms": E_rms, "alpha": A, "beta": B, "gamma": G, "ellipse": (x_e, x_prime_e)}
+
+
+class Settle_Model:
+    def __init__(self, dead_time=0.01, slew_time=0.0, tau=0.0, tolerance=0.001):
+        """
+        Time the plate voltage needs to settle after a DAC step of size dV:
+            t(dV) = dead_time + slew_time*dV + tau*ln(dV/tolerance)   (last term only for dV > tolerance)
+        i.e. a fixed delay, a slew-rate limited part of the amplifier and an exponential (RC) tail.
+        The default (0.01 s, no step dependence) is the delay that was used before a calibration existed.
+
+        Parameters
+        ----------
+        dead_time : float, optional
+            [s]. The default is 0.01.
+        slew_time : float, optional
+            [s/V] (DAC Volts). The default is 0.
+        tau : float, optional
+            time constant of the exponential tail [s]. The default is 0.
+        tolerance : float, optional
+            settling band [V] (DAC Volts). The default is 0.001.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.dead_time = dead_time
+        self.slew_time = slew_time
+        self.tau = tau
+        self.tolerance = tolerance
+
+    def features(self, step):
+        step = np.abs(np.asarray(step, dtype=float))
+        return np.stack([np.ones_like(step), step, np.log(np.maximum(step/self.tolerance, 1))], axis=-1)
+
+    def delay(self, step):
+        """
+        Returns
+        -------
+        float
+            settling time [s] after a DAC step of size step [V]
+        """
+        return float(self.features(step)@np.array([self.dead_time, self.slew_time, self.tau]))
+
+    def fit(self, steps, times):
+        """
+        Least squares fit of the model to measured settling times. Negative coefficients are set to 0.
+
+        Parameters
+        ----------
+        steps : array
+            step sizes [V]
+        times : array
+            measured settling times [s]
+
+        Returns
+        -------
+        None.
+
+        """
+        coefficients = np.linalg.lstsq(self.features(steps), np.asarray(times, dtype=float), rcond=None)[0]
+        self.dead_time, self.slew_time, self.tau = (float(c) for c in np.maximum(coefficients, 0))
+
+    @staticmethod
+    def setup_key(device, output, readback):
+        return f"{device} {output}->{readback}"
+
+    def save(self, key, file_name="Emittance_Scanner_Settle_Model.json"):
+        """
+        Stores the model under the setup key (device, DAC and readback channel) in the cache file.
+        The file is written to a temporary file first and then replaced, so it is never half written.
+        """
+        models = {}
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                models = json.load(f)
+        models[key] = dict(vars(self), calibrated=datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss"))
+        with open(file_name + ".tmp", 'w') as f:
+            json.dump(models, f, indent=1)
+        os.replace(file_name + ".tmp", file_name)
+
+    @classmethod
+    def load(cls, key, file_name="Emittance_Scanner_Settle_Model.json"):
+        """
+        Returns
+        -------
+        Settle_Model
+            the cached model of this setup, or the default model if the setup has not been calibrated
+        """
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                models = json.load(f)
+            if key in models:
+                return cls(**{name: models[key][name] for name in ["dead_time", "slew_time", "tau", "tolerance"]})
+        return cls()
+
+
+class Scan_Time_Estimator:
+    def __init__(self, planner=None, file_name="Emittance_Scanner_Timing.json"):
+        """
+        Predicts how long a scan takes from the grid (positions, voltages, samples), the planned moves (Motion_Planner),
+        the plate voltage settling (Settle_Model) and two latencies that are learned from past scans and kept in file_name:
+            sample_time     time per sample (sampling delay + LabJack request)
+            move_overhead   time per column move on top of the planned move time (controller round trips for drive, move and polling)
+
+        Parameters
+        ----------
+        planner : Motion_Planner, optional
+            The default is a new Motion_Planner.
+        file_name : str, optional
+            The default is "Emittance_Scanner_Timing.json".
+
+        Returns
+        -------
+        None.
+
+        """
+        self.planner = Motion_Planner() if planner is None else planner
+        self.file_name = file_name
+        self.sample_time = 0.021 #s, 0.02s delay between samples + request
+        self.move_overhead = 0.5 #s per column
+        self.scan_overhead = 5.0 #s per scan (journal, data file, centering of an axis that is already centered)
+        self.weight = 0.3 #weight of a new scan in the learned latencies (exponential average)
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name) as f:
+                    timing = json.load(f)
+            except ValueError:
+                return
+            self.sample_time = timing.get("sample_time", self.sample_time)
+            self.move_overhead = timing.get("move_overhead", self.move_overhead)
+
+    def save(self):
+        timing = {"sample_time": self.sample_time, "move_overhead": self.move_overhead, "time": datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss")}
+        with open(self.file_name + ".tmp", 'w') as f:
+            json.dump(timing, f)
+        os.replace(self.file_name + ".tmp", self.file_name)
+
+    def move_times(self, position, axis=0, start=0.0):
+        """
+        Returns
+        -------
+        numpy.ndarray
+            planned time [s] of the move to each position (from the previous one, the first from start), without overhead
+        """
+        steps = np.diff(np.concatenate([[start], position]))
+        return np.array([self.planner.plan(step, axis)[3] for step in steps])
+
+    def column_time(self, V, samples=2000, settle=None):
+        """
+        Returns
+        -------
+        float
+            time [s] to measure one column of plate voltages V (LabJack output) without the move
+        """
+        settle = Settle_Model() if settle is None else settle
+        return sum(settle.delay(step) for step in np.diff(V)) + len(V)*samples*self.sample_time
+
+    def column_times(self, position, V, axis=0, samples=2000, settle=None, start=0.0):
+        """
+        Returns
+        -------
+        numpy.ndarray
+            predicted time [s] of every column including its move
+        """
+        return self.move_times(position, axis, start) + self.move_overhead + self.column_time(V, samples, settle)
+
+    def estimate(self, Variables_instance, axis, scans=1, samples=2000, settle=None, sampling=1.0):
+        """
+        Predicted duration of scans on axis with the grid of Variables_instance, including the retraction at the end.
+
+        Parameters
+        ----------
+        Variables_instance : Variables
+        axis : int
+            in [0,1,2,3]
+        scans : int, optional
+            The default is 1.
+        samples : int, optional
+            samples per point. The default is 2000.
+        settle : Settle_Model, optional
+            The default is the uncalibrated model.
+        sampling : float, optional
+            fraction of measured cells of a sparse scan (Read_and_Analyze.sampling). The default is 1.0.
+
+        Returns
+        -------
+        float
+            [s]
+
+        """
+        Var = Variables_instance
+        if axis%2 == 0:
+            position = np.arange(Var.x_min, Var.x_max+Var.x_step, Var.x_step)
+            momentum = np.arange(Var.xp_min, Var.xp_step+Var.xp_max, Var.xp_step)
+        else:
+            position = np.arange(Var.y_min, Var.y_step+Var.y_max, Var.y_step)
+            momentum = np.arange(Var.yp_min, Var.yp_step+Var.yp_max, Var.yp_step)
+        V = Var.get_V(momentum*1e-3)/100
+        acquisition = (1 - sampling)*len(position)*self.column_time(V, samples, settle) #not measured in sparse scans; most columns are still driven to
+        first = self.column_times(position, V, axis, samples, settle).sum() - acquisition #from the center
+        repeated = self.column_times(position, V, axis, samples, settle, start=position[-1]).sum() - acquisition #from the end of the previous scan
+        retract = self.move_times([200], axis, start=position[-1])[0] + self.move_overhead
+        return first + (scans - 1)*repeated + scans*self.scan_overhead + retract
+
+    def eta(self, predicted, measured, elapsed):
+        """
+        Remaining time of a running scan: the prediction of the remaining columns, scaled by how fast the measured columns
+        were compared to their prediction.
+
+        Parameters
+        ----------
+        predicted : numpy.ndarray
+            predicted time of all columns of this run [s]
+        measured : int
+            number of measured columns
+        elapsed : float
+            time since the start of the run [s]
+
+        Returns
+        -------
+        float
+            [s]
+
+        """
+        done = predicted[:measured].sum()
+        ratio = elapsed/done if done > 0 and measured > 0 else 1
+        return float(ratio*predicted[measured:].sum())
+
+    def learn(self, moves, planned_moves, acquisitions, settle_times, samples):
+        """
+        Updates the latencies with the timing of the columns of a scan and saves them.
+
+        Parameters
+        ----------
+        moves : list of float
+            measured duration of every column move [s]
+        planned_moves : list of float
+            planned duration of the same moves (move_times) [s]
+        acquisitions : list of float
+            measured duration of the acquisition of every column [s]
+        settle_times : float
+            total settling delay of one column [s]
+        samples : int
+            number of samples of one column (voltages*samples per voltage)
+
+        Returns
+        -------
+        None.
+
+        """
+        if not moves:
+            return
+        move_overhead = max(0.0, float(np.median(np.array(moves) - np.array(planned_moves))))
+        sample_time = max(0.0, (float(np.median(acquisitions)) - settle_times)/samples)
+        self.move_overhead += self.weight*(move_overhead - self.move_overhead)
+        self.sample_time += self.weight*(sample_time - self.sample_time)
+        self.save()
+
+
+class Read_and_Analyze:
+    listeners = [] #callables that get every progress event of every scan (e.g. the GUI's ETA)
+    status_listeners = [] #listeners that also show the axis' drive and fault bits (e.g. Emittance_monitor.Scan_Snapshot.update); only they make the events query the controller
+    
+    def __init__(self, Variables_instance, Motor_instance=None):
+        """
+        Initiates the analysing class. Initates a Variables and Motor instance.
+        Without Motor instance (offline), only the analysis methods (emittance, phase_space_plot, ...) can be used.
+        creates arrays for the positions x and y and the momenta x' and y'
+
+        Parameters
+        ----------
+        Variables_instance : object
+            instance of Variables() class
+        Motor_instance : object, optional
+            instance of Motor() class. The default is None (offline analysis).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.Var = Variables_instance
+        self.Mot = Motor_instance
+        self.x = np.arange(self.Var.x_min, self.Var.x_max+self.Var.x_step, self.Var.x_step) #x-array
+        self.y = np.arange(self.Var.y_min, self.Var.y_step + self.Var.y_max, self.Var.y_step) #y-array
+        self.x_prime = np.arange(self.Var.xp_min,self.Var.xp_step + self.Var.xp_max, self.Var.xp_step) #x' array
+        self.y_prime = np.arange(self.Var.yp_min, self.Var.yp_step + self.Var.yp_max, self.Var.yp_step) # y' array
+        self.device = "ANY" #LabJack identifier (serial number, IP or name). Each beam line needs its own device when both are scanned at the same time
+        self.Voltagecurrentfactor = 1e8 if Motor_instance is None else Motor_instance.Voltagecurrentfactor #V/A Scan cup gain used for this scan
+        self.frontshield_gain = 1e8 if Motor_instance is None else Motor_instance.frontshield_gain #V/A front shield gain used for this scan
+        self.frontshield = "AIN2" #!!! input of the front shield amplifier, read together with AIN0 at every sample. None to not measure it
+        self.readback = "AIN1" #!!! input that sees the (divided down) plate voltage, only used by calibrate_settle_time
+        self.ljm = None #LabJack library, imported on first use. Can be set to an object with the same functions, e.g. a simulated device
+        self.estimator = Scan_Time_Estimator(None if Motor_instance is None else Motor_instance.planner) #scan duration and ETA
+        self.gains = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11] #V/A gain settings of the Keithley 428
+        self.saturation_voltage = 9.8 #V, Keithley 428 output (AIN0) is limited to +-10V; readings above this count as saturated
+        self.saturation_limit = 0.01 #fraction of saturated samples at one point that stops the scan
+        self.samples = 2000 #samples per plate voltage
+        self.sample_delay = 0.02 #s between two samples
+        self.settle = None #Settle_Model for the plate voltage steps, None loads the calibrated model of the setup (see calibrate_settle_time)
+        self.waveform = False #if True, every single sample is kept in a memory-mapped .npy file next to the data file (see time_resolved_emittance)
+        self.sampling = 1.0 #fraction of the (position, voltage) cells that are measured. Below 1 the rest is reconstructed (see reconstruct_current)
+        self.sampling_mode = "stratified" #see sampling_mask
+        self.prior = None #predicted current matrix for stratified sampling, e.g. gaussian_beam with the Twiss parameters of the last scan
+        self.stop_event = None #threading.Event; once it is set, the scan stops with a FatalError before the next column (the journal is kept)
+        self.controller_program = False #if True, the controller walks the positions (Motor.start_scan_program) and Python only sets the DAC, acquires and acknowledges each column
+        
+        
     def get_current(self, axis):
         """
         Calculates the Voltage from the momentum array. Then iterates through each positions of the position array.
         At each position it iterates through different plate voltages and measures Scan Cup Voltage for each Plate Voltage.
         Scan Cup Voltage measurement is turned to current by dividing through scan cup gain
         
+        Every finished column is appended to a journal file ("Emittance_Scanner_Data_... .journal") right away.
+        If the scan is interrupted (e.g. lost connection, FatalError, KeyboardInterrupt), it can be continued from the
+        last complete column with Read_and_Analyze.resume(journal_name, Motor_instance).
+        
+        With self.sampling < 1 only the cells of a sampling mask are measured (columns without cells are not driven to)
+        and the current matrix is reconstructed from them when the scan is assembled.
+        
         Input
         -------
         axis: int
@@ -491,38 +2417,662 @@ class Read_and_Analyze:
         
         """
        
+        journal_name = self.start_journal(axis)
+        self.measure_columns(axis, journal_name)
+        return self.assemble(journal_name)
+
+    def start_journal(self, axis):
+        """
+        Creates the journal of a new scan. Its first line holds everything needed to measure, continue and save the scan.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+
+        Returns
+        -------
+        journal_name : str
+
+        """
         position = [self.x, self.y][axis%2] #mm
         momentum = [self.x_prime, self.y_prime][axis%2] #mrad
         V = self.Var.get_V(momentum*1e-3)/100 #this is output from labjack which is amplified bz a factor of 100
-        m = len(V)
-        n = len(position)
-        I = np.zeros((m,n))
-        handle = ljm.openS("T8","usb","ANY")
+        base = create_file("Emittance_Scanner_Data_", f" {['Venus_x_', 'Venus_y_', 'AECR_x_', 'AECR_y_'][axis]}", ".journal", related=(".txt", ".npy"))
+        file_name = base + ".txt"
+        journal_name = base + ".journal"
+        waveform_name = None
+        if self.waveform: #positions x voltages x samples, written column by column; the file is created sparse, nothing is held in memory
+            waveform_name = file_name[:-4] + ".npy"
+            np.lib.format.open_memmap(waveform_name, mode='w+', dtype=np.float32, shape=(len(position), len(V), self.samples)).flush()
+        mask = None
+        if self.sampling < 1: #sparse scan, the mask is part of the journal so a resumed scan measures the same cells
+            mask = sampling_mask((len(V), len(position)), self.sampling, self.sampling_mode, self.prior).astype(int).tolist()
+        header = {"file_name": file_name, "axis": axis, "device": self.device, "gain": self.Voltagecurrentfactor,
+                  "attributes": dict(vars(self.Var)), "variables": self.variables(),
+                  "position": position.tolist(), "momentum": momentum.tolist(), "voltage": V.tolist(),
+                  "samples": self.samples, "waveform": waveform_name, "frontshield": self.frontshield, "frontshield_gain": self.frontshield_gain, "mask": mask}
+        with open(journal_name, 'w') as f: #first line of the journal: everything needed to continue the scan
+            f.write(json.dumps(header) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return journal_name
+
+    def variables(self):
+        """
+        Returns
+        -------
+        variables : dict
+            the Variables as they are stored in the data files
+        """
+        return {"Maximal x' [mrad]": self.Var.xp_max,"Minimal x' [mrad]":self.Var.xp_min, "Minimal y' [mrad]":self.Var.yp_min, "Maximal y' [mrad]":self.Var.yp_max, "Maximal x [mm]":self.Var.x_max, "Minimal x [mm]":self.Var.x_min, "Maximal y [mm]":self.Var.y_max, "Minimal y [mm]":self.Var.y_min,
+                "Charge Number Q": self.Var.Q, "Mass Number M":self.Var.M,"Extraction Voltage U [V]":self.Var.V_extr, "x' Step Size [mrad]":self.Var.xp_step,
+                "y' Step Size [mrad]":self.Var.yp_step, "x Step Size [mm]":self.Var.x_step, "y Step Size [mm]":self.Var.y_step}
+
+    @classmethod
+    def from_data_file(cls, filename):
+        """
+        Offline Read_and_Analyze (no Motor, no LabJack) with the Variables a data file was measured with,
+        e.g. to analyse or plot old data on a computer without the hardware.
+
+        Parameters
+        ----------
+        filename : str
+            data file
+
+        Returns
+        -------
+        RnA : Read_and_Analyze
+
+        """
+        V = Variables()
+        names = {"Maximal x' [mrad]": "xp_max", "Minimal x' [mrad]": "xp_min", "Minimal y' [mrad]": "yp_min", "Maximal y' [mrad]": "yp_max",
+                 "Maximal x [mm]": "x_max", "Minimal x [mm]": "x_min", "Maximal y [mm]": "y_max", "Minimal y [mm]": "y_min",
+                 "Charge Number Q": "Q", "Mass Number M": "M", "Extraction Voltage U [V]": "V_extr", "x' Step Size [mrad]": "xp_step",
+                 "y' Step Size [mrad]": "yp_step", "x Step Size [mm]": "x_step", "y Step Size [mm]": "y_step"}
+        for label, value in read_data_file(filename)["variables"].items():
+            if label in names:
+                setattr(V, names[label], value)
+        return cls(V)
+
+    @staticmethod
+    def read_journal(journal_name, key="current"):
+        """
+        Reads a scan journal.
+
+        Parameters
+        ----------
+        journal_name : str
+            journal file written by get_current
+        key : str, optional
+            "current" (scan cup) or "frontshield". The default is "current".
+
+        Returns
+        -------
+        header : dict
+            scan settings (first line of the journal)
+        columns : dict
+            {column index: current column} of all complete columns. A column that was only partly written when the program stopped is ignored.
+
+        """
+        columns = {}
+        with open(journal_name) as f:
+            header = json.loads(f.readline())
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #incomplete last line
+                    continue
+                if key in entry:
+                    columns[entry["column"]] = entry[key]
+        return header, columns
+
+    @staticmethod
+    def repair_journal(journal_name):
+        """
+        Cuts an incomplete last line off the journal (the program stopped while a column was written), so the next column
+        is appended on a line of its own instead of to the broken one.
+
+        Parameters
+        ----------
+        journal_name : str
+            journal file written by get_current
+
+        Returns
+        -------
+        None.
+
+        """
+        with open(journal_name, 'rb+') as f:
+            end = f.read().rfind(b"\n") + 1 #end of the last complete line
+            if end < f.tell():
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+    def measure_columns(self, axis, journal_name):
+        """
+        Measures all columns that are not yet in the journal and appends each column to the journal as soon as it is measured.
+        The loop is pipelined, so the time between two columns is mostly the mechanical move:
+        - the DAC is set to the first voltage of the next column before the axis moves, so the plate voltage settles during the move
+        - noise clipping, the journal write (flushed to disk) and the progress event of a column run in a worker thread while
+          the axis moves to the next column
+        In sparse scans, only the voltages of the sampling mask are measured; unmeasured cells are 0 in the journal.
+        With self.controller_program, the moves are made by the controller scan program, which waits at every point until the column is acknowledged.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        journal_name : str
+            journal file of the scan
+
+        Returns
+        -------
+        None.
+
+        """
+        self.Mot.run_steps(self.measure_columns_steps(axis, journal_name))
+
+    def measure_columns_steps(self, axis, journal_name):
+        """Steps of measure_columns (see Motor.run_steps)."""
+        header, columns = self.read_journal(journal_name)
+        position = np.array(header["position"]) #mm
+        V = np.array(header["voltage"])
+        I = np.zeros((len(V), len(position))) #partial current matrix for the progress events
+        for n, column in columns.items():
+            I[:,n] = column
+        todo = [n for n in range(len(position)) if n not in columns] #columns not measured before the scan was interrupted
+        mask = np.ones((len(V), len(position)), dtype=bool) if header.get("mask") is None else np.array(header["mask"], dtype=bool)
+        active = mask[:, todo].any(axis=0) #columns with at least one cell to measure
+        samples = header.get("samples", 2000)
+        channels = ["AIN0"] + ([header["frontshield"]] if header.get("frontshield") else []) #!!! scan cup (and front shield) are read in one request, so the front shield costs no time
+        frontshield_gain = header.get("frontshield_gain", self.frontshield_gain)
+        wave = raw = None
+        if header.get("waveform"):
+            wave = np.load(header["waveform"], mmap_mode='r+') #single samples as current [A], (position, voltage, sample)
+            raw = np.zeros((len(V), samples), dtype=np.float32) #one column, written to the file when the column is done
+        start = time.time()
+        ljm = self.ljm or load_ljm()
+        handle = yield ("call", ljm.openS, "T8", "usb", self.device)
         output = "DAC1" #!!!
-        Input = "AIN0" #!!!
-        delay = 0.01 #need to figure out the delay
-        for i in position:
-            self.Mot.move_to(i, axis)
-            I_ = np.array([])
-            for j in V: 
+        settle = self.settle or Settle_Model.load(Settle_Model.setup_key(self.device, output, self.readback)) #delay depends on the step size, see calibrate_settle_time
+        planned = self.estimator.move_times(np.array(position[todo])[active], axis, self.Mot.targets[axis] or 0.0)
+        predicted = np.zeros(len(todo)) #for the ETA
+        predicted[active] = planned + self.estimator.move_overhead
+        predicted += self.estimator.column_time(V, samples, settle)*mask[:, todo].mean(axis=0)
+        moves, acquisitions = [], [] #measured timing, to improve the next predictions
+        worker = ThreadPoolExecutor(max_workers=1, initializer=self.Mot.select_program, initargs=(self.Mot.program.get(),)) #one worker keeps the columns in order
+        previous = None
+        program = self.controller_program and active.any()
+        self.repair_journal(journal_name)
+        journal = open(journal_name, 'a')
+        role = Command_Metrics.role.set("scan")
+        try:
+            if program:
+                yield ("call", self.Mot.start_scan_program, axis, np.array(position[todo])[active])
+            for measured, n in enumerate(todo):
+                if self.stop_event is not None and self.stop_event.is_set():
+                    raise FatalError("Scan stopped")
+                rows = np.flatnonzero(mask[:, n])
+                if len(rows) == 0: #sparse scan, nothing to measure in this column, the axis is not moved
+                    I_ = np.zeros(len(V))
+                    F_ = np.zeros(len(V)) if len(channels) > 1 else None #front shield current
+                    if previous is not None:
+                        yield ("wait", [previous])
+                        previous.result()
+                    previous = worker.submit(self.finish_column, axis, journal, I, n, I_, F_, column=n, columns=len(position), position=float(position[n]),
+                                             ETA=self.estimator.eta(predicted, measured+1, time.time()-start))
+                    continue
+                if wave is not None:
+                    raw[:] = 0 #unmeasured cells of a sparse column stay 0, not the samples of the previous column
                 #two 1.5V batteries drop the Voltage. Labjack can only output from 0-10
-                ljm.eWriteName(handle, output, j+3.188) #according to measurements from Powersupply Voltagedrop is approx. 3.188V
-                time.sleep(delay) #!!!delay for some time so that signal can reach capacitor
-                current = 0
-                for k in range(2000): #take 2000 samples
-                    current += ljm.eReadName(handle, Input)/self.Mot.Voltagecurrentfactor #actually reading voltage that depends on current
-                    time.sleep(0.02) #LabView Program took 2000 samples at a sampling rate of 1000000S/s, so 0.02s in between samples
-                current *= -1/2000 #minus because of inverting output on keithley 428
-                current = (abs(I_) + I_)/2 #turns negative currents to 0 (non physical; noise)
-                I_ = np.append(I, current) # append the everage current                   
-            I[:,i] = I_ #columns = position, rows = Voltage
-        ljm.close(handle)
-        variables = {"Maximal x' [mrad]": self.Var.xp_max,"Minimal x' [mrad]":self.Var.xp_min, "Minimal y' [mrad]":self.Var.yp_min, "Maximal y' [mrad]":self.Var.yp_max, "Maximal x [mm]":self.Var.x_max, "Minimal x [mm]":self.Var.x_min, "Maximal y [mm]":self.Var.y_max, "Minimal y [mm]":self.Var.y_min,
-                     "Charge Number Q": self.Var.Q, "Mass Number M":self.Var.M,"Extraction Voltage U [V]":self.Var.V_extr, "x' Step Size [mrad]":self.Var.xp_step,
-                     "y' Step Size [mrad]":self.Var.yp_step, "x Step Size [mm]":self.Var.x_step, "y Step Size [mm]":self.Var.y_step}
-        Date_Time = datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss")
+                yield ("call", ljm.eWriteName, handle, output, V[rows[0]]+3.188) #first voltage of the column is set before the move; the move takes much longer than the delay
+                t0 = time.time()
+                if program:
+                    yield from self.Mot.wait_scan_point_steps(axis, position[n])
+                else:
+                    yield from self.Mot.move_to_steps(position[n], axis)
+                t1 = time.time()
+                I_, F_ = yield from self.acquire_column_steps(ljm, handle, V, rows, settle, samples, channels, frontshield_gain, position[n], raw, output)
+                if program:
+                    yield from self.Mot.acknowledge_scan_point_steps(axis) #the controller moves on while the column is post-processed
+                moves.append(t1 - t0)
+                acquisitions.append(time.time() - t1)
+                if wave is not None:
+                    wave[n] = raw
+                    wave.flush() #on disk before the column is in the journal
+                if previous is not None:
+                    yield ("wait", [previous])
+                    previous.result() #raises errors of the previous column's post-processing
+                previous = worker.submit(self.finish_column, axis, journal, I, n, I_, F_, column=n, columns=len(position), position=float(position[n]),
+                                         ETA=self.estimator.eta(predicted, measured+1, time.time()-start))
+            if previous is not None:
+                yield ("wait", [previous])
+                previous.result()
+            if mask.all() and not program: #only completed scans: the acquisition time of sparse columns depends on their cells, program moves include the handshake, failed scans have unusual timing
+                self.estimator.learn(moves, planned[:len(moves)], acquisitions, self.estimator.column_time(V, 0, settle), len(V)*samples)
+        except (Exception, KeyboardInterrupt):
+            print(f"Scan interrupted. The measured columns are kept in {journal_name}")
+            if program:
+                yield from self.Mot.stop_steps(axis)
+            raise
+        finally:
+            if previous is not None:
+                yield ("wait", [previous]) #the last measured column is written before the journal is closed
+            worker.shutdown()
+            journal.close()
+            yield ("call", ljm.close, handle)
+            if program:
+                yield ("call", self.Mot.end_scan_program, axis)
+            elif self.Mot.centered[axis]:
+                yield ("call", self.Mot.save_state, axis) #once per scan, not after every column
+            Command_Metrics.role.reset(role)
+
+    def acquire_column_steps(self, ljm, handle, V, rows, settle, samples, channels, frontshield_gain, position, raw=None, output="DAC1"):
+        """
+        Steps (see Motor.run_steps) that go through the plate voltages V[rows] of one column and average the current at each voltage.
+        The first voltage is expected to be set already (before the move).
+
+        Parameters
+        ----------
+        ljm : module
+            LabJack library (see self.ljm)
+        handle : int
+            LabJack handle
+        V : numpy.ndarray
+            plate voltages of the scan (LabJack output before the +3.188V offset)
+        rows : numpy.ndarray
+            indices of the voltages that are measured (all of them, except in sparse scans)
+        settle : Settle_Model
+        samples : int
+            samples per voltage
+        channels : list of str
+            scan cup input, followed by the front shield input if it is read
+        frontshield_gain : float
+            V/A
+        position : float
+            position of the column [mm], for the saturation error
+        raw : numpy.ndarray, optional
+            (voltages, samples) array that is filled with the single samples as current [A]. The default is None.
+        output : str, optional
+            DAC of the plate voltage. The default is "DAC1".
+
+        Raises
+        ------
+        SaturationError
+            see check_saturation
+
+        Returns
+        -------
+        I_ : numpy.ndarray
+            averaged currents of the column, 0 for the voltages that are not measured
+        F_ : numpy.ndarray or None
+            averaged front shield currents, None if the front shield is not read
+
+        """
+        I_ = np.zeros(len(V))
+        F_ = np.zeros(len(V)) if len(channels) > 1 else None #front shield current
+        for i, l in enumerate(rows):
+            j = V[l]
+            if i > 0:
+                yield ("call", ljm.eWriteName, handle, output, j+3.188) #according to measurements from Powersupply Voltagedrop is approx. 3.188V
+                yield ("sleep", settle.delay(j - V[rows[i-1]])) #delay for some time so that signal can reach capacitor
+            current, shield, saturated = yield ("call", self.read_samples, ljm, handle, channels, samples, None if raw is None else raw[l])
+            I_[l] = current*(-1/samples) #minus because of inverting output on keithley 428
+            if F_ is not None:
+                F_[l] = -shield/samples/frontshield_gain
+            self.check_saturation(saturated, samples, position, j)
+        return I_, F_
+
+    def read_samples(self, ljm, handle, channels, samples, raw=None):
+        """
+        Takes the samples of one plate voltage, sample_delay apart. Blocking; it is a "call" step of acquire_column_steps,
+        so the asynchronous scan runs it in a thread (see Motor.run_steps).
+
+        Parameters
+        ----------
+        ljm : module
+            LabJack library (see self.ljm)
+        handle : int
+            LabJack handle
+        channels : list of str
+            scan cup input, followed by the front shield input if it is read
+        samples : int
+        raw : numpy.ndarray, optional
+            (samples,) array that is filled with the single samples as current [A]. The default is None.
+
+        Returns
+        -------
+        current : float
+            sum of the scan cup samples [A] (not yet inverted)
+        shield : float
+            sum of the readings of the last channel [V]
+        saturated : int
+            number of samples at the end of the input range
+
+        """
+        current = 0
+        shield = 0
+        saturated = 0
+        for k in range(samples): #take 2000 samples (default)
+            readings = ljm.eReadNames(handle, len(channels), channels)
+            reading = readings[0]
+            shield += readings[-1]
+            saturated += abs(reading) >= self.saturation_voltage
+            sample = reading/self.Voltagecurrentfactor #actually reading voltage that depends on current
+            current += sample
+            if raw is not None:
+                raw[k] = -sample
+            time.sleep(self.sample_delay) #LabView Program took 2000 samples at a sampling rate of 1000000S/s, so 0.02s in between samples
+        return current, shield, saturated
+
+    def check_saturation(self, saturated, samples, position, voltage):
+        """
+        Stops the scan if too many samples of a point were at the end of the input range: the result would be wrong,
+        so there is no point in measuring the remaining columns. The measured columns stay in the journal.
+
+        Parameters
+        ----------
+        saturated : int
+            number of saturated samples at this point
+        samples : int
+            number of samples at this point
+        position : float
+            [mm]
+        voltage : float
+            plate voltage (LabJack output) [V]
+
+        Raises
+        ------
+        SaturationError
+            if more than self.saturation_limit of the samples are saturated
+
+        """
+        if saturated > self.saturation_limit*samples:
+            raise SaturationError(f"Scan cup signal saturated at {position:.2f} mm, {voltage*100:.1f} V plate voltage ({saturated}/{samples} samples). "
+                                  f"Gain {self.Voltagecurrentfactor:.0e} V/A is too high, see auto_gain.")
+
+    def auto_gain(self, axis, points=5, voltages=9, samples=50):
+        """
+        Quick pre-scan to choose the Keithley 428 gain: measures a few points through the core of the scan range (middle half of the
+        positions, voltages spread over the whole momentum range) with few samples, at the gain that is currently set on the Keithley
+        (self.Voltagecurrentfactor), and recommends the gain that maximises the dynamic range (see recommend_gain).
+        The axis has to be centered. The gain cannot be set from here, it has to be set on the device.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        points : int, optional
+            number of positions. The default is 5.
+        voltages : int, optional
+            number of plate voltages per position. The default is 9.
+        samples : int, optional
+            samples per point, taken as fast as possible. The default is 50.
+
+        Returns
+        -------
+        result : dict
+            see recommend_gain
+
+        """
+        position = [self.x, self.y][axis%2] #mm
+        momentum = [self.x_prime, self.y_prime][axis%2] #mrad
+        V = self.Var.get_V(momentum*1e-3)/100
+        core = position[len(position)//4:len(position) - len(position)//4]
+        if len(core) == 0:
+            core = position
+        core = core[np.unique(np.linspace(0, len(core)-1, points).round().astype(int))]
+        V = V[np.unique(np.linspace(0, len(V)-1, voltages).round().astype(int))]
+        ljm = self.ljm or load_ljm()
+        handle = ljm.openS("T8","usb",self.device)
+        output = "DAC1" #!!!
+        Input = "AIN0" #!!!
+        settle = self.settle or Settle_Model.load(Settle_Model.setup_key(self.device, output, self.readback))
+        peak = 0
+        noise = []
+        try:
+            for p in core:
+                ljm.eWriteName(handle, output, V[0]+3.188)
+                self.Mot.move_to(p, axis, save=False)
+                for l, j in enumerate(V):
+                    if l > 0:
+                        ljm.eWriteName(handle, output, j+3.188)
+                        time.sleep(settle.delay(j - V[l-1]))
+                    readings = np.array([ljm.eReadName(handle, Input) for k in range(samples)])
+                    peak = max(peak, np.abs(readings).max())
+                    noise.append(readings.std())
+        finally:
+            ljm.eWriteName(handle, output, 3.188) #plate voltage back to 0
+            ljm.close(handle)
+            if self.Mot.centered[axis]:
+                self.Mot.save_state(axis) #once, not after every point
+        return self.recommend_gain(peak, np.median(noise))
+
+    def recommend_gain(self, peak, noise, headroom=0.7):
+        """
+        Chooses the highest gain at which the peak signal stays below headroom*saturation_voltage. The AIN noise does not
+        depend on the gain, so the highest gain without saturation gives the best dynamic range.
+
+        Parameters
+        ----------
+        peak : float
+            largest absolute reading [V] at the current gain
+        noise : float
+            typical standard deviation of the readings at one point [V] at the current gain
+        headroom : float, optional
+            fraction of the input range the peak may use (beam fluctuations). The default is 0.7.
+
+        Returns
+        -------
+        result : dict
+            gain: recommended gain [V/A]
+            saturated: True if the pre-scan itself saturated; the peak is then unknown and the recommended gain is 100x lower
+                       than the current one, and the pre-scan should be repeated with it
+            peak_current, noise_current: [A]
+            peak_voltage: expected peak reading at the recommended gain [V]
+            signal_to_noise: peak/noise
+
+        """
+        gain = self.Voltagecurrentfactor
+        peak, noise = float(peak), float(noise)
+        peak_current = peak/gain
+        noise_current = noise/gain
+        saturated = peak >= self.saturation_voltage
+        if saturated:
+            recommended = max([g for g in self.gains if g <= gain/100] or [min(self.gains)])
+        else:
+            recommended = max([g for g in self.gains if peak_current*g <= headroom*self.saturation_voltage] or [min(self.gains)])
+        return {"gain": recommended, "saturated": bool(saturated), "peak_current": peak_current, "noise_current": noise_current,
+                "peak_voltage": peak_current*recommended, "signal_to_noise": peak/noise if noise > 0 else float("inf")}
+
+    def calibrate_settle_time(self, steps=None, repeats=3, tolerance=0.001, duration=0.5):
+        """
+        Measures how long the plate voltage needs to settle after DAC steps of different sizes, fits a Settle_Model and
+        caches it for this setup (device, DAC, readback channel). The scan loop then waits exactly as long as each step needs.
+        For every step, the readback is sampled as fast as possible for duration seconds; the final value is the mean of the
+        last fifth of the trace and the settling time is the last time the trace was outside the tolerance band around it.
+        The readback may be scaled (e.g. divider); the band is scaled by the measured ratio of readback step to DAC step.
+
+        Parameters
+        ----------
+        steps : array, optional
+            DAC step sizes [V]. The default covers 1 mV up to the full plate voltage range (-2V to 2V).
+        repeats : int, optional
+            measurements per step size. The default is 3.
+        tolerance : float, optional
+            settling band [V] (DAC Volts). The default is 0.001.
+        duration : float, optional
+            recording time per step [s]. The default is 0.5.
+
+        Returns
+        -------
+        model : Settle_Model
+
+        """
+        if steps is None:
+            steps = np.geomspace(0.001, 4, 12)
+        output = "DAC1" #!!!
+        ljm = self.ljm or load_ljm()
+        handle = ljm.openS("T8","usb",self.device)
+        measured_steps = []
+        times = []
+        try:
+            for step in steps:
+                for r in range(repeats):
+                    start_voltage = -2 if step > 2 else -step/2 #steps are centered in the plate voltage range
+                    ljm.eWriteName(handle, output, start_voltage+3.188)
+                    time.sleep(duration) #settled start value
+                    initial = ljm.eReadName(handle, self.readback)
+                    ljm.eWriteName(handle, output, start_voltage+step+3.188)
+                    t0 = time.perf_counter()
+                    trace = []
+                    while time.perf_counter() - t0 < duration:
+                        trace.append((time.perf_counter()-t0, ljm.eReadName(handle, self.readback)))
+                    t, reading = np.array(trace).T
+                    final = np.mean(reading[-max(1, len(reading)//5):])
+                    band = tolerance*abs((final-initial)/step)
+                    outside = np.nonzero(np.abs(reading - final) > band)[0]
+                    measured_steps.append(step)
+                    times.append(t[outside[-1]] if len(outside) else 0)
+        finally:
+            ljm.eWriteName(handle, output, 3.188) #plate voltage back to 0
+            ljm.close(handle)
+        model = Settle_Model(tolerance=tolerance)
+        model.fit(measured_steps, times)
+        model.save(Settle_Model.setup_key(self.device, output, self.readback))
+        return model
+
+    def finish_column(self, axis, journal, I, n, I_, F_=None, **event):
+        """
+        Post-processing of a measured column (runs in the worker thread of measure_columns):
+        clips the noise, appends the column to the journal, flushes it to disk and publishes the progress.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        journal : file
+            open journal file
+        I : numpy.ndarray
+            partial current matrix, column n is filled in
+        n : int
+            column index
+        I_ : numpy.ndarray
+            averaged currents of the column
+        F_ : numpy.ndarray, optional
+            averaged front shield currents of the column. The default is None (not measured).
+        **event :
+            entries of the progress event
+
+        Returns
+        -------
+        None.
+
+        """
+        I_ = (abs(I_) + I_)/2 #turns negative currents to 0 (non physical; noise)
+        entry = {"column": n, "current": I_.tolist()}
+        if F_ is not None:
+            entry["frontshield"] = F_.tolist()
+        journal.write(json.dumps(entry) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+        I[:,n] = I_
+        if self.listeners or self.status_listeners:
+            self.publish(axis, I, **event)
+
+    def publish(self, axis, I, **event):
+        """
+        Sends a progress event to all listeners: the given entries plus axis, partial current matrix and running emittance.
+        If there are status_listeners, the event also has the axis' drive and fault bits: the controller is queried once per
+        event (one round trip), no matter how many listeners there are. Without them, the scan link is not used.
+
+        Parameters
+        ----------
+        axis : int
+            in [0,1,2,3]
+        I : numpy.ndarray
+            current matrix measured so far (missing columns are 0)
+        **event :
+            e.g. column, position, ETA [s]
+
+        Returns
+        -------
+        None.
+
+        """
+        E_rms = None
+        if np.sum(I) > 0:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                E_rms = float(self.emittance(axis, I)[0])
+        event.update({"axis": axis, "time": time.time(), "current": I.tolist(), "E_rms": E_rms if E_rms == E_rms else None}) #NaN -> None
+        if self.status_listeners:
+            drive, fault = self.Mot.send_batch([f"?BIT(8465 + {axis}*32)", f"?BIT(8477 + {axis}*32)"])
+            event.update({"drive": bool(drive), "fault": bool(fault)})
+        for listener in self.listeners + self.status_listeners:
+            try:
+                listener(event)
+            except Exception as e: #a broken listener must not stop the scan
+                print(f"Progress listener failed: {e}")
+
+    def assemble(self, journal_name):
+        """
+        Assembles the current matrix from a complete journal, writes the data file and removes the journal.
+        The current matrix of a sparse scan is reconstructed from the measured cells (reconstruct_current).
+
+        Parameters
+        ----------
+        journal_name : str
+            journal file of the scan
+
+        Raises
+        ------
+        ValueError
+            if columns are missing in the journal
+
+        Returns
+        -------
+        I : numpy.ndarray
+            current matrix
+        file_name : str
+            file where the data is saved
+
+        """
+        header, columns = self.read_journal(journal_name)
+        axis = header["axis"]
+        position = np.array(header["position"])
+        momentum = np.array(header["momentum"])
+        V = np.array(header["voltage"])
+        missing = [n for n in range(len(position)) if n not in columns]
+        if missing:
+            raise ValueError(f"Columns {missing} are missing in {journal_name}")
+        I = np.array([columns[n] for n in range(len(position))]).T #columns = position, rows = Voltage
+        measured = I
+        if header.get("mask") is not None: #sparse scan
+            I = reconstruct_current(measured, np.array(header["mask"], dtype=bool))
+        file_name = header["file_name"]
+        self.write_data_file(file_name, axis, header["variables"], position, momentum, V, I)
+        frontshield = self.read_journal(journal_name, "frontshield")[1]
+        with open(file_name, 'a') as f: #additional sections
+            if header.get("mask") is not None:
+                f.write("\nSampling Mask: \n")
+                json.dump(header["mask"], f)
+                f.write("\nMeasured Current Matrix: \n")
+                json.dump(measured.tolist(), f)
+            if header.get("waveform"):
+                f.write("\nWaveform File: \n")
+                f.write(header["waveform"])
+            if len(frontshield) == len(position): #not in journals of scans that were started without front shield
+                f.write("\nFront Shield Current Matrix: \n")
+                json.dump(np.array([frontshield[n] for n in range(len(position))]).T.tolist(), f)
+        os.remove(journal_name)
+        return I, file_name
+
+    def write_data_file(self, file_name, axis, variables, position, momentum, V, I):
+        """
+        Writes the scan data and the emittance and Twiss parameters to the data file (format read by read_data_file).
+        """
         E, A, B, G = self.emittance(axis, I)
-        file_name = "Emittance_Scanner_Data_"+ Date_Time + f" {['Venus_x_', 'Venus_y_', 'AECR_x_', 'AECR_y_'][axis]}" + ".txt"
         with open(file_name, 'w') as f: #save data in a text file
             f.write("Variables\n")
             f.write(json.dumps(variables))
@@ -546,9 +3096,49 @@ class Read_and_Analyze:
             f.write(str(B))
             f.write("\nTwiss Parameter Gamma: \n")
             f.write(str(G))
-        return I, file_name
+
+    @classmethod
+    def resume(cls, journal_name, Motor_instance, stop_event=None, ljm=None):
+        """
+        Continues an interrupted scan from its journal: re-centers the axis (the center position may have been lost),
+        measures the missing columns and assembles the data file.
+
+        Parameters
+        ----------
+        journal_name : str
+            journal file of the interrupted scan
+        Motor_instance : object
+            instance of Motor() class
+        stop_event : threading.Event, optional
+            stops the scan again once it is set (see stop_event). The default is None.
+        ljm : module, optional
+            labjack.ljm or a stand-in with the same functions (see self.ljm). If None, labjack.ljm is loaded when the
+            first column is measured. The default is None.
+
+        Returns
+        -------
+        I : numpy.ndarray
+            current matrix
+        file_name : str
+            file where the data is saved
+
+        """
+        header, columns = cls.read_journal(journal_name)
+        V = Variables()
+        for name, value in header["attributes"].items():
+            setattr(V, name, value)
+        RnA = cls(V, Motor_instance)
+        RnA.device = header["device"]
+        RnA.Voltagecurrentfactor = header["gain"]
+        RnA.frontshield_gain = header.get("frontshield_gain", RnA.frontshield_gain)
+        RnA.stop_event = stop_event
+        RnA.ljm = ljm
+        axis = header["axis"]
+        Motor_instance.centering(axis)
+        RnA.measure_columns(axis, journal_name)
+        return RnA.assemble(journal_name)
     
-    def emittance(self, axis, I):
+    def emittance(self, axis, I, frontshield=None):
         """
         Calculates the RMS emittance. The Emittance is 4*the Root mean square emittance
         
@@ -559,6 +3149,9 @@ class Read_and_Analyze:
             in [0,1,2,3]
         I : numpy.ndarray
             2-D current matrix
+        frontshield : numpy.ndarray, optional
+            front shield current matrix of the scan. If given, the emittance of the drift normalized current matrix
+            (see normalize_drift) is calculated. The default is None.
 
         Returns
         -------
@@ -571,6 +3164,8 @@ class Read_and_Analyze:
         gamma : float
             Twiss Parameter gamma
         """
+        if frontshield is not None:
+            I = self.normalize_drift(I, frontshield)
         position = [self.x*1e-3, self.y*1e-3][axis%2] #m
         momentum = [self.x_prime*1e-3, self.y_prime*1e-3][axis%2] #rad
         position_mean = sum(I@position)/np.sum(I) #sum(x_i*I_i)/sum(I_i)
@@ -586,7 +3181,34 @@ class Read_and_Analyze:
         #E_rms in m rad
         return E_rms, alpha, beta, gamma
     
-    def phase_space_plot(self, filename): 
+    @staticmethod
+    def normalize_drift(I, frontshield, threshold=0.05):
+        """
+        Corrects the current matrix for source current drift during the scan. The front shield intercepts almost the whole beam
+        (all but the slit), so its current follows the beam current; every point is scaled to the mean front shield current.
+        Points where the front shield current is below threshold*mean (e.g. beam off) are left as they are.
+
+        Parameters
+        ----------
+        I : numpy.ndarray
+            current matrix
+        frontshield : numpy.ndarray
+            front shield current matrix (same shape)
+        threshold : float, optional
+            The default is 0.05.
+
+        Returns
+        -------
+        numpy.ndarray
+            drift normalized current matrix
+
+        """
+        frontshield = np.asarray(frontshield, dtype=float)
+        reference = np.mean(frontshield)
+        valid = frontshield > threshold*reference
+        return np.asarray(I)*np.where(valid, reference/np.where(valid, frontshield, 1), 1)
+
+    def phase_space_plot(self, filename, normalize=False, ax=None): 
         """
         Plots emittance scan data. plus an ellipses whose area is the emittance.
         
@@ -594,51 +3216,614 @@ class Read_and_Analyze:
         ----------
         filename : str
             Filename of data to be plotted. 
-        E_rms : float
-            Root mean square Emittance
-        A : float
-            Twiss Parameter Alpha
-        B : float
-            Twiss Parameters Alpha
+        normalize : bool, optional
+            If True, the drift normalized current matrix (see normalize_drift) and its emittance are plotted,
+            if the file has a front shield current matrix. The default is False.
+        ax : matplotlib.axes.Axes, optional
+            axes to plot into. The default is None, i.e. the current pyplot axes.
 
         Returns
         -------
         None.
 
         """
-        data = []
-        with open(filename) as f:
-            for i, line in enumerate(f):
-                if i >= 2 and i%2 == 1:
-                    try:
-                        data.append(json.loads(line))
-                    except:
-                        data.append(line.strip())
-                    
-        beam_line = data[0]
-        axis = data[1]
-        position = np.array(data[2]) #unit to mm
-        momentum = np.array(data[3]) #unit to mrad
-        I = np.array(data[5])*1e9 # unit nA
-        theta = np.linspace(0, 2*np.pi, 100)
-        E_rms = float(data[6])*1e6 #convert to mm mrad
-        A = float(data[7])
-        B = float(data[8])
-        x_e = np.sqrt(4*E_rms*B)*np.cos(theta)
-        x_prime_e = -np.sqrt(4*E_rms/B)*(A*np.cos(theta)+np.sin(theta)) #parametrisizing the ellipse (Epsilon = 4*Epsilon_rms)  
+        plot = phase_space_data(filename, normalize)
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
+        axis = plot["axis"]
         img_filename = filename.strip("txt") + "jpeg" #create valid format for picture with same name as the data
-        m,n = I.shape
-        binlength_position = (max(position)-min(position))/n
-        binlength_momentum = (max(momentum)-min(momentum))/m
-        plt.imshow(I,cmap="inferno", origin="lower", extent=(min(position)-binlength_position/2, max(position)+binlength_position/2, min(momentum)-binlength_momentum/2, max(momentum)+binlength_momentum/2))
-        plt.plot(x_e, x_prime_e,'r--', label ="$\epsilon_{rms}$ = "+f"{round(E_rms,4)} [mm mrad]")
-        plt.colorbar(label = "Current [nA]")
-        plt.xlabel(f"Position {axis} [mm]")
-        plt.ylabel(f"Momentum {axis}' [mrad]")
-        plt.title(f"{beam_line} {axis}-Axis Emittance Scan")
-        #plt.legend()
-        plt.savefig(img_filename) #saving plot
-        #plt.close()
+        image = ax.imshow(plot["I"], cmap="inferno", origin="lower", extent=plot["extent"])
+        ax.plot(*plot["ellipse"], 'r--', label ="$\\epsilon_{rms}$ = "+f"{round(plot['E_rms'],4)} [mm mrad]")
+        ax.figure.colorbar(image, ax=ax, label = "Current [nA]")
+        ax.set_xlabel(f"Position {axis} [mm]")
+        ax.set_ylabel(f"Momentum {axis}' [mrad]")
+        ax.set_title(f"{plot['beam_line']} {axis}-Axis Emittance Scan")
+        #ax.legend()
+        ax.figure.savefig(img_filename) #saving plot
+
+
+class Scan_Statistics:
+    def __init__(self, position, momentum):
+        """
+        Combines repeated scans of the same axis into a mean and a variance current matrix.
+        Mean and variance are updated in a streaming way (Welford), so scans can be added one by one as they finish.
+        Scans taken on a slightly different grid are interpolated onto the common grid given here.
+
+        Parameters
+        ----------
+        position : array
+            common position grid [mm]
+        momentum : array
+            common momentum grid [mrad]
+
+        Returns
+        -------
+        None.
+
+        """
+        self.position = np.asarray(position, dtype=float)
+        self.momentum = np.asarray(momentum, dtype=float)
+        self.n = 0 #number of scans added
+        self.mean = np.zeros((len(self.momentum), len(self.position)))
+        self.M2 = np.zeros_like(self.mean) #sum of squared differences from the mean (Welford)
+        self.moments = [] #beam_moments of every single scan, used for the bootstrap
+        self.header = None #variables, beam line, axis and voltage array of the first file added
+
+    @classmethod
+    def from_files(cls, filenames):
+        """
+        Creates a Scan_Statistics instance on the grid of the first file and adds all files.
+
+        Parameters
+        ----------
+        filenames : list of str
+            Emittance_Scanner_Data files of repeated scans on the same axis
+
+        Returns
+        -------
+        stats : Scan_Statistics
+
+        """
+        first = read_data_file(filenames[0])
+        stats = cls(first["position"], first["momentum"])
+        for filename in filenames:
+            stats.add_file(filename)
+        return stats
+
+    def regrid(self, position, momentum, I):
+        """
+        Interpolates (bilinear) a current matrix onto the common grid. Points outside the measured grid are set to 0.
+
+        Parameters
+        ----------
+        position : array
+            position grid of I [mm]
+        momentum : array
+            momentum grid of I [mrad]
+        I : numpy.ndarray
+            current matrix, rows = momentum, columns = position
+
+        Returns
+        -------
+        I : numpy.ndarray
+            current matrix on the common grid
+
+        """
+        position = np.asarray(position, dtype=float)
+        momentum = np.asarray(momentum, dtype=float)
+        I = np.asarray(I, dtype=float)
+        if position.shape == self.position.shape and momentum.shape == self.momentum.shape:
+            if np.allclose(position, self.position) and np.allclose(momentum, self.momentum):
+                return I #same grid, nothing to do
+        I = np.array([np.interp(self.position, position, row, left=0, right=0) for row in I]) #along position
+        return np.array([np.interp(self.momentum, momentum, column, left=0, right=0) for column in I.T]).T #along momentum
+
+    def add(self, I, position=None, momentum=None):
+        """
+        Adds one scan (Welford update of mean and variance).
+
+        Parameters
+        ----------
+        I : numpy.ndarray
+            current matrix [A]
+        position, momentum : array, optional
+            grid of I [mm], [mrad]. If None, I is assumed to be on the common grid
+
+        Returns
+        -------
+        None.
+
+        """
+        if position is not None and momentum is not None:
+            I = self.regrid(position, momentum, I)
+        I = np.asarray(I, dtype=float)
+        self.n += 1
+        delta = I - self.mean
+        self.mean += delta/self.n
+        self.M2 += delta*(I - self.mean)
+        self.moments.append(beam_moments(self.position*1e-3, self.momentum*1e-3, I))
+
+    def add_file(self, filename):
+        """
+        Adds the scan stored in an Emittance_Scanner_Data file.
+        """
+        data = read_data_file(filename)
+        if self.header is None:
+            self.header = {key: data[key] for key in ["variables", "beam_line", "axis", "voltage"]}
+        self.add(data["current"], data["position"], data["momentum"])
+
+    @property
+    def variance(self):
+        """Sample variance of the current in every cell (0 for fewer than 2 scans)."""
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return self.M2/(self.n-1)
+
+    def twiss(self):
+        """
+        Returns
+        -------
+        E_rms, alpha, beta, gamma : float
+            of the mean current matrix
+        """
+        return tuple(float(value) for value in twiss_from_moments(np.mean(self.moments, axis=0)))
+
+    def bootstrap(self, resamples=5000, confidence=0.95, seed=None):
+        """
+        Bootstrap confidence intervals for E_rms, alpha, beta, gamma.
+        Every resample draws n scans with replacement. Since the beam moments are linear in the current, the moments of
+        the resampled mean matrix are the resample counts times the moments of the single scans divided by n,
+        so all resamples are evaluated in one matrix product instead of recomputing mean matrices in a loop.
+
+        Parameters
+        ----------
+        resamples : int, optional
+            number of bootstrap resamples. The default is 5000.
+        confidence : float, optional
+            confidence level of the intervals. The default is 0.95.
+        seed : int, optional
+            seed for the random number generator
+
+        Returns
+        -------
+        intervals : dict
+            {"E_rms": (estimate, low, high), "alpha": ..., "beta": ..., "gamma": ...}
+
+        """
+        if self.n < 2:
+            raise ValueError("At least 2 scans are needed for a bootstrap")
+        rng = np.random.default_rng(seed)
+        counts = rng.multinomial(self.n, np.full(self.n, 1/self.n), size=resamples) #(resamples, n)
+        S = counts@np.array(self.moments)/self.n #(resamples, 6)
+        samples = twiss_from_moments(S)
+        q = [(1-confidence)/2*100, (1+confidence)/2*100]
+        intervals = {}
+        for name, estimate, sample in zip(["E_rms", "alpha", "beta", "gamma"], self.twiss(), samples):
+            low, high = np.nanpercentile(sample, q)
+            intervals[name] = (estimate, float(low), float(high))
+        return intervals
+
+    def write_and_save_file(self, intervals=None, confidence=0.95):
+        """
+        Saves the combined result in the same layout as a single scan data file, so it can be loaded and plotted like one,
+        followed by the number of scans, the variance matrix and the confidence intervals.
+        The file is named "Emittance_Scanner_Average_YYYY-MM-DD HHhMMmSSs {Beam Line}_{axis}_.txt" (see create_file)
+
+        Parameters
+        ----------
+        intervals : dict, optional
+            result of bootstrap(). If None, the bootstrap is run with the given confidence level.
+        confidence : float, optional
+            confidence level of the intervals. The default is 0.95.
+
+        Returns
+        -------
+        file_name : str
+
+        """
+        header = self.header or {"variables": {}, "beam_line": "", "axis": "", "voltage": np.array([])}
+        E, A, B, G = self.twiss()
+        if intervals is None:
+            intervals = self.bootstrap(confidence=confidence) if self.n > 1 else {}
+        file_name = create_file("Emittance_Scanner_Average_", f" {({'VENUS': 'Venus'}).get(header['beam_line'], header['beam_line'])}_{header['axis'].lower()}_", ".txt") + ".txt"
+        with open(file_name, 'w') as f:
+            f.write("Variables\n")
+            f.write(json.dumps(header["variables"]))
+            f.write("\nBeam Line:\n")
+            f.write(f"{header['beam_line']}\n")
+            f.write("Axis:\n")
+            f.write(f"{header['axis']}\n")
+            f.write("Position Array:\n")
+            json.dump(self.position.tolist(), f)
+            f.write('\nMomentum Array: \n')
+            json.dump(self.momentum.tolist(), f)
+            f.write('\nVoltage Array: \n')
+            json.dump(np.asarray(header["voltage"]).tolist(), f)
+            f.write("\nCurrent Matrix: \n")
+            json.dump(self.mean.tolist(), f)
+            f.write("\nRMS Emittance: \n")
+            f.write(str(E))
+            f.write("\nTwiss Parameter Alpha: \n")
+            f.write(str(A))
+            f.write("\nTwiss Parameter Beta: \n")
+            f.write(str(B))
+            f.write("\nTwiss Parameter Gamma: \n")
+            f.write(str(G))
+            f.write("\nNumber of Scans: \n")
+            f.write(str(self.n))
+            f.write("\nCurrent Variance Matrix: \n")
+            json.dump(self.variance.tolist(), f)
+            f.write(f"\nConfidence Intervals {confidence*100:g}% (estimate, low, high): \n")
+            json.dump(intervals, f)
+        return file_name
+
+
+class Scan_Scheduler:
+    def __init__(self, Motor_instance):
+        """
+        Runs one scan per beam line at the same time. VENUS (axes 0,1) and AECR (axes 2,3) are mechanically independent,
+        so while one beam line moves, the other one can acquire. Each scan runs in its own thread with its own
+        Read_and_Analyze instance and LabJack; the controller commands of both threads are interleaved on the
+        shared link by Motor.send_command.
+        Scans only run at the same time if the beam lines are attached to different masters (Motor.masters), otherwise
+        they would wait on the same "In Motion" bit, and a limit switch hit while homing one beam line would stop the
+        coordinated move of the other. So with the default Motor.masters [0, 0, 0, 0] the scans run one after the other;
+        running them at the same time needs the AECR axes attached to Master1 in the controller configuration and
+        Motor.masters = [0, 0, 1, 1].
+
+        Parameters
+        ----------
+        Motor_instance : object
+            instance of Motor() class
+
+        Returns
+        -------
+        None.
+
+        """
+        self.Mot = Motor_instance
+        self.jobs = {} #beam line: job
+
+    def add_scan(self, Variables_instance, axis, scans=1, device="ANY", gain=None):
+        """
+        Adds a scan to the schedule.
+
+        Parameters
+        ----------
+        Variables_instance : object
+            instance of Variables() class for this beam line
+        axis : int
+            in [0,1,2,3]
+        scans : int, optional
+            number of scans on this axis. The default is 1.
+        device : str, optional
+            LabJack identifier of the beam line's acquisition device. The default is "ANY".
+        gain : float, optional
+            Scan cup gain [V/A]. The default is the gain of the Motor instance.
+
+        Raises
+        ------
+        ValueError
+            if there already is a scan on this beam line
+
+        Returns
+        -------
+        None.
+
+        """
+        beam_line = axis//2
+        if beam_line in self.jobs:
+            raise ValueError(f"There already is a scan on {['VENUS', 'AECR'][beam_line]}")
+        RnA = Read_and_Analyze(Variables_instance, self.Mot)
+        RnA.device = device
+        if gain is not None:
+            RnA.Voltagecurrentfactor = gain
+        self.jobs[beam_line] = {"RnA": RnA, "axis": axis, "scans": scans, "filenames": [], "error": None}
+
+    def run_job(self, job):
+        """
+        Centers the axis, runs the scans and retracts the axis. Runs in the beam line's thread.
+        """
+        axis = job["axis"]
+        self.Mot.select_program(self.Mot.masters[axis])
+        Command_Metrics.select_role("scan")
+        try:
+            self.Mot.centering(axis)
+            for i in range(job["scans"]):
+                I, filename = job["RnA"].get_current(axis)
+                job["filenames"].append(filename)
+            self.Mot.move_out(axis)
+        except Exception as e:
+            job["error"] = e
+
+    def run(self):
+        """
+        Runs all scheduled scans at the same time (one after the other if the beam lines share a master) and waits until
+        all of them are done.
+
+        Raises
+        ------
+        FatalError
+            if a scan failed. The other beam line's scan is still completed.
+
+        Returns
+        -------
+        filenames : dict
+            {beam line: list of data files}
+
+        """
+        if len({self.Mot.masters[job["axis"]] for job in self.jobs.values()}) < len(self.jobs):
+            print("Both beam lines are attached to the same master, the scans run one after the other. For simultaneous scans, attach "
+                  "the AECR axes to Master1 in the controller configuration and set Motor.masters = [0, 0, 1, 1].")
+            threads = [threading.Thread(target=lambda: [self.run_job(job) for job in self.jobs.values()], daemon=True)]
+        else:
+            threads = [threading.Thread(target=self.run_job, args=(job,), daemon=True) for job in self.jobs.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        jobs, self.jobs = self.jobs, {}
+        for beam_line, job in jobs.items():
+            if job["error"] is not None:
+                raise FatalError(f"Scan on {['VENUS', 'AECR'][beam_line]} failed: {job['error']}") from job["error"]
+        return {beam_line: job["filenames"] for beam_line, job in jobs.items()}
+
+
+class Scan_Queue:
+    def __init__(self, file_name="Emittance_Scanner_Queue.json"):
+        """
+        Persistent queue of scan jobs. The queue is stored as a json file and rewritten after every change,
+        so jobs survive a program restart and can be added while the runner is executing other jobs.
+        A job that was running when the program stopped is set back to pending on the next start.
+
+        Parameters
+        ----------
+        file_name : str, optional
+            file the queue is stored in. The default is "Emittance_Scanner_Queue.json".
+
+        Returns
+        -------
+        None.
+
+        """
+        self.file_name = file_name
+        self.max_attempts = 3 #a job that failed with a transient error is retried until it failed this many times
+        self.transient = (TimeoutError, OSError, EOFError) #link errors and timeouts; other errors (FatalError, SaturationError, ...) would happen again
+        self.lock = threading.Lock()
+        self.jobs = self.load()
+        for job in self.jobs:
+            if job["status"] == "running": #program stopped during this job
+                job["status"] = "pending"
+        self.save()
+
+    def load(self):
+        """
+        Returns
+        -------
+        jobs : list of dict
+            jobs stored in the queue file (empty if there is no file yet)
+        """
+        if not os.path.exists(self.file_name):
+            return []
+        with open(self.file_name) as f:
+            return json.load(f)
+
+    def save(self):
+        """
+        Writes the queue to a temporary file first and replaces the queue file with it, so the queue file is never half written.
+        """
+        with open(self.file_name + ".tmp", 'w') as f:
+            json.dump(self.jobs, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.file_name + ".tmp", self.file_name)
+
+    def enqueue(self, Variables_instance, axis, scans=1, gain=1e8, device="ANY"):
+        """
+        Adds a job to the end of the queue.
+
+        Parameters
+        ----------
+        Variables_instance : object
+            instance of Variables() class. The values are copied, later changes do not affect the job.
+        axis : int
+            in [0,1,2,3] (beam line = axis//2)
+        scans : int, optional
+            number of scans. The default is 1.
+        gain : float, optional
+            Scan cup gain [V/A]. The default is 1e8.
+        device : str, optional
+            LabJack identifier. The default is "ANY".
+
+        Returns
+        -------
+        job_id : int
+
+        """
+        with self.lock:
+            self.jobs = self.load() #jobs might have been added by another program
+            job_id = max([job["id"] for job in self.jobs], default=0) + 1
+            self.jobs.append({"id": job_id, "beam_line": ["VENUS", "AECR"][axis//2], "axis": int(axis), "scans": int(scans), "gain": float(gain), "device": device,
+                              "variables": dict(vars(Variables_instance)), "status": "pending", "attempts": 0, "error": None, "filenames": [], "journal": None,
+                              "created": datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss")})
+            self.save()
+        return job_id
+
+    def update(self, job_id, **changes):
+        """
+        Changes the given entries of a job and saves the queue.
+        """
+        with self.lock:
+            self.jobs = self.load()
+            for job in self.jobs:
+                if job["id"] == job_id:
+                    job.update(changes)
+                    break
+            self.save()
+            return job
+
+    def next_job(self):
+        """
+        Returns
+        -------
+        job : dict or None
+            first pending job with the fewest attempts (failed jobs are retried after the other jobs), None if there is none
+        """
+        with self.lock:
+            self.jobs = self.load()
+        pending = [job for job in self.jobs if job["status"] == "pending"]
+        return min(pending, key=lambda job: job["attempts"], default=None)
+
+    def pending(self):
+        """Number of pending jobs."""
+        return sum(job["status"] == "pending" for job in self.load())
+
+    def run_job(self, Motor_instance, job):
+        """
+        Centers the axis, runs the job's scans (combining repeated scans with Scan_Statistics) and retracts the axis.
+        The journal of the running scan and the data files of the finished scans are stored in the job, so a retry
+        skips the finished scans and resumes the interrupted one from its journal (the measured columns are kept).
+
+        Returns
+        -------
+        filenames : list of str
+            data files of the job (the combined file last, if there is one)
+
+        """
+        axis = job["axis"]
+        V = Variables()
+        for name, value in job["variables"].items():
+            setattr(V, name, value)
+        RnA = Read_and_Analyze(V, Motor_instance)
+        RnA.device = job["device"]
+        RnA.Voltagecurrentfactor = job["gain"]
+        Motor_instance.centering(axis)
+        filenames = list(job.get("filenames") or [])
+        journal_name = job.get("journal")
+        for i in range(len(filenames), job["scans"]):
+            if journal_name is None or not os.path.exists(journal_name):
+                journal_name = RnA.start_journal(axis)
+                self.update(job["id"], journal=journal_name)
+            RnA.measure_columns(axis, journal_name)
+            I, filename = RnA.assemble(journal_name)
+            filenames.append(filename)
+            journal_name = None
+            self.update(job["id"], journal=None, filenames=filenames)
+        Motor_instance.move_out(axis)
+        if len(filenames) > 1:
+            stats = Scan_Statistics.from_files(filenames)
+            filenames.append(stats.write_and_save_file())
+        return filenames
+
+    def run(self, Motor_instance, wait=False, stop_event=None):
+        """
+        Executes the pending jobs one after the other. A failed job is retracted. If it failed with a transient error
+        (see self.transient), it is retried later (continuing its scans, see run_job) until it failed max_attempts times; otherwise (e.g. the Faraday Cup is not out,
+        the axis can not be cleared or the signal saturates) it is marked as failed right away. Then the queue continues.
+
+        Parameters
+        ----------
+        Motor_instance : object
+            instance of Motor() class
+        wait : bool, optional
+            If True, waits for new jobs when the queue is empty instead of returning. The default is False.
+        stop_event : threading.Event, optional
+            the runner returns after the current job once it is set
+
+        Returns
+        -------
+        None.
+
+        """
+        role = Command_Metrics.role.set("scan")
+        try:
+            while not (stop_event and stop_event.is_set()):
+                job = self.next_job()
+                if job is None:
+                    if not wait:
+                        return
+                    time.sleep(5)
+                    continue
+                self.update(job["id"], status="running", attempts=job["attempts"]+1)
+                try:
+                    filenames = self.run_job(Motor_instance, job)
+                except KeyboardInterrupt:
+                    self.update(job["id"], status="pending")
+                    raise
+                except Exception as e:
+                    try: #leave the beam line clear for the next job
+                        Motor_instance.move_out(job["axis"])
+                    except Exception:
+                        pass
+                    status = ["pending", "failed"][job["attempts"]+1 >= self.max_attempts or not isinstance(e, self.transient)]
+                    self.update(job["id"], status=status, error=f"{type(e).__name__}: {e}")
+                    continue
+                self.update(job["id"], status="done", error=None, filenames=filenames)
+        finally:
+            Command_Metrics.role.reset(role)
+
+
+def print_statistics(filenames):
+    """
+    Combines repeated scans with Scan_Statistics, saves the combined file and prints the results with 95% confidence intervals.
+
+    Parameters
+    ----------
+    filenames : list of str
+        data files of repeated scans on the same axis
+
+    Returns
+    -------
+    file_name : str
+        file where the combined result is saved
+
+    """
+    stats = Scan_Statistics.from_files(filenames)
+    intervals = stats.bootstrap()
+    file_name = stats.write_and_save_file(intervals)
+    print(f"Combined {stats.n} scans, saved as {file_name}")
+    print(f"RMS Emittance: {intervals['E_rms'][0]*1e6:.4f} [mm mrad] ({intervals['E_rms'][1]*1e6:.4f} - {intervals['E_rms'][2]*1e6:.4f})")
+    for name in ["alpha", "beta", "gamma"]:
+        estimate, low, high = intervals[name]
+        print(f"Twiss Parameter {name.capitalize()}: {estimate:.4f} ({low:.4f} - {high:.4f})")
+    return file_name
+
+
+def print_sparse_simulation(filename, fractions=(0.2, 0.25, 0.3), modes=("random", "stratified"), noise=0.01, repeats=10):
+    """
+    Simulates sparse scans of a Gaussian beam with the grid and the Twiss parameters of a measured scan and prints the
+    reconstruction errors against the full scan, to choose Read_and_Analyze.sampling before the beam time.
+
+    Parameters
+    ----------
+    filename : str
+        data file of a full scan
+    fractions : tuple of float, optional
+        fractions of measured cells. The default is (0.2, 0.25, 0.3).
+    modes : tuple of str, optional
+        sampling modes. The default is ("random", "stratified").
+    noise : float, optional
+        rms noise relative to the peak current. The default is 0.01.
+    repeats : int, optional
+        simulated scans per fraction and mode. The default is 10.
+
+    Returns
+    -------
+    results : dict
+        {(mode, fraction): errors} see simulate_sparse_scan
+
+    """
+    data = read_data_file(filename)
+    results = {}
+    print("Mode        Fraction   Current [%]   E_rms [%]   Alpha     Beta [%]")
+    for mode in modes:
+        for fraction in fractions:
+            errors = simulate_sparse_scan(data["position"], data["momentum"], data["E_rms"], data["alpha"], data["beta"],
+                                          fraction, mode, noise, repeats=repeats, seed=0)
+            results[(mode, fraction)] = errors
+            print(f"{mode:12s}{fraction:8.2f}{errors['current']*100:14.2f}{errors['E_rms']*100:12.2f}{errors['alpha']:10.4f}{errors['beta']*100:11.2f}")
+    return results
 
 
 def main():
@@ -796,9 +3981,18 @@ def main():
                     continue
                 else:
                     return
+    both = False
     while True:
         try: 
-            M.beam_line = np.where(np.array(["VENUS", "AECR"])==input("Enter the Beam Line (VENUS or AECR): "))[0].item()
+            beam_line = input("Enter the Beam Line (VENUS, AECR or BOTH): ")
+            if beam_line == "BOTH": #one scan per beam line at the same time, each beam line gets its own copy of the variables
+                both = True
+                Vs = [copy.deepcopy(V), copy.deepcopy(V)]
+                for b in range(2):
+                    Vs[b].x_min = max(-M.mid_point_offsets[[0,2][b]], Vs[b].x_min)
+                    Vs[b].y_min = max(-M.mid_point_offsets[[1,3][b]], Vs[b].y_min)
+                break
+            M.beam_line = np.where(np.array(["VENUS", "AECR"])==beam_line)[0].item()
             V.x_min = max(-M.mid_point_offsets[[0,2][M.beam_line]], V.x_min)
             V.y_min = max(-M.mid_point_offsets[[1,3][M.beam_line]], V.y_min)
             V.x_max = max(50, V.x_max)
@@ -829,19 +4023,43 @@ def main():
         except ValueError:
             print("Must be a float!")
             continue
+    if both:
+        devices = [input(f"Enter the LabJack identifier for {name} (serial number, IP or name): ") for name in ["VENUS", "AECR"]]
+        scheduler = Scan_Scheduler(M)
+        for k, axis_name in enumerate(["x", "y"]):
+            input(f"When ready to start {axis_name}-Axis Scans on both beam lines, hit Enter")
+            for b in range(2):
+                scheduler.add_scan(Vs[b], [[0,1], [2,3]][b][k], [x_scans, y_scans][k], devices[b])
+            results = scheduler.run()
+            for b, filenames in results.items():
+                RnA = Read_and_Analyze(Vs[b], M)
+                for filename in filenames:
+                    RnA.phase_space_plot(filename)
+                if len(filenames) > 1:
+                    print_statistics(filenames)
+        M.tn.close()
+        return
     RnA = Read_and_Analyze(V, M)
     input("When ready to start x-Axis Scans, hit Enter")
     axis = [0,2][M.beam_line]
     M.centering(axis)
+    filenames = []
     for i in range(x_scans):
         I, filename = RnA.get_current(axis)
         RnA.phase_space_plot(filename)
+        filenames.append(filename)
     M.move_out(axis)
+    if len(filenames) > 1: #combine repeated scans into one result with confidence intervals
+        print_statistics(filenames)
     input("When ready to start y-Axis Scans, hit Enter")
     axis = [1,3][M.beam_line]
     M.centering(axis)
+    filenames = []
     for i in range(y_scans):
         I, filename = RnA.get_current(axis)
         RnA.phase_space_plot(filename)
+        filenames.append(filename)
     M.move_out(axis)
+    if len(filenames) > 1:
+        print_statistics(filenames)
     M.tn.close()
\ No newline at end of file
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long the program needs to start, each step in a fresh Python process (nothing cached from other steps):
+    import      import Emittance_scanner
+    motor       import + Motor() (must not connect to the controller)
+    offline     import + analysis of a data file without hardware (Read_and_Analyze.from_data_file)
+    gui         import Emittance_GUI_NEW
+
+Usage:
+    python Emittance_startup_benchmark.py [data file] [--repeats 5] [--budget 1.0]
+
+With --budget, the exit code is 1 if the median of import or motor is slower than the budget [s],
+so the benchmark can be run after changes to the imports.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+STEPS = {
+    "import": "import Emittance_scanner",
+    "motor": "import Emittance_scanner\nM = Emittance_scanner.Motor()\nassert not M.tn",
+    "offline": "import Emittance_scanner\n"
+               "data = Emittance_scanner.read_data_file(FILE)\n"
+               "RnA = Emittance_scanner.Read_and_Analyze.from_data_file(FILE)\n"
+               "RnA.emittance(['X', 'Y'].index(data['axis']), data['current'])",
+    "gui": "import Emittance_GUI_NEW",
+}
+
+
+def run(code, repeats):
+    """
+    Runs code repeats times in new processes.
+
+    Returns
+    -------
+    times : list of float
+        [s] per run, None if the code failed (e.g. missing library)
+    """
+    times = []
+    wrapped = "import time\nt0 = time.perf_counter()\n" + code + "\nprint(time.perf_counter() - t0)"
+    for r in range(repeats):
+        result = subprocess.run([sys.executable, "-c", wrapped], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            return [None]
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark of the emittance scanner program")
+    parser.add_argument("file", nargs="?", help="data file for the offline analysis step")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=None, help="maximal median time of import and motor [s]")
+    args = parser.parse_args()
+    exceeded = False
+    for name, code in STEPS.items():
+        if name == "offline":
+            if args.file is None:
+                continue
+            code = code.replace("FILE", repr(os.path.abspath(args.file)))
+        times = run(code, args.repeats)
+        if None in times:
+            print(f"{name:8s} failed")
+            continue
+        median = statistics.median(times)
+        print(f"{name:8s} median {median*1e3:8.1f} ms   min {min(times)*1e3:8.1f} ms")
+        if args.budget is not None and name in ("import", "motor") and median > args.budget:
+            exceeded = True
+    sys.exit(1 if exceeded else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Record -> replay round trip of a session with the controller stand-in and a simulated LabJack (python -m pytest).
+"""
+import functools
+import numpy as np
+import Emittance_scanner
+import Emittance_controller
+import Emittance_replay
+
+
+class Simulated_LJM:
+    """LabJack with a Gaussian beam on the scan cup, enough of labjack.ljm for Read_and_Analyze."""
+    def openS(self, *args):
+        return 1
+
+    def close(self, handle):
+        pass
+
+    def eWriteName(self, handle, name, value):
+        self.voltage = value
+
+    def eReadNames(self, handle, count, names):
+        return [-0.1*np.exp(-3*(self.voltage - 3.188)**2)] + [-0.05]*(count - 1)
+
+
+def scan_variables():
+    V = Emittance_scanner.Variables()
+    V.x_min = V.y_min = -2
+    V.x_max = V.y_max = 2
+    V.x_step = V.y_step = 1
+    V.xp_min = V.yp_min = -2
+    V.xp_max = V.yp_max = 2
+    V.xp_step = V.yp_step = 1
+    V.V_extr, V.Q, V.M = 20000, 1, 1
+    return V
+
+
+def test_record_replay_centering_and_scan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #state, homing log and data files
+    V = scan_variables()
+    M = Emittance_scanner.Motor()
+    M.telnet = functools.partial(Emittance_controller.Controller_Stand_In, speed=50)
+    M.response_delay = 0.0005
+    RnA = Emittance_scanner.Read_and_Analyze(V, M)
+    RnA.ljm = Simulated_LJM()
+    RnA.samples = 20
+    RnA.sample_delay = 0
+    trace = Emittance_replay.record(str(tmp_path/"session.trace.gz"), M, RnA)
+    M.centering(0)
+    I, file_name = RnA.get_current(0)
+    trace.close()
+    with open(tmp_path/"Emittance_Scanner_Timing.json") as f: #learned by the recorded scan
+        timing = f.read()
+
+    session = Emittance_replay.Replay_Session(str(tmp_path/"session.trace.gz"))
+    assert session.address == (M.tn.host, M.tn.port)
+    M_replay = session.motor()
+    RnA_replay = session.analyzer(V, M_replay)
+    RnA_replay.samples = 20
+    M_replay.centering(0)
+    I_replay, file_name_replay = RnA_replay.get_current(0)
+    assert M_replay.centered == M.centered
+    assert np.array_equal(I_replay, I)
+    assert session.remaining() == (0, 0)
+    with open(tmp_path/"Emittance_Scanner_Timing.json") as f:
+        assert f.read() == timing
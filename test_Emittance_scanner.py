@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Scans with the controller stand-in and a simulated LabJack (python -m pytest).
+"""
+import functools
+import numpy as np
+import Emittance_scanner
+import Emittance_controller
+from test_Emittance_replay import Simulated_LJM, scan_variables
+
+
+class Positioned_LJM(Simulated_LJM):
+    """Simulated LabJack whose beam also depends on the cup position, so columns measured at the wrong position differ."""
+    def __init__(self, Motor_instance, axis):
+        self.Mot = Motor_instance
+        self.axis = axis
+
+    def eReadNames(self, handle, count, names):
+        position = self.Mot.tn.position(self.axis) - self.Mot.tn.origin[self.axis]
+        readings = super().eReadNames(handle, count, names)
+        return [readings[0]*np.exp(-position**2/8)] + readings[1:]
+
+
+def centered_scan(tmp_path, monkeypatch, controller_program):
+    monkeypatch.chdir(tmp_path) #state, homing log and data files
+    M = Emittance_scanner.Motor()
+    M.telnet = functools.partial(Emittance_controller.Controller_Stand_In, speed=50)
+    M.response_delay = 0.0005
+    RnA = Emittance_scanner.Read_and_Analyze(scan_variables(), M)
+    RnA.samples = 5
+    RnA.sample_delay = 0
+    RnA.controller_program = controller_program
+    M.centering(0)
+    RnA.ljm = Positioned_LJM(M, 0)
+    I, file_name = RnA.get_current(0)
+    return I
+
+
+def test_controller_program_scan_matches_host_scan(tmp_path, monkeypatch):
+    (tmp_path/"host").mkdir()
+    (tmp_path/"program").mkdir()
+    I_host = centered_scan(tmp_path/"host", monkeypatch, False)
+    I_program = centered_scan(tmp_path/"program", monkeypatch, True)
+    assert I_host.shape == I_program.shape
+    assert np.count_nonzero(I_host) == I_host.size
+    assert np.allclose(I_program, I_host, rtol=1e-9, atol=0) #currents are ~1e-9 A
+
+
+def test_scan_statistics_matches_numpy():
+    rng = np.random.default_rng(0)
+    position = np.linspace(-2, 2, 9)
+    momentum = np.linspace(-3, 3, 7)
+    scans = rng.normal(1e-9, 2e-10, size=(6, len(momentum), len(position)))
+    stats = Emittance_scanner.Scan_Statistics(position, momentum)
+    for I in scans:
+        stats.add(I)
+    assert stats.n == len(scans)
+    assert np.allclose(stats.mean, np.mean(scans, axis=0), rtol=1e-12, atol=0)
+    assert np.allclose(stats.variance, np.var(scans, axis=0, ddof=1), rtol=1e-9, atol=0)
+
+
+def test_bootstrap_interval_coverage():
+    rng = np.random.default_rng(1)
+    position = np.linspace(-10e-3, 10e-3, 21) #m
+    momentum = np.linspace(-20e-3, 20e-3, 21) #rad
+    beam = Emittance_scanner.gaussian_beam(position, momentum, 10e-6, 0.5, 1.0)
+    E_true = Emittance_scanner.twiss_from_moments(Emittance_scanner.beam_moments(position, momentum, beam))[0]
+    trials, covered = 100, 0
+    for trial in range(trials):
+        stats = Emittance_scanner.Scan_Statistics(position*1e3, momentum*1e3)
+        for scan in range(10):
+            stats.add(beam*rng.normal(1, 0.1) + rng.normal(0, 0.02e-6, beam.shape))
+        estimate, low, high = stats.bootstrap(resamples=1000, confidence=0.9, seed=trial)["E_rms"]
+        assert low <= estimate <= high
+        covered += low <= E_true <= high
+    assert 0.75 <= covered/trials <= 0.98 #nominal 0.9, percentile intervals of 10 scans are a bit narrow
+
+
+def test_sparse_reconstruction_of_gaussian_beam():
+    position = np.linspace(-10e-3, 10e-3, 31) #m
+    momentum = np.linspace(-20e-3, 20e-3, 31) #rad
+    beam = Emittance_scanner.gaussian_beam(position, momentum, 10e-6, 0.5, 1.0)
+    E_true = Emittance_scanner.twiss_from_moments(Emittance_scanner.beam_moments(position, momentum, beam))[0]
+    for mode, prior, error in [("random", None, 0.1), ("stratified", None, 0.1), ("stratified", beam, 0.03)]: #the prior puts the points on the beam
+        mask = Emittance_scanner.sampling_mask(beam.shape, 0.3, mode=mode, prior=prior, seed=2)
+        assert mask.sum() == round(0.3*beam.size)
+        I = Emittance_scanner.reconstruct_current(np.where(mask, beam, 0), mask)
+        assert np.linalg.norm(I - beam)/np.linalg.norm(beam) < error, mode
+        E_rms = Emittance_scanner.twiss_from_moments(Emittance_scanner.beam_moments(position, momentum, I))[0]
+        assert abs(E_rms/E_true - 1) < error/2, mode
+
+
+def test_motion_planner_profile_boundary():
+    planner = Emittance_scanner.Motion_Planner()
+    acceleration, velocity = 20.0, 15.0
+    boundary = velocity**2/acceleration #shortest move that reaches the velocity
+    t_boundary = 2*velocity/acceleration
+    assert np.isclose(planner.move_time(boundary, acceleration, velocity), t_boundary)
+    for distance in [boundary*(1 - 1e-6), boundary*(1 + 1e-6)]: #no jump between triangular and trapezoidal profile
+        assert np.isclose(planner.move_time(distance, acceleration, velocity), t_boundary, rtol=1e-5)
+    short, long = 0.5*boundary, 2*boundary
+    assert np.isclose(planner.move_time(short, acceleration, velocity), 2*np.sqrt(short/acceleration)) #triangular
+    assert np.isclose(planner.move_time(long, acceleration, velocity), long/velocity + velocity/acceleration) #trapezoidal
+    for distance in [short, boundary, long]:
+        duration = float(planner.move_time(distance, acceleration, velocity))
+        assert np.isclose(planner.distance_at(distance, acceleration, velocity, duration/2), distance/2) #symmetric ramps
+        assert planner.distance_at(distance, acceleration, velocity, duration) == distance
+        assert planner.distance_at(distance, acceleration, velocity, 0) == 0
+        times = np.linspace(0, duration, 200)
+        assert np.all(np.diff([planner.distance_at(distance, acceleration, velocity, t) for t in times]) >= 0)
+    assert np.isclose(planner.distance_at(long, acceleration, velocity, velocity/acceleration), boundary/2) #end of the ramp
+    for distance in [0.1, boundary, 3*boundary]:
+        acc, dec, vel, t = planner.plan(distance, 0)
+        assert vel <= planner.max_velocity[0] and planner.min_acceleration[0] <= acc <= planner.max_acceleration[0]
+        assert np.isclose(t, planner.move_time(distance, acc, vel) + planner.settle_per_deceleration[0]*dec, rtol=1e-3)
+
+
+def test_journals_of_the_same_second_and_resume(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    M = Emittance_scanner.Motor()
+    M.telnet = functools.partial(Emittance_controller.Controller_Stand_In, speed=50)
+    M.response_delay = 0.0005
+    RnA = Emittance_scanner.Read_and_Analyze(scan_variables(), M)
+    RnA.samples = 5
+    journals = [RnA.start_journal(0) for i in range(3)] #well within one second
+    assert len(set(journals)) == 3
+    I, file_name = Emittance_scanner.Read_and_Analyze.resume(journals[1], M, ljm=Simulated_LJM())
+    assert file_name == journals[1][:-len(".journal")] + ".txt"
+    assert np.count_nonzero(I) == I.size